@@ -1,5 +1,12 @@
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import TTLCache
+from leaderboard import Leaderboard
+import rating
 from datetime import datetime, timedelta
 
 # Determine database type
@@ -13,6 +20,34 @@ if IS_POSTGRES:
 else:
     IntegrityError = sqlite3.IntegrityError
 
+SUPPORTS_RETURNING = IS_POSTGRES or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# In-process user cache (read-through, invalidated by the write helpers below).
+# Writes done with raw SQL elsewhere (web admin pages, another process) show up after the TTL.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 5000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)     # user_id -> get_user row
+_nickname_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL) # nickname -> users row
+_game_id_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)  # game_id -> user_id
+_chat_author_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL) # user_id -> (nickname, avatar_url)
+
+# Clan membership cache: user_id -> (clan_id, tag), or () for players without a clan.
+# Invalidated by create_clan/add_clan_member/remove_clan_member; the web app's own
+# clan writes show up after CLAN_CACHE_TTL.
+CLAN_CACHE_TTL = float(os.environ.get('CLAN_CACHE_TTL', 300))
+_clan_membership_cache = TTLCache(USER_CACHE_SIZE, CLAN_CACHE_TTL)
+
+# In-memory ranked leaderboard. Built from the users table on first use; the ELO
+# helpers below keep it current for this process's writes and bump elo_marker.version,
+# so writes from other processes are noticed by one primary key read, checked at most
+# every LEADERBOARD_CHECK seconds. LEADERBOARD_REFRESH is a backstop full rebuild.
+LEADERBOARD_REFRESH = float(os.environ.get('LEADERBOARD_REFRESH', 300))
+LEADERBOARD_CHECK = float(os.environ.get('LEADERBOARD_CHECK', 1))
+_leaderboard = Leaderboard()
+_leaderboard_built_at = None
+_leaderboard_checked_at = None
+_leaderboard_version = None # elo_marker.version the tree reflects
+
 class PostgresConnectionWrapper:
     def __init__(self, conn):
         self.conn = conn
@@ -43,23 +78,236 @@ class PostgresConnectionWrapper:
             cursor.execute(sql)
         return cursor
 
-def get_db_connection():
-    if IS_POSTGRES:
+# Connection pooling
+# Postgres: bounded pool shared by all threads of the process.
+# SQLite: one connection per thread, reused across calls. A db_connection opened
+# inside another on the same thread shares its transaction, so it runs in a
+# savepoint: its commit and rollback only cover its own work, and the outer
+# connection decides what is kept. Nested connections must close innermost first.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection:
+    # Looks like a regular connection, but close() hands it back to the pool
+    def __init__(self, pool, conn, savepoint=None):
+        self._pool = pool
+        self.conn = conn
+        self.savepoint = savepoint # set when nested in another user of the same connection
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self):
+        if self.savepoint is None:
+            self.conn.commit()
+        else:
+            # Hands the work to the outer transaction and keeps a savepoint for what follows
+            self.conn.execute(f'RELEASE SAVEPOINT {self.savepoint}')
+            self.conn.execute(f'SAVEPOINT {self.savepoint}')
+
+    def rollback(self):
+        if self.savepoint is None:
+            self.conn.rollback()
+        else:
+            self.conn.execute(f'ROLLBACK TO SAVEPOINT {self.savepoint}')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                if self.savepoint is not None:
+                    # Drop what was not committed, as the outermost release does
+                    self.rollback()
+                    self.conn.execute(f'RELEASE SAVEPOINT {self.savepoint}')
+            finally:
+                self._pool.release(self.conn)
+
+class PostgresPool:
+    def __init__(self, size, timeout):
+        from psycopg2.pool import ThreadedConnectionPool
         try:
             # Add sslmode='require' for secure connection on Render
-            conn = psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor, sslmode='require')
+            self._pool = ThreadedConnectionPool(1, size, DATABASE_URL, cursor_factory=DictCursor, sslmode='require')
         except psycopg2.OperationalError:
-            # Fallback without sslmode if require fails (e.g. local postgres)
-            conn = psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor)
-            
+            # Fallback without sslmode if require fails (e.g. local postgres).
+            # Decided once per pool, so we don't pay for a failed handshake on every connect.
+            self._pool = ThreadedConnectionPool(1, size, DATABASE_URL, cursor_factory=DictCursor)
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        started = time.monotonic()
+        waited = not self._slots.acquire(blocking=False)
+        if waited and not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.waits += 1
+                self.timeouts += 1
+            raise PoolTimeout(f"No free database connection after {self.timeout}s")
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
         conn.autocommit = False
+        waited_for = time.monotonic() - started
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += waited_for
+                self.max_wait = max(self.max_wait, waited_for)
         return PostgresConnectionWrapper(conn)
-    else:
-        basedir = os.path.dirname(os.path.abspath(__file__))
-        db_path = os.path.join(basedir, 'database.db')
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-    return conn
+
+    def savepoint(self, conn):
+        # Every acquire gets a connection of its own
+        return None
+
+    def release(self, wrapper):
+        try:
+            # putconn rolls back anything left uncommitted
+            self._pool.putconn(wrapper.conn, close=bool(wrapper.conn.closed))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'postgres',
+                'size': self.size,
+                'open': len(self._pool._pool) + len(self._pool._used),
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time': round(self.wait_time, 4),
+                'max_wait': round(self.max_wait, 4),
+            }
+
+class SQLitePool:
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.acquired = 0
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self.open += 1
+        self._local.depth += 1
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+        return conn
+
+    def savepoint(self, conn):
+        # A user nested in another one on this thread: returns the savepoint it runs in
+        if self._local.depth == 1:
+            return None
+        name = f'pool_nested_{self._local.depth}'
+        conn.execute(f'SAVEPOINT {name}')
+        return name
+
+    def release(self, conn):
+        self._local.depth -= 1
+        # Last user of this thread's connection: drop whatever was not committed,
+        # same as closing a fresh connection would have done
+        if self._local.depth == 0 and conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'sqlite',
+                'size': self.open,
+                'open': self.open,
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'waits': 0,
+                'timeouts': 0,
+                'wait_time': 0.0,
+                'max_wait': 0.0,
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    # Rebuild after fork (gunicorn workers must not share sockets with the master)
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                if IS_POSTGRES:
+                    _pool = PostgresPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+                else:
+                    _pool = SQLitePool(SQLITE_PATH)
+    return _pool
+
+def get_pool_stats():
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+def get_db_connection():
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        savepoint = pool.savepoint(conn)
+    except BaseException:
+        pool.release(conn)
+        raise
+    return PooledConnection(pool, conn, savepoint)
+
+@contextmanager
+def db_connection():
+    conn = get_db_connection()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+@contextmanager
+def db_cursor():
+    with db_connection() as conn:
+        yield conn.cursor()
 
 def execute_query(cursor, sql, params=None):
     if IS_POSTGRES:
@@ -76,815 +324,825 @@ def execute_query(cursor, sql, params=None):
         cursor.execute(sql)
     return cursor
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Helper for creating tables compatible with both
-    def create_table(sql):
-        if IS_POSTGRES:
-            sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
-            sql = sql.replace('DATETIME', 'TIMESTAMP')
-        execute_query(cursor, sql)
-
-    # Users
-    create_table('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            game_id TEXT,
-            nickname TEXT,
-            elo INTEGER DEFAULT 1000,
-            level INTEGER DEFAULT 4,
-            matches INTEGER DEFAULT 0,
-            wins INTEGER DEFAULT 0,
-            is_admin INTEGER DEFAULT 0
-        )
-    ''')
-
-    # Migration: Ensure is_admin column exists
-    # REMOVED: This block caused rollback of CREATE TABLE users because is_admin already exists in schema.
-    # The migration section at the end handles this safely.
-
-
+def execute_many(cursor, sql, seq_of_params):
+    if IS_POSTGRES:
+        sql = sql.replace('?', '%s')
+    cursor.executemany(sql, seq_of_params)
+    return cursor
 
-    
-    # Matches
-    create_table('''
-        CREATE TABLE IF NOT EXISTS matches (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            status TEXT DEFAULT 'active',
-            mode TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Match Players
-    create_table('''
-        CREATE TABLE IF NOT EXISTS match_players (
-            match_id INTEGER,
-            user_id BIGINT,
-            accepted INTEGER DEFAULT 0,
-            PRIMARY KEY (match_id, user_id)
-        )
-    ''')
-
-    # Support Tickets
-    create_table('''
-        CREATE TABLE IF NOT EXISTS support_tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id BIGINT,
-            text TEXT,
-            status TEXT DEFAULT 'open',
-            admin_id BIGINT
-        )
-    ''')
-    
-    # Lobby Members
-    create_table('''
-        CREATE TABLE IF NOT EXISTS lobby_members (
-            mode TEXT,
-            lobby_id INTEGER,
-            user_id BIGINT,
-            PRIMARY KEY (mode, lobby_id, user_id)
-        )
-    ''')
-
-    # Clans
-    create_table('''
-        CREATE TABLE IF NOT EXISTS clans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tag TEXT UNIQUE,
-            name TEXT,
-            owner_id BIGINT,
-            level INTEGER DEFAULT 1,
-            exp INTEGER DEFAULT 0,
-            matches_played INTEGER DEFAULT 0,
-            matches_won INTEGER DEFAULT 0,
-            clan_elo INTEGER DEFAULT 1000,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            logo_url TEXT
-        )
-    ''')
-
-    # Clan Members
-    create_table('''
-        CREATE TABLE IF NOT EXISTS clan_members (
-            clan_id INTEGER,
-            user_id BIGINT UNIQUE,
-            role TEXT DEFAULT 'member',
-            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (clan_id, user_id),
-            FOREIGN KEY (clan_id) REFERENCES clans(id)
-        )
-    ''')
-
-    # Polls
-    create_table('''
-        CREATE TABLE IF NOT EXISTS polls (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            question TEXT,
-            is_active INTEGER DEFAULT 1,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    create_table('''
-        CREATE TABLE IF NOT EXISTS poll_options (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            poll_id INTEGER,
-            option_text TEXT,
-            FOREIGN KEY (poll_id) REFERENCES polls(id)
-        )
-    ''')
-
-    create_table('''
-        CREATE TABLE IF NOT EXISTS poll_votes (
-            poll_id INTEGER,
-            option_id INTEGER,
-            user_id BIGINT,
-            PRIMARY KEY (poll_id, user_id),
-            FOREIGN KEY (poll_id) REFERENCES polls(id),
-            FOREIGN KEY (option_id) REFERENCES poll_options(id)
-        )
-    ''')
-
-    # Clan Matchmaking Queue
-    create_table('''
-        CREATE TABLE IF NOT EXISTS clan_matchmaking_queue (
-            clan_id INTEGER PRIMARY KEY,
-            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (clan_id) REFERENCES clans(id)
-        )
-    ''')
-
-    # Clan Matches
-    create_table('''
-        CREATE TABLE IF NOT EXISTS clan_matches (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            clan1_id INTEGER,
-            clan2_id INTEGER,
-            winner_clan_id INTEGER,
-            status TEXT DEFAULT 'active',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (clan1_id) REFERENCES clans(id),
-            FOREIGN KEY (clan2_id) REFERENCES clans(id)
-        )
-    ''')
-
-    # Matchmaking Queue
-    create_table('''
-        CREATE TABLE IF NOT EXISTS matchmaking_queue (
-            user_id BIGINT PRIMARY KEY,
-            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Match Stats
-    create_table('''
-        CREATE TABLE IF NOT EXISTS match_stats (
-            match_id INTEGER,
-            user_id BIGINT,
-            kills INTEGER DEFAULT 0,
-            deaths INTEGER DEFAULT 0,
-            headshots INTEGER DEFAULT 0,
-            mvps INTEGER DEFAULT 0,
-            score INTEGER DEFAULT 0,
-            PRIMARY KEY (match_id, user_id)
-        )
-    ''')
-    
-    # Match Chat
-    create_table('''
-        CREATE TABLE IF NOT EXISTS match_chat (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            match_id INTEGER,
-            user_id BIGINT,
-            message TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Friends
-    create_table('''
-        CREATE TABLE IF NOT EXISTS friends (
-            user_id BIGINT,
-            friend_id BIGINT,
-            status TEXT DEFAULT 'pending',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, friend_id),
-            FOREIGN KEY (user_id) REFERENCES users(user_id),
-            FOREIGN KEY (friend_id) REFERENCES users(user_id)
-        )
-    ''')
-
-    # Commit table creations before running migrations
-    conn.commit()
-
-    # Migration checks (moved to end to ensure tables exist)
-    if not IS_POSTGRES:
-        # SQLite specific migrations for existing local DB
-        try:
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [column[1] for column in cursor.fetchall()]
-            if 'level' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN level INTEGER DEFAULT 4')
-            if 'is_banned' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN is_banned INTEGER DEFAULT 0')
-            if 'ban_until' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN ban_until DATETIME')
-            if 'missed_games' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN missed_games INTEGER DEFAULT 0')
-            if 'is_vip' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN is_vip INTEGER DEFAULT 0')
-            if 'vip_until' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN vip_until DATETIME')
-            if 'is_admin' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN is_admin INTEGER DEFAULT 0')
-            if 'avatar_url' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN avatar_url TEXT')
-            if 'steam_url' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN steam_url TEXT')
-            if 'bio' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN bio TEXT')
-            if 'warnings' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN warnings INTEGER DEFAULT 0')
-            if 'ban_expiration' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN ban_expiration INTEGER DEFAULT 0')
-
-            cursor.execute("PRAGMA table_info(support_tickets)")
-            st_columns = [column[1] for column in cursor.fetchall()]
-            if 'admin_id' not in st_columns:
-                cursor.execute('ALTER TABLE support_tickets ADD COLUMN admin_id INTEGER')
-            
-            cursor.execute("PRAGMA table_info(matches)")
-            m_columns = [column[1] for column in cursor.fetchall()]
-            if 'mode' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN mode TEXT')
-            if 'created_at' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN created_at DATETIME')
-            if 'team1_score' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN team1_score INTEGER DEFAULT 0')
-            if 'team2_score' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN team2_score INTEGER DEFAULT 0')
-            if 'winner_team' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN winner_team INTEGER')
-            if 'veto_status' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN veto_status TEXT')
-            if 'current_veto_turn' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN current_veto_turn INTEGER')
-            if 'map_picked' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN map_picked TEXT')
-            if 'last_action_time' not in m_columns:
-                cursor.execute('ALTER TABLE matches ADD COLUMN last_action_time INTEGER DEFAULT 0')
-
-            cursor.execute('UPDATE users SET level = 4 WHERE elo = 1000')
-
-            cursor.execute("PRAGMA table_info(match_players)")
-            mp_columns = [column[1] for column in cursor.fetchall()]
-            if 'team' not in mp_columns:
-                cursor.execute('ALTER TABLE match_players ADD COLUMN team INTEGER DEFAULT 1')
-            if 'is_annulled' not in mp_columns:
-                cursor.execute('ALTER TABLE match_players ADD COLUMN is_annulled INTEGER DEFAULT 0')
-            if 'has_left' not in mp_columns:
-                cursor.execute('ALTER TABLE match_players ADD COLUMN has_left INTEGER DEFAULT 0')
-        except Exception as e:
-            print(f"SQLite Migration error: {e}")
-    else:
-        # Postgres migrations
-        try:
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS avatar_url TEXT')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS steam_url TEXT')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS bio TEXT')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS level INTEGER DEFAULT 4')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_banned INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS ban_until TIMESTAMP')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS missed_games INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_vip INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS vip_until TIMESTAMP')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS warnings INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS ban_expiration INTEGER DEFAULT 0')
-            
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS team1_score INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS team2_score INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS winner_team INTEGER')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS veto_status TEXT')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS current_veto_turn BIGINT')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS map_picked TEXT')
-            execute_query(cursor, 'ALTER TABLE matches ADD COLUMN IF NOT EXISTS last_action_time INTEGER DEFAULT 0')
-            
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS warnings INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE users ADD COLUMN IF NOT EXISTS ban_expiration INTEGER DEFAULT 0')
-            
-            execute_query(cursor, 'ALTER TABLE match_players ADD COLUMN IF NOT EXISTS team INTEGER DEFAULT 1')
-            execute_query(cursor, 'ALTER TABLE match_players ADD COLUMN IF NOT EXISTS is_annulled INTEGER DEFAULT 0')
-            execute_query(cursor, 'ALTER TABLE match_players ADD COLUMN IF NOT EXISTS has_left INTEGER DEFAULT 0')
-            
-            execute_query(cursor, 'ALTER TABLE clans ADD COLUMN IF NOT EXISTS logo_url TEXT')
-            execute_query(cursor, 'ALTER TABLE clans ADD COLUMN IF NOT EXISTS clan_elo INTEGER DEFAULT 1000')
-            
-            # Commit migrations immediately to avoid transaction issues
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            print(f"Postgres Migration error (harmless if fresh): {e}")
-        
-    conn.commit()
-    conn.close()
+def init_db():
+    # Schema lives in migrations.py; a warm start is a single version check
+    import migrations
+    with db_connection() as conn:
+        migrations.migrate(conn)
 
 def get_clan_by_tag(tag):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT * FROM clans WHERE tag = ?', (tag,))
-    clan = cursor.fetchone()
-    conn.close()
-    return clan
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT * FROM clans WHERE tag = ?', (tag,))
+        clan = cursor.fetchone()
+        return clan
 
 def get_clan_by_id(clan_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT * FROM clans WHERE id = ?', (clan_id,))
-    clan = cursor.fetchone()
-    conn.close()
-    return clan
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT * FROM clans WHERE id = ?', (clan_id,))
+        clan = cursor.fetchone()
+        return clan
 
 def get_user_clan(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT c.* FROM clans c 
-        JOIN clan_members cm ON c.id = cm.clan_id 
-        WHERE cm.user_id = ?
-    ''', (user_id,))
-    clan = cursor.fetchone()
-    conn.close()
-    return clan
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT c.* FROM clans c 
+            JOIN clan_members cm ON c.id = cm.clan_id 
+            WHERE cm.user_id = ?
+        ''', (user_id,))
+        clan = cursor.fetchone()
+        return clan
 
 def create_clan(tag, name, owner_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        if IS_POSTGRES:
-            execute_query(cursor, 'INSERT INTO clans (tag, name, owner_id) VALUES (?, ?, ?) RETURNING id', (tag, name, owner_id))
-            clan_id = cursor.fetchone()[0] # or ['id']
-        else:
-            execute_query(cursor, 'INSERT INTO clans (tag, name, owner_id) VALUES (?, ?, ?)', (tag, name, owner_id))
-            clan_id = cursor.lastrowid
-            
-        execute_query(cursor, 'INSERT INTO clan_members (clan_id, user_id, role) VALUES (?, ?, ?)', (clan_id, owner_id, 'owner'))
-        conn.commit()
+        with db_cursor() as cursor:
+            if IS_POSTGRES:
+                execute_query(cursor, 'INSERT INTO clans (tag, name, owner_id) VALUES (?, ?, ?) RETURNING id', (tag, name, owner_id))
+                clan_id = cursor.fetchone()[0] # or ['id']
+            else:
+                execute_query(cursor, 'INSERT INTO clans (tag, name, owner_id) VALUES (?, ?, ?)', (tag, name, owner_id))
+                clan_id = cursor.lastrowid
+                
+            execute_query(cursor, 'INSERT INTO clan_members (clan_id, user_id, role) VALUES (?, ?, ?)', (clan_id, owner_id, 'owner'))
+        _clan_membership_cache.pop(owner_id)
         return clan_id
     except Exception:
         return None
-    finally:
-        conn.close()
 
 def get_all_clans():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT * FROM clans')
-    clans = cursor.fetchall()
-    conn.close()
-    return clans
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT * FROM clans')
+        clans = cursor.fetchall()
+        return clans
 
 def get_clan_members(clan_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT u.user_id, u.nickname, u.elo, u.level, cm.role 
-        FROM clan_members cm 
-        JOIN users u ON cm.user_id = u.user_id 
-        WHERE cm.clan_id = ?
-    ''', (clan_id,))
-    members = cursor.fetchall()
-    conn.close()
-    return members
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT u.user_id, u.nickname, u.elo, u.level, cm.role 
+            FROM clan_members cm 
+            JOIN users u ON cm.user_id = u.user_id 
+            WHERE cm.clan_id = ?
+        ''', (clan_id,))
+        members = cursor.fetchall()
+        return members
 
 def add_clan_member(clan_id, user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        execute_query(cursor, 'INSERT INTO clan_members (clan_id, user_id) VALUES (?, ?)', (clan_id, user_id))
-        conn.commit()
+        with db_cursor() as cursor:
+            execute_query(cursor, 'INSERT INTO clan_members (clan_id, user_id) VALUES (?, ?)', (clan_id, user_id))
+        _clan_membership_cache.pop(user_id)
         return True
     except Exception:
         return False
-    finally:
-        conn.close()
 
 def get_clan_count():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT COUNT(*) FROM clans')
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT COUNT(*) FROM clans')
+        count = cursor.fetchone()[0]
+        return count
 
 def get_all_users():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT user_id, game_id, nickname, elo, level, is_banned, ban_until, missed_games, is_vip, vip_until FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT user_id, game_id, nickname, elo, level, is_banned, ban_until, missed_games, is_vip, vip_until FROM users')
+        users = cursor.fetchall()
+        return users
 
 def increment_missed_games(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'UPDATE users SET missed_games = missed_games + 1 WHERE user_id = ?', (user_id,))
-    execute_query(cursor, 'SELECT missed_games FROM users WHERE user_id = ?', (user_id,))
-    count = cursor.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'UPDATE users SET missed_games = missed_games + 1 WHERE user_id = ?', (user_id,))
+        execute_query(cursor, 'SELECT missed_games FROM users WHERE user_id = ?', (user_id,))
+        count = cursor.fetchone()[0]
+    invalidate_user(user_id)
     return count
 
 def reset_missed_games(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'UPDATE users SET missed_games = 0 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'UPDATE users SET missed_games = 0 WHERE user_id = ?', (user_id,))
+    invalidate_user(user_id)
 
 def set_ban_status(user_id, status, until=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if status:
-        execute_query(cursor, 'UPDATE users SET is_banned = 1, ban_until = ? WHERE user_id = ?', (until, user_id))
-    else:
-        execute_query(cursor, 'UPDATE users SET is_banned = 0, ban_until = NULL WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        if status:
+            execute_query(cursor, 'UPDATE users SET is_banned = 1, ban_until = ? WHERE user_id = ?', (until, user_id))
+        else:
+            execute_query(cursor, 'UPDATE users SET is_banned = 0, ban_until = NULL WHERE user_id = ?', (user_id,))
+    invalidate_user(user_id)
 
 def create_match(mode, players_ids):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    if IS_POSTGRES:
-        execute_query(cursor, 'INSERT INTO matches (status, mode) VALUES (%s, %s) RETURNING id', ('pending', mode))
-        match_id = cursor.fetchone()[0]
-    else:
-        execute_query(cursor, 'INSERT INTO matches (status, mode) VALUES ("pending", ?)', (mode,))
-        match_id = cursor.lastrowid
-    
-    for uid in players_ids:
-        execute_query(cursor, 'INSERT INTO match_players (match_id, user_id) VALUES (?, ?)', (match_id, uid))
-        
-    conn.commit()
-    conn.close()
-    return match_id
+    with db_cursor() as cursor:
+        if IS_POSTGRES:
+            execute_query(cursor, 'INSERT INTO matches (status, mode) VALUES (%s, %s) RETURNING id', ('pending', mode))
+            match_id = cursor.fetchone()[0]
+        else:
+            execute_query(cursor, 'INSERT INTO matches (status, mode) VALUES ("pending", ?)', (mode,))
+            match_id = cursor.lastrowid
+
+        for uid in players_ids:
+            execute_query(cursor, 'INSERT INTO match_players (match_id, user_id) VALUES (?, ?)', (match_id, uid))
+
+        return match_id
 
 def accept_match_player(match_id, user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'UPDATE match_players SET accepted = 1 WHERE match_id = ? AND user_id = ?', (match_id, user_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'UPDATE match_players SET accepted = 1 WHERE match_id = ? AND user_id = ?', (match_id, user_id))
+        touch_match(cursor, match_id)
+
+def touch_match(cursor, match_id):
+    # Bumps matches.version in the caller's transaction, for writes that don't
+    # update the match row itself (chat, players)
+    execute_query(cursor, 'UPDATE matches SET version = version + 1 WHERE id = ?', (match_id,))
+
+def get_match_versions(match_ids):
+    # {match_id: version}; matches that don't exist are left out
+    match_ids = list(match_ids)
+    if not match_ids:
+        return {}
+    placeholders = ', '.join(['?'] * len(match_ids))
+    with db_cursor() as cursor:
+        execute_query(cursor, f'SELECT id, version FROM matches WHERE id IN ({placeholders})', match_ids)
+        return {row[0]: row[1] or 0 for row in cursor.fetchall()}
+
+def _match_chat(cursor, match_id, since_id, limit):
+    if since_id is None:
+        # Latest `limit` messages
+        execute_query(cursor, '''
+            SELECT id, user_id, message, created_at FROM match_chat
+            WHERE match_id = ? ORDER BY id DESC LIMIT ?
+        ''', (match_id, limit))
+        return cursor.fetchall()[::-1]
+    sql = 'SELECT id, user_id, message, created_at FROM match_chat WHERE match_id = ? AND id > ? ORDER BY id ASC'
+    if limit is None:
+        execute_query(cursor, sql, (match_id, since_id))
+    else:
+        execute_query(cursor, sql + ' LIMIT ?', (match_id, since_id, limit))
+    return cursor.fetchall()
+
+def get_match_chat(match_id, since_id=None, limit=50):
+    # [(id, user_id, message, created_at)] oldest first: messages with id > since_id,
+    # or the latest ones if since_id is None. Authors come from get_chat_authors.
+    with db_cursor() as cursor:
+        return _match_chat(cursor, match_id, since_id, limit)
+
+def get_match_feed(match_id, since_id=None, limit=50):
+    # (match row, get_match_chat rows), or (None, []) if the match doesn't exist
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
+        match = cursor.fetchone()
+        if not match:
+            return None, []
+        return match, _match_chat(cursor, match_id, since_id, limit)
+
+def add_match_chat_messages(messages):
+    # messages: [(match_id, user_id, text)], written in one transaction
+    messages = list(messages)
+    with db_cursor() as cursor:
+        execute_many(cursor, 'INSERT INTO match_chat (match_id, user_id, message) VALUES (?, ?, ?)', messages)
+        for match_id in dict.fromkeys(match_id for match_id, _, _ in messages):
+            touch_match(cursor, match_id)
+
+def get_chat_authors(user_ids):
+    # {user_id: (nickname, avatar_url)} for chat messages, cached like get_user
+    authors = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        author = _chat_author_cache.get(user_id)
+        if author is not None:
+            authors[user_id] = author
+        else:
+            missing.append(user_id)
+    if missing:
+        with db_cursor() as cursor:
+            for chunk in _chunks(missing):
+                placeholders = ', '.join(['?'] * len(chunk))
+                execute_query(cursor, f'SELECT user_id, nickname, avatar_url FROM users WHERE user_id IN ({placeholders})', chunk)
+                for user_id, nickname, avatar_url in cursor.fetchall():
+                    authors[user_id] = (nickname, avatar_url)
+                    _chat_author_cache.set(user_id, (nickname, avatar_url))
+    return authors
+
+def _veto_players(cursor, match_ids):
+    # {match_id: [user_id]} in veto turn order: team, then user id
+    placeholders = ', '.join(['?'] * len(match_ids))
+    execute_query(cursor, f'SELECT match_id, user_id FROM match_players WHERE match_id IN ({placeholders}) ORDER BY match_id, team, user_id', match_ids)
+    players = {}
+    for match_id, user_id in cursor.fetchall():
+        players.setdefault(match_id, []).append(user_id)
+    return players
+
+def get_veto_state(match_id):
+    # (veto_bans, current_veto_turn, [player ids in turn order]) of an active
+    # match, or None if there is no such match or it isn't active
+    with db_cursor() as cursor:
+        execute_query(cursor, "SELECT veto_bans, current_veto_turn FROM matches WHERE id = ? AND status = 'active'", (match_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return row[0], row[1], _veto_players(cursor, [match_id]).get(match_id, [])
+
+def start_veto(match_id, first_turn, now):
+    # Opens the web veto of a match that hasn't started one, starting the ban timer
+    # unless match creation already did (NULL and the schema default 0 both mean no
+    # timer); False if it already had
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE matches SET veto_bans = 0, current_veto_turn = ?, version = version + 1,
+                last_action_time = CASE WHEN COALESCE(last_action_time, 0) = 0 THEN ? ELSE last_action_time END
+            WHERE id = ? AND veto_bans IS NULL
+        ''', (first_turn, now, match_id))
+        return cursor.rowcount > 0
+
+def get_overdue_vetoes(cutoff):
+    # [(match_id, veto_bans, current_veto_turn, [player ids in turn order])] for active
+    # matches still in map veto whose current turn started at or before `cutoff`;
+    # a 0 timer (the schema default) was never started
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT id, veto_bans, current_veto_turn FROM matches
+            WHERE status = 'active' AND last_action_time > 0 AND last_action_time <= ? AND map_picked IS NULL
+        ''', (cutoff,))
+        matches = cursor.fetchall()
+        if not matches:
+            return []
+        players = _veto_players(cursor, [row[0] for row in matches])
+    return [(row[0], row[1], row[2], players.get(row[0], [])) for row in matches]
+
+def save_vetoes(updates, now):
+    # Write-through for match_state.MatchStates and the veto sweeper.
+    # updates: [(match_id, old_bans, veto_bans, map_picked, current_turn, actions)], all in
+    # one transaction; actions are (user_id, map_name, action) for log_veto_action. A match
+    # only changes if its bans are still old_bans, so whoever wrote first wins and the
+    # others reload. Returns the updated match ids.
+    applied = []
+    with db_cursor() as cursor:
+        for match_id, old_bans, veto_bans, map_picked, current_turn, actions in updates:
+            execute_query(cursor, '''
+                UPDATE matches
+                SET veto_bans = ?, map_picked = ?, current_veto_turn = ?, last_action_time = ?, version = version + 1
+                WHERE id = ? AND status = 'active' AND COALESCE(veto_bans, 0) = ? AND map_picked IS NULL
+            ''', (veto_bans, map_picked, current_turn, now, match_id, old_bans))
+            if cursor.rowcount:
+                applied.append(match_id)
+                for user_id, map_name, action in actions:
+                    log_veto_action(cursor, match_id, user_id, map_name, action)
+    return applied
+
+def log_veto_action(cursor, match_id, user_id, map_name, action):
+    # action: 'ban', 'auto_ban' (turn timed out, user_id is whose turn it was) or 'pick'
+    execute_query(cursor, 'INSERT INTO veto_actions (match_id, user_id, map_name, action) VALUES (?, ?, ?, ?)',
+                  (match_id, user_id, map_name, action))
+
+def add_veto_actions(match_id, actions):
+    # Bot matches keep their veto in memory; this records its history.
+    # actions: [(user_id, map_name, action)]
+    with db_cursor() as cursor:
+        for user_id, map_name, action in actions:
+            log_veto_action(cursor, match_id, user_id, map_name, action)
+
+def get_veto_actions(match_id):
+    # [(user_id, map_name, action, created_at)] in order
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT user_id, map_name, action, created_at FROM veto_actions WHERE match_id = ? ORDER BY id', (match_id,))
+        return cursor.fetchall()
 
 def get_match_players(match_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT mp.user_id, u.nickname, u.elo, u.level, mp.accepted 
-        FROM match_players mp
-        JOIN users u ON mp.user_id = u.user_id
-        WHERE mp.match_id = ?
-    ''', (match_id,))
-    players = cursor.fetchall()
-    conn.close()
-    return players 
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT mp.user_id, u.nickname, u.elo, u.level, mp.accepted 
+            FROM match_players mp
+            JOIN users u ON mp.user_id = u.user_id
+            WHERE mp.match_id = ?
+        ''', (match_id,))
+        players = cursor.fetchall()
+        return players 
 
 def cancel_match(match_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, "UPDATE matches SET status = 'cancelled' WHERE id = ?", (match_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, "UPDATE matches SET status = 'cancelled', version = version + 1 WHERE id = ?", (match_id,))
 
 def get_pending_match(match_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, "SELECT id, mode, status FROM matches WHERE id = ? AND status = 'pending'", (match_id,))
-    match = cursor.fetchone()
-    conn.close()
-    return match
+    with db_cursor() as cursor:
+        execute_query(cursor, "SELECT id, mode, status FROM matches WHERE id = ? AND status = 'pending'", (match_id,))
+        match = cursor.fetchone()
+        return match
+
+LEVEL_THRESHOLDS = [(500, 1), (750, 2), (900, 3), (1050, 4), (1200, 5), (1350, 6), (1530, 7), (1750, 8), (2000, 9)]
 
 def get_level_by_elo(elo):
     try:
         elo = int(elo)
     except (ValueError, TypeError):
         elo = 1000
-    if elo <= 500: return 1
-    if elo <= 750: return 2
-    if elo <= 900: return 3
-    if elo <= 1050: return 4
-    if elo <= 1200: return 5
-    if elo <= 1350: return 6
-    if elo <= 1530: return 7
-    if elo <= 1750: return 8
-    if elo <= 2000: return 9
+    for max_elo, level in LEVEL_THRESHOLDS:
+        if elo <= max_elo: return level
     return 10
 
+# Same mapping as get_level_by_elo, for recomputing levels inside a single UPDATE
+LEVEL_CASE_SQL = 'CASE ' + ' '.join(f'WHEN elo <= {max_elo} THEN {level}' for max_elo, level in LEVEL_THRESHOLDS) + ' ELSE 10 END'
+
 def add_user(user_id, game_id, nickname):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    if IS_POSTGRES:
-        # Postgres ON CONFLICT syntax
-        execute_query(cursor, '''
-            INSERT INTO users (user_id, game_id, nickname, elo, level) 
-            VALUES (?, ?, ?, 1000, 4)
-            ON CONFLICT (user_id) DO UPDATE SET
-            game_id = EXCLUDED.game_id,
-            nickname = EXCLUDED.nickname
-        ''', (user_id, game_id, nickname))
-    else:
-        # SQLite syntax
-        execute_query(cursor, 'INSERT OR REPLACE INTO users (user_id, game_id, nickname, elo, level) VALUES (?, ?, ?, 1000, 4)', 
-                       (user_id, game_id, nickname))
-                       
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        if IS_POSTGRES:
+            # Postgres ON CONFLICT syntax
+            execute_query(cursor, '''
+                INSERT INTO users (user_id, game_id, nickname, elo, level) 
+                VALUES (?, ?, ?, 1000, 4)
+                ON CONFLICT (user_id) DO UPDATE SET
+                game_id = EXCLUDED.game_id,
+                nickname = EXCLUDED.nickname
+            ''', (user_id, game_id, nickname))
+        else:
+            # SQLite syntax
+            execute_query(cursor, 'INSERT OR REPLACE INTO users (user_id, game_id, nickname, elo, level) VALUES (?, ?, ?, 1000, 4)', 
+                           (user_id, game_id, nickname))
+        # A new player changes everyone's rank below them
+        versions = _stamp_elo_version(cursor)
+    invalidate_user(user_id)
+    # INSERT OR REPLACE resets the ELO; the Postgres upsert keeps an existing one
+    if not (IS_POSTGRES and user_id in _leaderboard):
+        update_leaderboard(user_id, 1000)
+    _elo_written(versions)
 
 def get_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT user_id, game_id, nickname, elo, level, matches, wins, 
-               is_banned, ban_until, missed_games, is_vip, vip_until 
-        FROM users WHERE user_id = ?
-    ''', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user = _user_cache.get(user_id)
+    if user is not None:
+        return user
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT user_id, game_id, nickname, elo, level, matches, wins, 
+                   is_banned, ban_until, missed_games, is_vip, vip_until 
+            FROM users WHERE user_id = ?
+        ''', (user_id,))
+        user = cursor.fetchone()
+    if user is not None:
+        _user_cache.set(user_id, user)
     return user
 
-def get_top_players(limit=10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT nickname, elo, level, is_vip FROM users ORDER BY elo DESC LIMIT ?', (limit,))
-    players = cursor.fetchall()
-    conn.close()
-    return players
+def _chunks(items, size=500):
+    # Keep IN (...) lists under SQLite's bound-parameter limit
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def get_users(user_ids):
+    # Batch get_user: {user_id: row} for every id that exists, one query for all cache misses
+    users = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        user = _user_cache.get(user_id)
+        if user is not None:
+            users[user_id] = user
+        else:
+            missing.append(user_id)
+    if missing:
+        with db_cursor() as cursor:
+            for chunk in _chunks(missing):
+                placeholders = ', '.join(['?'] * len(chunk))
+                execute_query(cursor, f'''
+                    SELECT user_id, game_id, nickname, elo, level, matches, wins, 
+                           is_banned, ban_until, missed_games, is_vip, vip_until 
+                    FROM users WHERE user_id IN ({placeholders})
+                ''', chunk)
+                for user in cursor.fetchall():
+                    users[user[0]] = user
+                    _user_cache.set(user[0], user)
+    return users
+
+def get_vip_flags(user_ids):
+    # Batch is_user_vip: {user_id: bool}; expired VIPs are switched off in one UPDATE
+    user_ids = list(user_ids)
+    users = get_users(user_ids)
+    flags = {}
+    expired = []
+    now = datetime.now()
+    for user_id in user_ids:
+        user = users.get(user_id)
+        flags[user_id] = bool(user and user[10])
+        if flags[user_id] and user[11]:
+            try:
+                until_dt = user[11]
+                if isinstance(until_dt, str):
+                    until_dt = datetime.strptime(until_dt, "%Y-%m-%d %H:%M:%S")
+                if now > until_dt:
+                    flags[user_id] = False
+                    expired.append(user_id)
+            except: pass
+    if expired:
+        with db_cursor() as cursor:
+            execute_many(cursor, 'UPDATE users SET is_vip = 0, vip_until = NULL WHERE user_id = ?', [(user_id,) for user_id in expired])
+        for user_id in expired:
+            invalidate_user(user_id)
+    return flags
+
+def get_clan_membership(user_id):
+    # (clan_id, tag) of the player's clan, or None
+    membership = _clan_membership_cache.get(user_id)
+    if membership is None:
+        membership = get_clan_memberships([user_id]).get(user_id)
+    return membership or None
+
+def get_clan_memberships(user_ids):
+    # Batch get_clan_membership: {user_id: (clan_id, tag)} for players that are in a clan
+    memberships = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        membership = _clan_membership_cache.get(user_id)
+        if membership is None:
+            missing.append(user_id)
+        elif membership:
+            memberships[user_id] = membership
+    if missing:
+        with db_cursor() as cursor:
+            for chunk in _chunks(missing):
+                placeholders = ', '.join(['?'] * len(chunk))
+                execute_query(cursor, f'''
+                    SELECT cm.user_id, c.id, c.tag FROM clan_members cm 
+                    JOIN clans c ON c.id = cm.clan_id 
+                    WHERE cm.user_id IN ({placeholders})
+                ''', chunk)
+                for user_id, clan_id, tag in cursor.fetchall():
+                    memberships[user_id] = (clan_id, tag)
+        for user_id in missing:
+            _clan_membership_cache.set(user_id, memberships.get(user_id, ()))
+    return memberships
+
+def prime_clan_cache():
+    # Loads every clan membership in one query (bot startup)
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT cm.user_id, c.id, c.tag FROM clan_members cm 
+            JOIN clans c ON c.id = cm.clan_id
+        ''')
+        rows = cursor.fetchall()
+    for user_id, clan_id, tag in rows:
+        _clan_membership_cache.set(user_id, (clan_id, tag))
+    return len(rows)
+
+def invalidate_user(user_id):
+    _user_cache.pop(user_id)
+    _chat_author_cache.pop(user_id)
+    if len(_nickname_cache):
+        _nickname_cache.invalidate_if(lambda nickname, row: row[0] == user_id)
+    if len(_game_id_cache):
+        _game_id_cache.invalidate_if(lambda game_id, cached_id: cached_id == user_id)
+
+def clear_user_cache():
+    _user_cache.clear()
+    _nickname_cache.clear()
+    _game_id_cache.clear()
+    _chat_author_cache.clear()
+    _clan_membership_cache.clear()
+
+def get_cache_stats():
+    return {
+        'users': _user_cache.stats(),
+        'nicknames': _nickname_cache.stats(),
+        'game_ids': _game_id_cache.stats(),
+        'chat_authors': _chat_author_cache.stats(),
+        'clans': _clan_membership_cache.stats(),
+    }
+
+def _elo_version(cursor):
+    execute_query(cursor, 'SELECT version FROM elo_marker WHERE id = 1')
+    return cursor.fetchone()[0]
+
+def _stamp_elo_version(cursor):
+    # Marks an ELO write for other processes' leaderboards, in the writer's
+    # transaction. The UPDATE locks the marker row until commit, so concurrent
+    # writers get distinct versions in commit order. Returns (before, after)
+    # for _elo_written.
+    execute_query(cursor, 'UPDATE elo_marker SET version = version + 1 WHERE id = 1')
+    after = _elo_version(cursor)
+    return after - 1, after
+
+def _elo_written(versions):
+    # After commit and update_leaderboard: a tree that was current at `before`
+    # now holds the same change, so it is current at `after` and needs no rebuild
+    global _leaderboard_version
+    if _leaderboard_version is not None and _leaderboard_version == versions[0]:
+        _leaderboard_version = versions[1]
+
+def rebuild_leaderboard():
+    global _leaderboard_built_at, _leaderboard_checked_at, _leaderboard_version
+    _leaderboard.begin_rebuild()
+    with db_cursor() as cursor:
+        # Marker first: a write that lands after it shows up at the next check
+        version = _elo_version(cursor)
+        execute_query(cursor, 'SELECT user_id, elo FROM users')
+        rows = [(row[0], row[1]) for row in cursor.fetchall()]
+    _leaderboard.rebuild(rows)
+    _leaderboard_version = version
+    _leaderboard_built_at = _leaderboard_checked_at = time.monotonic()
+    return len(rows)
+
+def get_leaderboard():
+    global _leaderboard_checked_at
+    now = time.monotonic()
+    if _leaderboard_built_at is None or now - _leaderboard_built_at > LEADERBOARD_REFRESH:
+        rebuild_leaderboard()
+    elif now - _leaderboard_checked_at >= LEADERBOARD_CHECK:
+        _leaderboard_checked_at = now
+        with db_cursor() as cursor:
+            changed = _elo_version(cursor) != _leaderboard_version
+        if changed:
+            rebuild_leaderboard()
+    return _leaderboard
+
+def update_leaderboard(user_id, elo):
+    # Not built yet: the first get_leaderboard() reads the committed value anyway
+    if _leaderboard_built_at is not None:
+        _leaderboard.update(user_id, elo)
+
+def set_user_elo(user_id, elo):
+    # Admin override of a player's ELO
+    with db_cursor() as cursor:
+        execute_query(cursor, 'UPDATE users SET elo = ? WHERE user_id = ?', (elo, user_id))
+        versions = _stamp_elo_version(cursor)
+    invalidate_user(user_id)
+    update_leaderboard(user_id, elo)
+    _elo_written(versions)
+
+def _ranked_players(entries):
+    # [(rank, user_id, elo)] -> [(rank, user_id, nickname, elo, level, is_vip)]
+    users = get_users([user_id for _, user_id, _ in entries])
+    return [(rank, user_id, users[user_id][2], users[user_id][3], users[user_id][4], users[user_id][10])
+            for rank, user_id, _ in entries if user_id in users]
+
+def get_top_players(limit=10, offset=0):
+    return [row[2:] for row in _ranked_players(get_leaderboard().top(limit, offset))]
+
+def get_top_player_ids(limit=10, offset=0):
+    return [user_id for _, user_id, _ in get_leaderboard().top(limit, offset)]
+
+def get_player_rank(user_id):
+    # (rank, total players) or None
+    board = get_leaderboard()
+    rank = board.rank(user_id)
+    return (rank, len(board)) if rank is not None else None
+
+def get_players_around(user_id, radius=2):
+    return _ranked_players(get_leaderboard().around(user_id, radius))
+
+def get_rated_history():
+    # [(mode, winners, losers), ...] of settled matches in play order, for rating.replay
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT m.id, m.mode, mp.user_id, mp.is_win
+            FROM matches m JOIN match_players mp ON mp.match_id = m.id
+            WHERE m.status = 'finished' AND mp.is_win IS NOT NULL
+            ORDER BY m.id
+        ''')
+        rows = cursor.fetchall()
+    history = []
+    current = None
+    for match_id, mode, user_id, is_win in rows:
+        if current is None or current[0] != match_id:
+            current = (match_id, mode, [], [])
+            history.append(current)
+        (current[2] if is_win else current[3]).append(user_id)
+    return [(mode, winners, losers) for _, mode, winners, losers in history if winners and losers]
+
+def recompute_ratings(apply=False):
+    # Replays every settled match from rating.BASE_RATING; players without rated
+    # matches end up there too. Returns [(user_id, old_elo, new_elo)] for the
+    # players whose ELO differs; apply=True writes the new values.
+    ratings = rating.replay(get_rated_history())
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT user_id, elo FROM users')
+        changes = [(user_id, elo, ratings.get(user_id, rating.BASE_RATING)) for user_id, elo in cursor.fetchall()]
+        changes = [change for change in changes if change[1] != change[2]]
+        if apply and changes:
+            execute_many(cursor, 'UPDATE users SET elo = ? WHERE user_id = ?', [(new_elo, user_id) for user_id, _, new_elo in changes])
+            execute_query(cursor, f'UPDATE users SET level = {LEVEL_CASE_SQL}')
+            _stamp_elo_version(cursor)
+    if apply and changes:
+        clear_user_cache()
+        if _leaderboard_built_at is not None:
+            rebuild_leaderboard()
+    return changes
 
 def update_elo(user_id, elo_change, is_win):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        UPDATE users 
-        SET elo = elo + ?, 
-            matches = matches + 1,
-            wins = wins + ?
-        WHERE user_id = ?
-    ''', (elo_change, 1 if is_win else 0, user_id))
-    
-    execute_query(cursor, 'SELECT elo FROM users WHERE user_id = ?', (user_id,))
-    res = cursor.fetchone()
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE users 
+            SET elo = elo + ?, 
+                matches = matches + 1,
+                wins = wins + ?
+            WHERE user_id = ?
+        ''', (elo_change, 1 if is_win else 0, user_id))
+
+        execute_query(cursor, 'SELECT elo FROM users WHERE user_id = ?', (user_id,))
+        res = cursor.fetchone()
+        if res:
+            new_elo = res[0]
+            new_level = get_level_by_elo(new_elo)
+            execute_query(cursor, 'UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
+            versions = _stamp_elo_version(cursor)
+    invalidate_user(user_id)
     if res:
-        new_elo = res[0]
-        new_level = get_level_by_elo(new_elo)
-        execute_query(cursor, 'UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
-    
-    conn.commit()
-    conn.close()
+        update_leaderboard(user_id, new_elo)
+        _elo_written(versions)
 
 def manual_update_elo(user_id, elo_change):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        UPDATE users 
-        SET elo = elo + ?
-        WHERE user_id = ?
-    ''', (elo_change, user_id))
-    
-    execute_query(cursor, 'SELECT elo FROM users WHERE user_id = ?', (user_id,))
-    res = cursor.fetchone()
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE users 
+            SET elo = elo + ?
+            WHERE user_id = ?
+        ''', (elo_change, user_id))
+
+        execute_query(cursor, 'SELECT elo FROM users WHERE user_id = ?', (user_id,))
+        res = cursor.fetchone()
+        if res:
+            new_elo = res[0]
+            new_level = get_level_by_elo(new_elo)
+            execute_query(cursor, 'UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
+            versions = _stamp_elo_version(cursor)
+    invalidate_user(user_id)
     if res:
-        new_elo = res[0]
-        new_level = get_level_by_elo(new_elo)
-        execute_query(cursor, 'UPDATE users SET level = ? WHERE user_id = ?', (new_level, user_id))
-    
-    conn.commit()
-    conn.close()
+        update_leaderboard(user_id, new_elo)
+        _elo_written(versions)
 
 def adjust_user_stats(user_id, matches_change, wins_change):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        UPDATE users 
-        SET matches = matches + ?,
-            wins = wins + ?
-        WHERE user_id = ?
-    ''', (matches_change, wins_change, user_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE users 
+            SET matches = matches + ?,
+                wins = wins + ?
+            WHERE user_id = ?
+        ''', (matches_change, wins_change, user_id))
+    invalidate_user(user_id)
 
 def create_support_ticket(user_id, text):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    if IS_POSTGRES:
-        execute_query(cursor, 'INSERT INTO support_tickets (user_id, text) VALUES (?, ?) RETURNING id', (user_id, text))
-        ticket_id = cursor.fetchone()[0]
-    else:
-        execute_query(cursor, 'INSERT INTO support_tickets (user_id, text) VALUES (?, ?)', (user_id, text))
-        ticket_id = cursor.lastrowid
-        
-    conn.commit()
-    conn.close()
-    return ticket_id
+    with db_cursor() as cursor:
+        if IS_POSTGRES:
+            execute_query(cursor, 'INSERT INTO support_tickets (user_id, text) VALUES (?, ?) RETURNING id', (user_id, text))
+            ticket_id = cursor.fetchone()[0]
+        else:
+            execute_query(cursor, 'INSERT INTO support_tickets (user_id, text) VALUES (?, ?)', (user_id, text))
+            ticket_id = cursor.lastrowid
+
+        return ticket_id
 
 def get_support_ticket(ticket_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT user_id, text, admin_id, status FROM support_tickets WHERE id = ?', (ticket_id,))
-    ticket = cursor.fetchone()
-    conn.close()
-    return ticket
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT user_id, text, admin_id, status FROM support_tickets WHERE id = ?', (ticket_id,))
+        ticket = cursor.fetchone()
+        return ticket
 
 def get_all_tickets():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT id, user_id, text, status FROM support_tickets WHERE status = "open"')
-    tickets = cursor.fetchall()
-    conn.close()
-    return tickets
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT id, user_id, text, status FROM support_tickets WHERE status = "open"')
+        tickets = cursor.fetchall()
+        return tickets
 
 def add_lobby_member(mode, lobby_id, user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    if IS_POSTGRES:
-        execute_query(cursor, '''
-            INSERT INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)
-            ON CONFLICT (mode, lobby_id, user_id) DO NOTHING
-        ''', (mode, lobby_id, user_id))
-    else:
-        execute_query(cursor, 'INSERT OR REPLACE INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)', (mode, lobby_id, user_id))
-        
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        if IS_POSTGRES:
+            execute_query(cursor, '''
+                INSERT INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)
+                ON CONFLICT (mode, lobby_id, user_id) DO NOTHING
+            ''', (mode, lobby_id, user_id))
+        else:
+            execute_query(cursor, 'INSERT OR REPLACE INTO lobby_members (mode, lobby_id, user_id) VALUES (?, ?, ?)', (mode, lobby_id, user_id))
 
 def remove_lobby_member(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'DELETE FROM lobby_members WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'DELETE FROM lobby_members WHERE user_id = ?', (user_id,))
 
 def get_all_lobby_members():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT mode, lobby_id, user_id FROM lobby_members')
-    members = cursor.fetchall()
-    conn.close()
-    return members
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT mode, lobby_id, user_id FROM lobby_members')
+        members = cursor.fetchall()
+        return members
 
 def update_support_ticket(ticket_id, admin_id=None, status=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if admin_id is not None:
-        execute_query(cursor, 'UPDATE support_tickets SET admin_id = ? WHERE id = ?', (admin_id, ticket_id))
-    if status is not None:
-        execute_query(cursor, 'UPDATE support_tickets SET status = ? WHERE id = ?', (status, ticket_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        if admin_id is not None:
+            execute_query(cursor, 'UPDATE support_tickets SET admin_id = ? WHERE id = ?', (admin_id, ticket_id))
+        if status is not None:
+            execute_query(cursor, 'UPDATE support_tickets SET status = ? WHERE id = ?', (status, ticket_id))
 
 def close_ticket(ticket_id, admin_id):
     update_support_ticket(ticket_id, admin_id=admin_id, status='closed')
 
 def update_user_profile(user_id, nickname=None, game_id=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if nickname:
-        execute_query(cursor, 'UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
-    if game_id:
-        execute_query(cursor, 'UPDATE users SET game_id = ? WHERE user_id = ?', (game_id, user_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        if nickname:
+            execute_query(cursor, 'UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
+        if game_id:
+            execute_query(cursor, 'UPDATE users SET game_id = ? WHERE user_id = ?', (game_id, user_id))
+    invalidate_user(user_id)
 
 def get_user_by_nickname(nickname):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT * FROM users WHERE nickname = ?', (nickname,))
-    user = cursor.fetchone()
-    conn.close()
+    user = _nickname_cache.get(nickname)
+    if user is not None:
+        return user
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT * FROM users WHERE nickname = ?', (nickname,))
+        user = cursor.fetchone()
+    if user is not None:
+        _nickname_cache.set(nickname, user)
     return user
 
 def add_friend(user_id, friend_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Check if already friends or pending
-        execute_query(cursor, 'SELECT status FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)', 
-                      (user_id, friend_id, friend_id, user_id))
-        existing = cursor.fetchone()
-        if existing:
-            return False # Already sent/friends
-            
-        execute_query(cursor, 'INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, ?)', (user_id, friend_id, 'pending'))
-        conn.commit()
-        return True
+        with db_cursor() as cursor:
+            # Check if already friends or pending
+            execute_query(cursor, 'SELECT status FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)', 
+                          (user_id, friend_id, friend_id, user_id))
+            existing = cursor.fetchone()
+            if existing:
+                return False # Already sent/friends
+                
+            execute_query(cursor, 'INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, ?)', (user_id, friend_id, 'pending'))
+            return True
     except Exception as e:
         print(f"Error adding friend: {e}")
         return False
-    finally:
-        conn.close()
 
 def accept_friend(user_id, friend_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # user_id is the one accepting (so friend_id sent the request)
-    execute_query(cursor, 'UPDATE friends SET status = "accepted" WHERE user_id = ? AND friend_id = ?', (friend_id, user_id))
-    if cursor.rowcount == 0:
-        execute_query(cursor, 'UPDATE friends SET status = "accepted" WHERE user_id = ? AND friend_id = ?', (user_id, friend_id))
-        
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        # user_id is the one accepting (so friend_id sent the request)
+        execute_query(cursor, 'UPDATE friends SET status = "accepted" WHERE user_id = ? AND friend_id = ?', (friend_id, user_id))
+        if cursor.rowcount == 0:
+            execute_query(cursor, 'UPDATE friends SET status = "accepted" WHERE user_id = ? AND friend_id = ?', (user_id, friend_id))
 
 def remove_friend(user_id, friend_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)', 
-                   (user_id, friend_id, friend_id, user_id))
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)', 
+                       (user_id, friend_id, friend_id, user_id))
 
 def get_friends(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT u.user_id, u.nickname, u.avatar_url, u.elo, u.is_vip
-        FROM users u
-        JOIN friends f ON (f.friend_id = u.user_id AND f.user_id = ?) 
-                       OR (f.user_id = u.user_id AND f.friend_id = ?)
-        WHERE f.status = "accepted"
-    ''', (user_id, user_id))
-    friends = cursor.fetchall()
-    conn.close()
-    return friends
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT u.user_id, u.nickname, u.avatar_url, u.elo, u.is_vip
+            FROM users u
+            JOIN friends f ON (f.friend_id = u.user_id AND f.user_id = ?) 
+                           OR (f.user_id = u.user_id AND f.friend_id = ?)
+            WHERE f.status = "accepted"
+        ''', (user_id, user_id))
+        friends = cursor.fetchall()
+        return friends
 
 def get_friend_requests(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT u.user_id, u.nickname, u.avatar_url
-        FROM users u
-        JOIN friends f ON f.user_id = u.user_id
-        WHERE f.friend_id = ? AND f.status = "pending"
-    ''', (user_id,))
-    requests = cursor.fetchall()
-    conn.close()
-    return requests
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT u.user_id, u.nickname, u.avatar_url
+            FROM users u
+            JOIN friends f ON f.user_id = u.user_id
+            WHERE f.friend_id = ? AND f.status = "pending"
+        ''', (user_id,))
+        requests = cursor.fetchall()
+        return requests
 
 def get_friend_status(user_id, other_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT user_id, status FROM friends 
-        WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
-    ''', (user_id, other_id, other_id, user_id))
-    res = cursor.fetchone()
-    conn.close()
-    if not res: return None
-    return res
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT user_id, status FROM friends 
+            WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
+        ''', (user_id, other_id, other_id, user_id))
+        res = cursor.fetchone()
+        if not res: return None
+        return res
 
 def set_vip_status(user_id, status, until=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if status and until:
-        execute_query(cursor, 'SELECT is_vip, vip_until FROM users WHERE user_id = ?', (user_id,))
-        res = cursor.fetchone()
-        if res and res[0] and res[1]:
-            try:
-                # Handle both datetime object and string (postgres returns datetime)
-                current_until = res[1]
-                if isinstance(current_until, str):
-                    current_until = datetime.strptime(current_until, "%Y-%m-%d %H:%M:%S")
-                
-                if current_until > datetime.now():
-                    new_until_dt = datetime.strptime(until, "%Y-%m-%d %H:%M:%S")
-                    days_to_add = (new_until_dt - datetime.now()).days
-                    if days_to_add < 0: days_to_add = 30
+    extended = False
+    with db_cursor() as cursor:
+        if status and until:
+            execute_query(cursor, 'SELECT is_vip, vip_until FROM users WHERE user_id = ?', (user_id,))
+            res = cursor.fetchone()
+            if res and res[0] and res[1]:
+                try:
+                    # Handle both datetime object and string (postgres returns datetime)
+                    current_until = res[1]
+                    if isinstance(current_until, str):
+                        current_until = datetime.strptime(current_until, "%Y-%m-%d %H:%M:%S")
                     
-                    final_until = (current_until + timedelta(days=days_to_add)).strftime("%Y-%m-%d %H:%M:%S")
-                    execute_query(cursor, 'UPDATE users SET is_vip = 1, vip_until = ? WHERE user_id = ?', (final_until, user_id))
-                    conn.commit()
-                    conn.close()
-                    return
-            except: pass
-            
-    execute_query(cursor, 'UPDATE users SET is_vip = ?, vip_until = ? WHERE user_id = ?', (1 if status else 0, until, user_id))
-    conn.commit()
-    conn.close()
+                    if current_until > datetime.now():
+                        new_until_dt = datetime.strptime(until, "%Y-%m-%d %H:%M:%S")
+                        days_to_add = (new_until_dt - datetime.now()).days
+                        if days_to_add < 0: days_to_add = 30
+                        
+                        final_until = (current_until + timedelta(days=days_to_add)).strftime("%Y-%m-%d %H:%M:%S")
+                        execute_query(cursor, 'UPDATE users SET is_vip = 1, vip_until = ? WHERE user_id = ?', (final_until, user_id))
+                        extended = True
+                except: pass
+                
+        if not extended:
+            execute_query(cursor, 'UPDATE users SET is_vip = ?, vip_until = ? WHERE user_id = ?', (1 if status else 0, until, user_id))
+    invalidate_user(user_id)
 
 def is_user_vip(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT is_vip, vip_until FROM users WHERE user_id = ?', (user_id,))
-    res = cursor.fetchone()
-    conn.close()
-    if not res: return False
+    # Served from the user cache; set_vip_status invalidates it
+    user = get_user(user_id)
+    if not user: return False
     
-    is_vip, until = res
+    is_vip, until = user[10], user[11]
     if not is_vip: return False
     
     if until:
@@ -901,54 +1159,114 @@ def is_user_vip(user_id):
     return True
 
 def update_clan_stats(clan_id, is_win, elo_change):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        UPDATE clans 
-        SET matches_played = matches_played + 1,
-            matches_won = matches_won + ?,
-            exp = exp + ?,
-            clan_elo = clan_elo + ?
-        WHERE id = ?
-    ''', (1 if is_win else 0, 50 if is_win else 10, elo_change, clan_id))
-    
-    execute_query(cursor, 'SELECT exp, level FROM clans WHERE id = ?', (clan_id,))
-    res = cursor.fetchone()
-    if res:
-        exp, level = res
-        new_level = (exp // 500) + 1
-        if new_level > level:
-            execute_query(cursor, 'UPDATE clans SET level = ? WHERE id = ?', (new_level, clan_id))
-        
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE clans 
+            SET matches_played = matches_played + 1,
+                matches_won = matches_won + ?,
+                exp = exp + ?,
+                clan_elo = clan_elo + ?
+            WHERE id = ?
+        ''', (1 if is_win else 0, 50 if is_win else 10, elo_change, clan_id))
+
+        execute_query(cursor, 'SELECT exp, level FROM clans WHERE id = ?', (clan_id,))
+        res = cursor.fetchone()
+        if res:
+            exp, level = res
+            new_level = (exp // 500) + 1
+            if new_level > level:
+                execute_query(cursor, 'UPDATE clans SET level = ? WHERE id = ?', (new_level, clan_id))
 
 def get_top_clans(limit=10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, '''
-        SELECT tag, name, clan_elo, matches_won, matches_played, level 
-        FROM clans 
-        ORDER BY clan_elo DESC, matches_won DESC 
-        LIMIT ?
-    ''', (limit,))
-    clans = cursor.fetchall()
-    conn.close()
-    return clans
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            SELECT tag, name, clan_elo, matches_won, matches_played, level 
+            FROM clans 
+            ORDER BY clan_elo DESC, matches_won DESC 
+            LIMIT ?
+        ''', (limit,))
+        clans = cursor.fetchall()
+        return clans
 
 def remove_clan_member(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'DELETE FROM clan_members WHERE user_id = ?', (user_id,))
-    success = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    with db_cursor() as cursor:
+        execute_query(cursor, 'DELETE FROM clan_members WHERE user_id = ?', (user_id,))
+        success = cursor.rowcount > 0
+    _clan_membership_cache.pop(user_id)
     return success
 
 def get_user_by_game_id(game_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    execute_query(cursor, 'SELECT user_id FROM users WHERE game_id = ?', (game_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user_id = _game_id_cache.get(game_id)
+    if user_id is not None:
+        return user_id
+    with db_cursor() as cursor:
+        execute_query(cursor, 'SELECT user_id FROM users WHERE game_id = ?', (game_id,))
+        user = cursor.fetchone()
+    if user:
+        _game_id_cache.set(game_id, user[0])
     return user[0] if user else None
+
+def settle_match(match_id, results, clan_results=None, winner_team=None):
+    # results: [(user_id, elo_change, is_win), ...]
+    # clan_results: [(clan_id, elo_change, is_win), ...]
+    # Everything is applied in one transaction. Returns {user_id: (elo, level)},
+    # or None if the match was already finished/cancelled (e.g. a double confirm).
+    results = list(results)
+    clan_results = list(clan_results or [])
+    with db_cursor() as cursor:
+        execute_query(cursor, '''
+            UPDATE matches SET status = 'finished', winner_team = COALESCE(?, winner_team), version = version + 1
+            WHERE id = ? AND status NOT IN ('finished', 'cancelled')
+        ''', (winner_team, match_id))
+        if cursor.rowcount == 0:
+            return None
+
+        settled = {}
+        versions = None
+        if results:
+            execute_many(cursor, '''
+                UPDATE users 
+                SET elo = elo + ?, 
+                    matches = matches + 1,
+                    wins = wins + ?
+                WHERE user_id = ?
+            ''', [(elo_change, 1 if is_win else 0, user_id) for user_id, elo_change, is_win in results])
+            execute_many(cursor, '''
+                UPDATE match_players SET is_win = ?, elo_change = ?
+                WHERE match_id = ? AND user_id = ?
+            ''', [(1 if is_win else 0, elo_change, match_id, user_id) for user_id, elo_change, is_win in results])
+
+            user_ids = [user_id for user_id, _, _ in results]
+            placeholders = ', '.join(['?'] * len(user_ids))
+            level_sql = f'UPDATE users SET level = {LEVEL_CASE_SQL} WHERE user_id IN ({placeholders})'
+            if SUPPORTS_RETURNING:
+                execute_query(cursor, level_sql + ' RETURNING user_id, elo, level', user_ids)
+            else:
+                execute_query(cursor, level_sql, user_ids)
+                execute_query(cursor, f'SELECT user_id, elo, level FROM users WHERE user_id IN ({placeholders})', user_ids)
+            for user_id, elo, level in cursor.fetchall():
+                settled[user_id] = (elo, level)
+            versions = _stamp_elo_version(cursor)
+
+        if clan_results:
+            execute_many(cursor, '''
+                UPDATE clans 
+                SET matches_played = matches_played + 1,
+                    matches_won = matches_won + ?,
+                    exp = exp + ?,
+                    clan_elo = clan_elo + ?
+                WHERE id = ?
+            ''', [(1 if is_win else 0, 50 if is_win else 10, elo_change, clan_id) for clan_id, elo_change, is_win in clan_results])
+            clan_ids = [clan_id for clan_id, _, _ in clan_results]
+            placeholders = ', '.join(['?'] * len(clan_ids))
+            execute_query(cursor, f'''
+                UPDATE clans SET level = exp / 500 + 1
+                WHERE id IN ({placeholders}) AND exp / 500 + 1 > level
+            ''', clan_ids)
+
+    for user_id, (elo, _) in settled.items():
+        invalidate_user(user_id)
+        update_leaderboard(user_id, elo)
+    if versions:
+        _elo_written(versions)
+    return settled
@@ -0,0 +1,39 @@
+import asyncio
+import functools
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# Async mirror of db.py for the bot: every public helper runs on a small
+# thread pool, so a slow query no longer blocks the event loop.
+# Usage: `user = await db_async.get_user(user_id)`
+
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', db.DB_POOL_SIZE))
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+# Pure / connection-level functions that make no sense to run in the executor
+_SKIP = {'get_level_by_elo', 'execute_query', 'touch_match', 'log_veto_action', 'get_db_connection', 'db_connection', 'db_cursor', 'get_pool', 'get_pool_stats'}
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+for _name, _func in inspect.getmembers(db, inspect.isfunction):
+    if _name.startswith('_') or _name in _SKIP or _func.__module__ != db.__name__:
+        continue
+    globals()[_name] = _wrap(_func)
+
+get_level_by_elo = db.get_level_by_elo
+get_pool_stats = db.get_pool_stats
+
+def shutdown():
+    _executor.shutdown(wait=True)
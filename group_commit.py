@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+# Group commit for small, bursty writes (match chat). The first writer to
+# arrive becomes the leader: it lingers for GROUP_COMMIT_LINGER seconds so a
+# burst can pile up, then writes everything queued in one transaction per
+# batch. Every writer returns once its item is committed, or raises the error
+# its batch failed with.
+
+GROUP_COMMIT_LINGER = float(os.environ.get('GROUP_COMMIT_LINGER', 0.005))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 200))
+
+class _Entry:
+    __slots__ = ('item', 'done', 'error')
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.error = None
+
+class GroupCommit:
+    def __init__(self, flush, linger=GROUP_COMMIT_LINGER, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.flush = flush # flush([item, ...]) writes a batch in one transaction
+        self.linger = linger
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leader = False
+        self.items = 0
+        self.batches = 0
+
+    def submit(self, item):
+        entry = _Entry(item)
+        with self._lock:
+            self._pending.append(entry)
+            lead = not self._leader
+            self._leader = True
+        if lead:
+            if self.linger:
+                time.sleep(self.linger)
+            self._drain()
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:len(batch)]
+                if not batch:
+                    self._leader = False
+                    return
+            error = None
+            try:
+                self.flush([entry.item for entry in batch])
+            except Exception as e:
+                error = e
+            with self._lock:
+                self.items += len(batch)
+                self.batches += 1
+            for entry in batch:
+                entry.error = error
+                entry.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'items': self.items, 'batches': self.batches, 'pending': len(self._pending)}
@@ -0,0 +1,7 @@
+# Loaded by gunicorn from the working directory (Procfile, start.sh)
+
+def post_worker_init(worker):
+    # Background jobs of the web app run in every worker; their writes are
+    # conditional, so several workers sweeping at once is harmless
+    from web.app import veto_sweeper
+    veto_sweeper.start()
@@ -0,0 +1,142 @@
+import bisect
+import threading
+
+# ELO range covered by the Fenwick tree, one bucket per point. Ratings outside
+# the range share the edge buckets but are still ordered correctly inside them.
+ELO_MIN = 0
+ELO_MAX = 5000
+
+class FenwickTree:
+    def __init__(self, size):
+        self.size = size
+        self._tree = [0] * (size + 1)
+        self._top_bit = 1 << (size.bit_length() - 1) if size else 0
+
+    def add(self, index, delta):
+        while index <= self.size:
+            self._tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def find_kth(self, k):
+        # Smallest index whose prefix sum is >= k
+        index = 0
+        bit = self._top_bit
+        while bit:
+            nxt = index + bit
+            if nxt <= self.size and self._tree[nxt] < k:
+                index = nxt
+                k -= self._tree[nxt]
+            bit >>= 1
+        return index + 1
+
+class Leaderboard:
+    # Order-statistics index over player ELO: rank, top-N and "around me" in
+    # O(log n) without touching the database. Ties are broken by user_id.
+    def __init__(self, elo_min=ELO_MIN, elo_max=ELO_MAX):
+        self.elo_min = elo_min
+        self.elo_max = elo_max
+        self._lock = threading.Lock()
+        self._reset()
+        self._pending = None
+
+    def _reset(self):
+        self._tree = FenwickTree(self.elo_max - self.elo_min + 1)
+        self._buckets = {} # tree index -> sorted [(-elo, user_id)]
+        self._elo = {}     # user_id -> elo
+
+    def _index(self, elo):
+        # Index 1 holds the highest ELO, so prefix sums count players above
+        elo = min(max(elo, self.elo_min), self.elo_max)
+        return self.elo_max - elo + 1
+
+    def _insert(self, user_id, elo):
+        index = self._index(elo)
+        bisect.insort(self._buckets.setdefault(index, []), (-elo, user_id))
+        self._tree.add(index, 1)
+        self._elo[user_id] = elo
+
+    def _delete(self, user_id):
+        elo = self._elo.pop(user_id, None)
+        if elo is None:
+            return
+        index = self._index(elo)
+        bucket = self._buckets[index]
+        del bucket[bisect.bisect_left(bucket, (-elo, user_id))]
+        if not bucket:
+            del self._buckets[index]
+        self._tree.add(index, -1)
+
+    def begin_rebuild(self):
+        # Updates that arrive while the snapshot is being read are replayed on top of it
+        with self._lock:
+            self._pending = {}
+
+    def rebuild(self, rows):
+        with self._lock:
+            self._reset()
+            for user_id, elo in rows:
+                self._insert(user_id, int(elo))
+            for user_id, elo in (self._pending or {}).items():
+                self._delete(user_id)
+                if elo is not None:
+                    self._insert(user_id, elo)
+            self._pending = None
+
+    def update(self, user_id, elo):
+        elo = int(elo)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[user_id] = elo
+            if self._elo.get(user_id) == elo:
+                return
+            self._delete(user_id)
+            self._insert(user_id, elo)
+
+    def remove(self, user_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[user_id] = None
+            self._delete(user_id)
+
+    def rank(self, user_id):
+        with self._lock:
+            elo = self._elo.get(user_id)
+            if elo is None:
+                return None
+            index = self._index(elo)
+            return self._tree.prefix(index - 1) + bisect.bisect_left(self._buckets[index], (-elo, user_id)) + 1
+
+    def top(self, limit, offset=0):
+        # [(rank, user_id, elo), ...] starting at rank offset + 1
+        result = []
+        with self._lock:
+            rank = offset + 1
+            total = len(self._elo)
+            while len(result) < limit and rank <= total:
+                index = self._tree.find_kth(rank)
+                before = self._tree.prefix(index - 1)
+                for neg_elo, user_id in self._buckets[index][rank - before - 1:]:
+                    result.append((rank, user_id, -neg_elo))
+                    rank += 1
+                    if len(result) == limit:
+                        break
+        return result
+
+    def around(self, user_id, radius=2):
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        return self.top(2 * radius + 1, max(0, rank - radius - 1))
+
+    def __len__(self):
+        return len(self._elo)
+
+    def __contains__(self, user_id):
+        return user_id in self._elo
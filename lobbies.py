@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import logging
+from types import MappingProxyType
+
+LOBBY_MODES = ("1x1", "2x2", "5x5", "2x2_clan")
+LOBBY_COUNT = 10
+
+class LobbyRegistry:
+    # Seats players in lobbies: {mode: {lobby_id: {user_id: data}}}. Keeps a
+    # user_id -> (mode, lobby_id) index and the set of empty lobbies per mode in
+    # sync with the nested dicts. Lobbies are only exposed as read-only views, so
+    # every change has to go through add/remove/clear.
+    def __init__(self, modes=LOBBY_MODES, count=LOBBY_COUNT):
+        self._lobbies = {mode: {lid: {} for lid in range(1, count + 1)} for mode in modes}
+        self._seats = {}    # user_id -> (mode, lobby_id)
+        self._free = {mode: set(range(1, count + 1)) for mode in modes}
+        self._free_heap = {mode: list(range(1, count + 1)) for mode in modes} # lazy min-heap over _free
+        self._versions = {}  # (mode, lobby_id) -> changes so far
+        self._mode_versions = dict.fromkeys(modes, 0)
+
+    def lobby_ids(self, mode):
+        return self._lobbies[mode].keys()
+
+    def players(self, mode, lobby_id):
+        return MappingProxyType(self._lobbies[mode][lobby_id])
+
+    def count(self, mode, lobby_id):
+        return len(self._lobbies[mode][lobby_id])
+
+    def version(self, mode, lobby_id):
+        # Bumped on every change, so renders can be cached per (mode, lobby_id, version)
+        return self._versions.get((mode, lobby_id), 0)
+
+    def mode_version(self, mode):
+        return self._mode_versions[mode]
+
+    def locate(self, user_id):
+        # (mode, lobby_id) the user is seated in, or None
+        return self._seats.get(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._seats
+
+    def first_free(self, mode):
+        # Lowest empty lobby id of the mode, or None
+        heap = self._free_heap[mode]
+        while heap and heap[0] not in self._free[mode]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _changed(self, mode, lobby_id):
+        key = (mode, lobby_id)
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._mode_versions[mode] += 1
+        if self._lobbies[mode][lobby_id]:
+            self._free[mode].discard(lobby_id)
+        elif lobby_id not in self._free[mode]:
+            self._free[mode].add(lobby_id)
+            heapq.heappush(self._free_heap[mode], lobby_id)
+
+    def add(self, mode, lobby_id, user_id, data):
+        seat = self._seats.get(user_id)
+        if seat is not None and seat != (mode, lobby_id):
+            raise ValueError(f"user {user_id} is already in lobby {seat}")
+        self._lobbies[mode][lobby_id][user_id] = data
+        self._seats[user_id] = (mode, lobby_id)
+        self._changed(mode, lobby_id)
+
+    def update_player(self, user_id, **fields):
+        seat = self._seats.get(user_id)
+        if seat is None:
+            return None
+        self._lobbies[seat[0]][seat[1]][user_id].update(fields)
+        self._changed(*seat)
+        return seat
+
+    def remove(self, user_id):
+        # Returns (mode, lobby_id, data), or None if the user is not seated
+        seat = self._seats.pop(user_id, None)
+        if seat is None:
+            return None
+        mode, lobby_id = seat
+        data = self._lobbies[mode][lobby_id].pop(user_id)
+        self._changed(mode, lobby_id)
+        return mode, lobby_id, data
+
+    def clear(self, mode, lobby_id):
+        # Empties the lobby and returns its [(user_id, data), ...]
+        players = list(self._lobbies[mode][lobby_id].items())
+        if players:
+            for user_id, _ in players:
+                del self._seats[user_id]
+            self._lobbies[mode][lobby_id].clear()
+            self._changed(mode, lobby_id)
+        return players
+
+class ViewerIndex:
+    # Who is looking at which lobby screen: user_id -> viewer dict
+    # ({"mode", "lobby_id", "message_id", "chat_id"}), indexed by (mode, lobby_id).
+    # lobby_id None is the lobby list of a mode, (None, None) the mode selection.
+    def __init__(self):
+        self._viewers = {}
+        self._by_screen = {} # (mode, lobby_id) -> {user_id}
+
+    def set(self, user_id, mode, lobby_id, message_id, chat_id):
+        self.remove(user_id)
+        self._viewers[user_id] = {"mode": mode, "lobby_id": lobby_id, "message_id": message_id, "chat_id": chat_id}
+        self._by_screen.setdefault((mode, lobby_id), set()).add(user_id)
+
+    def get(self, user_id):
+        return self._viewers.get(user_id)
+
+    def remove(self, user_id):
+        viewer = self._viewers.pop(user_id, None)
+        if viewer is not None:
+            screen = (viewer["mode"], viewer["lobby_id"])
+            self._by_screen[screen].discard(user_id)
+            if not self._by_screen[screen]:
+                del self._by_screen[screen]
+        return viewer
+
+    def watching(self, mode, lobby_id):
+        # [(user_id, viewer), ...] for one screen
+        return [(uid, self._viewers[uid]) for uid in self._by_screen.get((mode, lobby_id), ())]
+
+    def __contains__(self, user_id):
+        return user_id in self._viewers
+
+    def __len__(self):
+        return len(self._viewers)
+
+class Debouncer:
+    # Coalesces schedule(key) calls made within `delay` seconds into a single
+    # `await callback(*key)`. A call that arrives while the callback is running
+    # schedules one more run, so the last state is always rendered.
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self._pending = set()
+        self._tasks = set() # the loop only keeps weak references to tasks
+        self.scheduled = 0
+        self.runs = 0
+
+    def schedule(self, key):
+        self.scheduled += 1
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        task = asyncio.create_task(self._run(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key):
+        await asyncio.sleep(self.delay)
+        self._pending.discard(key)
+        self.runs += 1
+        try:
+            await self.callback(*key)
+        except Exception:
+            logging.exception(f"Debounced update {key} failed")
@@ -15,6 +15,17 @@ from aiogram import BaseMiddleware
 from typing import Callable, Dict, Any, Awaitable
 
 import db
+import db_async
+import outbox
+import rating
+import team_balance
+from lobbies import Debouncer, LobbyRegistry, ViewerIndex
+from match_actor import MatchActors
+from matchmaking import WAIT_BINS, Matchmaker
+from state_store import StateStore
+from subscriptions import SubscriptionCache
+from timers import TimerService
+from veto import Veto, pool_for_mode
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -33,6 +44,19 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
 
+# Все отправки и правки сообщений идут через планировщик (лимиты Telegram, приоритеты, RetryAfter)
+outbox_middleware = outbox.OutboxMiddleware()
+bot.session.middleware(outbox_middleware)
+
+async def notify_players(user_ids, text, priority=outbox.NORMAL, **kwargs):
+    # Рассылка всем сразу: очередность и лимиты держит outbox. Возвращает {uid: message} для доставленных
+    async def send(uid):
+        with outbox.priority(priority):
+            return await bot.send_message(uid, text, **kwargs)
+    user_ids = list(user_ids)
+    results = await asyncio.gather(*(send(uid) for uid in user_ids), return_exceptions=True)
+    return {uid: msg for uid, msg in zip(user_ids, results) if not isinstance(msg, Exception)}
+
 class SubscriptionMiddleware(BaseMiddleware):
     async def __call__(
         self,
@@ -105,18 +129,35 @@ dp.callback_query.middleware(SubscriptionMiddleware())
 dp.message.middleware(MenuMiddleware())
 
 # Глобальное состояние лобби и зрителей
-# Структура: {"1x1": {1: {}, ...}, "2x2": {1: {}, ...}, "5x5": {1: {}, ...}}
-lobby_players = {
-    "1x1": {i: {} for i in range(1, 11)},
-    "2x2": {i: {} for i in range(1, 11)},
-    "5x5": {i: {} for i in range(1, 11)},
-    "2x2_clan": {i: {} for i in range(1, 11)}
-}
-# Зрители: {user_id: {"mode": mode, "lobby_id": lid, "message_id": mid, "chat_id": cid}}
-lobby_viewers = {} 
+# Игроки в лобби: {"1x1": {1: {user_id: data}, ...}, ...} + индекс user_id -> (mode, lobby_id).
+# Менять только через методы реестра (add/remove/clear), чтобы индекс не разъезжался
+lobby_registry = LobbyRegistry()
+# Зрители: user_id -> {"mode": mode, "lobby_id": lid, "message_id": mid, "chat_id": cid}, с индексом по (mode, lobby_id)
+lobby_viewers = ViewerIndex()
 
 # Глобальное состояние активных матчей
 active_matches = {}
+
+# У каждого матча свой почтовый ящик: нажатия кнопок, таймауты и решения админов
+# по одному матчу выполняются строго по очереди, без гонок между await
+match_actors = MatchActors()
+
+def callback_match_id(index):
+    # Номер матча из callback_data вида "ban_{match_id}_{map_index}"
+    return lambda callback, *args, **kwargs: int(callback.data.split("_")[index])
+
+def timer_match_id(match_id, *args):
+    return match_id
+
+# Автоподбор по ELO: очередь на режим, окно ELO расширяется со временем ожидания
+matchmaker = Matchmaker({"1x1": 2, "2x2": 4, "5x5": 10})
+MM_POLL_INTERVAL = float(os.getenv("MM_POLL_INTERVAL", 2))
+
+# Все таймауты матчей (подтверждение, бан, пик, кнопки админам) — на одном планировщике.
+# Ключ таймера: (match_id, фаза); новый таймер той же фазы заменяет старый
+timers = TimerService()
+ACCEPT_TIMEOUT = 60
+TURN_TIMEOUT = 30
 # Ожидание подтверждения матча
 pending_matches = {} # {match_id: {"players": [], "accepted": set(), "messages": {uid: mid}, "mode": mode}}
 # Хранилище дополнительных данных для матчей (например, инфо о кланах)
@@ -128,8 +169,22 @@ admin_messages = {} # {match_id: {admin_id: message_id}}
 # Состояния поддержки
 support_requests = {} # {ticket_id: {"user_id": uid, "text": text, "admin_id": None, "messages": {admin_id: msg_id}}}
 
-MAP_LIST_2X2 = ["Sandstone", "Province", "Breeze", "Dune", "Zone 7", "Rust", "Hanami"]
-MAP_LIST_1X1 = ["Temple", "Yard", "Bridge", "Pool", "Desert", "Pipeline", "Cableway"]
+# Состояние выше переживает перезапуск бота: журнал изменений + периодические снапшоты.
+# Изменил запись — отметь ее через state_store.mark(таблица, ключ), запись уйдет на диск в фоне
+state_store = StateStore()
+state_store.track("pending_matches", pending_matches)
+state_store.track("pending_matches_data", pending_matches_data)
+state_store.track("active_matches", active_matches)
+state_store.track("clan_war_queue", clan_war_queue)
+state_store.track("admin_messages", admin_messages)
+state_store.track("support_requests", support_requests)
+
+# Как собираются команды 2x2/5x5: "draft" — капитаны по очереди пикают игроков,
+# "balanced" — команды сразу делятся с минимальной разницей среднего ELO (капитаны в разных командах)
+TEAM_SELECTION = os.getenv("TEAM_SELECTION", "draft")
+
+# Мап-пулы и маска банов живут в veto.py (общий код с веб-версией):
+# match["bans"] — битовая маска, бит i = карта i пула забанена
 
 # Состояния регистрации
 class Registration(StatesGroup):
@@ -170,10 +225,26 @@ def main_menu_keyboard(user_id=None):
         builder.row(types.KeyboardButton(text="Админ-панель 👑"))
     return builder.as_markup(resize_keyboard=True, persistent=True)
 
+# Кэш отрисовки экранов лобби. У экрана лобби всего два варианта клавиатуры (игрок внутри / снаружи)
+# и один текст, поэтому они строятся один раз на состояние лобби и общие для всех зрителей.
+# Ключ — версия из реестра: любое изменение лобби её меняет, и старая запись просто не совпадет
+lobby_keyboard_cache = {} # (mode, lobby_id, inside) -> (version, markup)
+lobby_status_cache = {}   # (mode, lobby_id) -> (version, status_text)
+lobby_list_cache = {}     # mode -> (mode_version, markup)
+
+def lobby_screen_state(user_id, mode, lobby_id):
+    # Что сейчас показано зрителю лобби: одинаковое состояние — одинаковое сообщение
+    return (mode, lobby_id, lobby_registry.version(mode, lobby_id), user_id in lobby_registry.players(mode, lobby_id))
+
 def get_lobby_keyboard(user_id, mode, lobby_id):
-    builder = InlineKeyboardBuilder()
-    players_in_lobby = lobby_players[mode][lobby_id]
+    players_in_lobby = lobby_registry.players(mode, lobby_id)
+    inside = user_id in players_in_lobby
+    version = lobby_registry.version(mode, lobby_id)
+    cached = lobby_keyboard_cache.get((mode, lobby_id, inside))
+    if cached and cached[0] == version:
+        return cached[1]
     
+    builder = InlineKeyboardBuilder()
     if mode == "1x1":
         max_players = 2
     elif mode in ["2x2", "2x2_clan"]:
@@ -181,7 +252,7 @@ def get_lobby_keyboard(user_id, mode, lobby_id):
     else: # 5x5
         max_players = 10
     
-    if user_id not in players_in_lobby:
+    if not inside:
         builder.row(types.InlineKeyboardButton(
             text=f"Войти в лобби {lobby_id} 🎮 ({len(players_in_lobby)}/{max_players})", 
             callback_data=f"l_enter_{mode}_{lobby_id}"
@@ -193,7 +264,9 @@ def get_lobby_keyboard(user_id, mode, lobby_id):
         ))
     
     builder.row(types.InlineKeyboardButton(text="⬅️ Назад к выбору лобби", callback_data=f"mode_{mode}"))
-    return builder.as_markup()
+    markup = builder.as_markup()
+    lobby_keyboard_cache[(mode, lobby_id, inside)] = (version, markup)
+    return markup
 
 def get_mode_selection_keyboard():
     builder = InlineKeyboardBuilder()
@@ -210,6 +283,11 @@ def get_mode_selection_keyboard():
     return builder.as_markup()
 
 def get_lobby_list_keyboard(mode):
+    version = lobby_registry.mode_version(mode)
+    cached = lobby_list_cache.get(mode)
+    if cached and cached[0] == version:
+        return cached[1]
+    
     builder = InlineKeyboardBuilder()
     if mode == "1x1":
         max_p = 2
@@ -219,16 +297,54 @@ def get_lobby_list_keyboard(mode):
         max_p = 10
         
     for lid in range(1, 11):
-        count = len(lobby_players[mode][lid])
+        count = lobby_registry.count(mode, lid)
         builder.row(types.InlineKeyboardButton(
             text=f"Лобби №{lid} [{count}/{max_p}]", 
             callback_data=f"view_l_{mode}_{lid}"
         ))
+    if mode in matchmaker.queues:
+        builder.row(types.InlineKeyboardButton(text="⚡ Автоподбор по ELO", callback_data=f"mmq_join_{mode}"))
     builder.row(types.InlineKeyboardButton(text="⬅️ Назад к режимам", callback_data="back_to_modes"))
-    return builder.as_markup()
+    markup = builder.as_markup()
+    lobby_list_cache[mode] = (version, markup)
+    return markup
+
+# Обновления лобби копятся LOBBY_REFRESH_DELAY секунд и уходят одним рендером на всех зрителей
+LOBBY_REFRESH_DELAY = float(os.getenv("LOBBY_REFRESH_DELAY", 0.3))
 
 async def update_all_lobby_messages(mode, lobby_id):
-    players_in_lobby = lobby_players[mode][lobby_id]
+    lobby_refresher.schedule((mode, lobby_id))
+
+async def update_lobby_list_for_all(mode):
+    lobby_list_refresher.schedule((mode,))
+
+async def edit_viewer_message(uid, viewer, text, reply_markup, rendered, **kwargs):
+    # Правим сообщение зрителя, только если показанное ему состояние (rendered) изменилось.
+    # False — сообщение больше недоступно, зрителя можно забыть
+    if viewer.get("rendered") == rendered:
+        return True
+    try:
+        await bot.edit_message_text(
+            text=text,
+            chat_id=viewer['chat_id'],
+            message_id=viewer['message_id'],
+            reply_markup=reply_markup,
+            **kwargs
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e): return False
+    except Exception:
+        return False
+    viewer["rendered"] = rendered
+    return True
+
+async def render_lobby_status(mode, lobby_id):
+    version = lobby_registry.version(mode, lobby_id)
+    cached = lobby_status_cache.get((mode, lobby_id))
+    if cached and cached[0] == version:
+        return cached[1]
+    
+    players_in_lobby = list(lobby_registry.players(mode, lobby_id).items())
     if mode == "1x1":
         max_p = 2
     elif mode in ["2x2", "2x2_clan"]:
@@ -244,8 +360,9 @@ async def update_all_lobby_messages(mode, lobby_id):
         if mode == "2x2_clan":
             # Группируем по кланам для режима Битва кланов
             clans_in_lobby = {} # {clan_id: {"tag": tag, "players": [p_data, ...]}}
-            for uid, data in players_in_lobby.items():
-                clan = db.get_user_clan(uid)
+            player_clans = await db_async.get_clan_memberships([uid for uid, _ in players_in_lobby])
+            for uid, data in players_in_lobby:
+                clan = player_clans.get(uid)
                 if clan:
                     cid, tag = clan[0], clan[1]
                     if cid not in clans_in_lobby:
@@ -264,68 +381,68 @@ async def update_all_lobby_messages(mode, lobby_id):
                     nick = f"🏆 VIP 🏆 <b>{p_data['nickname']}</b>" if is_vip else p_data['nickname']
                     status_text += f"  • {nick} (Lvl: {p_data['level']})\n"
         else:
-            for uid, data in players_in_lobby.items():
+            for uid, data in players_in_lobby:
                 is_vip = data.get("is_vip", False)
                 if is_vip:
                     status_text += f"👤 👑 <b>{data['nickname']}</b> | Lvl: {data['level']}\n"
                 else:
                     status_text += f"👤 {data['nickname']} | Lvl: {data['level']}\n"
     
-    # Обновляем сообщения у всех, кто смотрит ИМЕННО ЭТО лобби
-    dead_viewers = []
-    for uid, data in lobby_viewers.items():
-        if data.get("mode") == mode and data.get("lobby_id") == lobby_id:
-            try:
-                await bot.edit_message_text(
-                    text=status_text,
-                    chat_id=data['chat_id'],
-                    message_id=data['message_id'],
-                    reply_markup=get_lobby_keyboard(uid, mode, lobby_id),
-                    parse_mode="HTML"
-                )
-            except TelegramBadRequest as e:
-                if "message is not modified" in str(e): continue
-                dead_viewers.append(uid)
-            except Exception:
-                dead_viewers.append(uid)
-            
-    for uid in dead_viewers:
-        if uid in lobby_viewers: del lobby_viewers[uid]
+    lobby_status_cache[(mode, lobby_id)] = (version, status_text)
+    return status_text
 
-async def update_lobby_list_for_all(mode):
+async def broadcast_lobby(mode, lobby_id):
+    status_text = await render_lobby_status(mode, lobby_id)
+    
+    # Обновляем сообщения у всех, кто смотрит ИМЕННО ЭТО лобби
+    viewers = lobby_viewers.watching(mode, lobby_id)
+    results = await asyncio.gather(*(
+        edit_viewer_message(uid, viewer, status_text, get_lobby_keyboard(uid, mode, lobby_id), lobby_screen_state(uid, mode, lobby_id), parse_mode="HTML")
+        for uid, viewer in viewers
+    ))
+    
+    for (uid, viewer), ok in zip(viewers, results):
+        # Зритель мог уже перейти на другой экран, пока шла правка
+        if not ok and lobby_viewers.get(uid) is viewer:
+            lobby_viewers.remove(uid)
+
+async def broadcast_lobby_list(mode):
     # Обновляем список лобби для тех, кто находится на экране выбора лобби этого режима
-    for uid, data in lobby_viewers.items():
-        if data.get("mode") == mode and data.get("lobby_id") is None:
-            try:
-                text = f"Выбран режим: {'🛡️ ' if mode == '2x2_clan' else ''}{mode}. Выберите свободное лобби:"
-                await bot.edit_message_text(
-                    text=text,
-                    chat_id=data['chat_id'],
-                    message_id=data['message_id'],
-                    reply_markup=get_lobby_list_keyboard(mode)
-                )
-            except: pass
+    text = f"Выбран режим: {'🛡️ ' if mode == '2x2_clan' else ''}{mode}. Выберите свободное лобби:"
+    markup = get_lobby_list_keyboard(mode)
+    rendered = ("list", mode, lobby_registry.mode_version(mode))
+    await asyncio.gather(*(
+        edit_viewer_message(uid, viewer, text, markup, rendered)
+        for uid, viewer in lobby_viewers.watching(mode, None)
+    ))
+
+lobby_refresher = Debouncer(broadcast_lobby, LOBBY_REFRESH_DELAY)
+lobby_list_refresher = Debouncer(broadcast_lobby_list, LOBBY_REFRESH_DELAY)
+
+async def fetch_subscription(user_id: int) -> bool:
+    # Обе проверки каналов параллельно
+    member1, member2 = await asyncio.gather(
+        bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id),
+        bot.get_chat_member(chat_id=CHANNEL_ID_2, user_id=user_id)
+    )
+    is_sub1 = member1.status in ["member", "administrator", "creator"]
+    is_sub2 = member2.status in ["member", "administrator", "creator"]
+    return is_sub1 and is_sub2
+
+# Кэш статуса подписки (subscriptions.py): подписанных помним долго и обновляем в фоне,
+# неподписанных — недолго; если проверка упала, пропускаем пользователя на SUB_ERROR_TTL
+subscription_cache = SubscriptionCache(fetch_subscription)
 
 async def check_subscription(user_id: int) -> bool:
-    try:
-        # Проверка первого канала
-        member1 = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        is_sub1 = member1.status in ["member", "administrator", "creator"]
-        
-        # Проверка второго канала
-        member2 = await bot.get_chat_member(chat_id=CHANNEL_ID_2, user_id=user_id)
-        is_sub2 = member2.status in ["member", "administrator", "creator"]
-        
-        return is_sub1 and is_sub2
-    except Exception:
-        # Если бот не админ в каком-то канале или канал не найден, 
-        # для безопасности считаем что подписан, чтобы не блокировать всех
-        return True
+    return await subscription_cache.check(user_id)
+
+def invalidate_subscription(user_id: int):
+    subscription_cache.invalidate(user_id)
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_val = user_db_data[8]
@@ -340,7 +457,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
                 return
             else:
                 # Время бана истекло
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы навсегда.")
             return
@@ -358,7 +475,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         return
 
     await state.clear()
-    user = db.get_user(message.from_user.id)
+    user = await db_async.get_user(message.from_user.id)
     if user:
         await message.answer(
             f"С возвращением, {user[2]}! 👋\nТы в главном меню.",
@@ -375,6 +492,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "check_sub")
 async def handle_check_sub(callback: types.CallbackQuery, state: FSMContext):
+    # Пользователь говорит, что подписался — проверяем заново, а не по кэшу
+    invalidate_subscription(callback.from_user.id)
     if await check_subscription(callback.from_user.id):
         try: await callback.answer("Подписка подтверждена! ✅")
         except TelegramBadRequest: pass
@@ -433,7 +552,7 @@ async def process_nickname(message: types.Message, state: FSMContext):
         await message.answer("Никнейм от 2 до 20 символов:")
         return
     user_data = await state.get_data()
-    db.add_user(message.from_user.id, user_data['game_id'], nickname)
+    await db_async.add_user(message.from_user.id, user_data['game_id'], nickname)
     await state.clear()
     await message.answer(f"Регистрация завершена! 🎉\nНик: {nickname}\nID: {user_data['game_id']}\nLvl: 4", reply_markup=main_menu_keyboard(message.from_user.id))
 
@@ -444,7 +563,7 @@ class ClanCreation(StatesGroup):
 @dp.message(F.text == "Битва кланов ⚔️")
 async def clan_battle_handler(message: types.Message):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -455,13 +574,13 @@ async def clan_battle_handler(message: types.Message):
                 except: pass
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             try: await message.answer("❌ Вы заблокированы.")
             except: pass
             return
 
-    user_clan = db.get_user_clan(message.from_user.id)
+    user_clan = await db_async.get_clan_membership(message.from_user.id)
     
     text = "⚔️ **БИТВА КЛАНОВ**\n\nВыберите действие:"
     builder = InlineKeyboardBuilder()
@@ -476,7 +595,7 @@ async def clan_battle_handler(message: types.Message):
         builder.row(types.InlineKeyboardButton(text="🚪 Выйти из клана", callback_data="clan_leave_confirm"))
 
     # Показываем список созданных кланов
-    all_clans = db.get_all_clans()
+    all_clans = await db_async.get_all_clans()
     if all_clans:
         text += "\n\n**Список доступных кланов:**"
         for clan in all_clans:
@@ -486,7 +605,7 @@ async def clan_battle_handler(message: types.Message):
 
 @dp.callback_query(F.data == "clan_create")
 async def clan_create_callback(callback: types.CallbackQuery, state: FSMContext):
-    if db.get_user_clan(callback.from_user.id):
+    if await db_async.get_clan_membership(callback.from_user.id):
         await callback.answer("❌ Вы уже состоите в клане!", show_alert=True)
         return
         
@@ -504,7 +623,7 @@ async def clan_tag_input(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат тега! Используйте от 2 до 5 английских букв или цифр.")
         return
         
-    if db.get_clan_by_tag(tag):
+    if await db_async.get_clan_by_tag(tag):
         await message.answer("❌ Клан с таким тегом уже существует!")
         return
         
@@ -523,7 +642,7 @@ async def clan_name_input(message: types.Message, state: FSMContext):
     data = await state.get_data()
     tag = data['tag']
     
-    clan_id = db.create_clan(tag, name, message.from_user.id)
+    clan_id = await db_async.create_clan(tag, name, message.from_user.id)
     if clan_id:
         await message.answer(f"✅ Клан **[{tag}] {name}** успешно создан!", parse_mode="Markdown", reply_markup=main_menu_keyboard(message.from_user.id))
         await state.clear()
@@ -533,7 +652,7 @@ async def clan_name_input(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data == "clan_list")
 async def clan_list_callback(callback: types.CallbackQuery):
-    clans = db.get_all_clans()
+    clans = await db_async.get_all_clans()
     if not clans:
         await callback.answer("Кланов пока нет.", show_alert=True)
         return
@@ -550,12 +669,12 @@ async def clan_list_callback(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("clan_view_"))
 async def clan_view_callback(callback: types.CallbackQuery):
     clan_id = int(callback.data.split("_")[2])
-    clan = db.get_clan_by_id(clan_id)
+    clan = await db_async.get_clan_by_id(clan_id)
     if not clan:
         await callback.answer("Клан не найден.")
         return
         
-    members = db.get_clan_members(clan_id)
+    members = await db_async.get_clan_members(clan_id)
     
     text = (
         f"🛡️ **КЛАН: [{clan[1]}] {clan[2]}**\n\n"
@@ -574,7 +693,7 @@ async def clan_view_callback(callback: types.CallbackQuery):
         text += f"{role_icon} {m[1]} (Lvl {m[3]}, ELO: {m[2]})\n"
         
     builder = InlineKeyboardBuilder()
-    user_clan = db.get_user_clan(callback.from_user.id)
+    user_clan = await db_async.get_clan_membership(callback.from_user.id)
     
     if not user_clan and len(members) < 5:
         builder.row(types.InlineKeyboardButton(text="🚪 Вступить в клан", callback_data=f"clan_join_{clan_id}"))
@@ -588,16 +707,16 @@ async def clan_view_callback(callback: types.CallbackQuery):
 async def clan_join_callback(callback: types.CallbackQuery):
     clan_id = int(callback.data.split("_")[2])
     
-    if db.get_user_clan(callback.from_user.id):
+    if await db_async.get_clan_membership(callback.from_user.id):
         await callback.answer("❌ Вы уже состоите в клане!", show_alert=True)
         return
         
-    members = db.get_clan_members(clan_id)
+    members = await db_async.get_clan_members(clan_id)
     if len(members) >= 5:
         await callback.answer("❌ В клане уже максимум участников (5/5)!", show_alert=True)
         return
         
-    if db.add_clan_member(clan_id, callback.from_user.id):
+    if await db_async.add_clan_member(clan_id, callback.from_user.id):
         await callback.answer("✅ Вы успешно вступили в клан!", show_alert=True)
         await clan_view_callback(callback)
     else:
@@ -615,7 +734,7 @@ async def clan_leave_confirm_callback(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "clan_leave_yes")
 async def clan_leave_yes_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    user_clan = db.get_user_clan(user_id)
+    user_clan = await db_async.get_user_clan(user_id)
     if not user_clan:
         await callback.answer("Вы не в клане.")
         return
@@ -625,7 +744,7 @@ async def clan_leave_yes_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Владелец не может выйти из клана! Вы можете только удалить его или передать права.", show_alert=True)
         return
 
-    if db.remove_clan_member(user_id):
+    if await db_async.remove_clan_member(user_id):
         await callback.answer("✅ Вы вышли из клана.", show_alert=True)
         await back_to_clan_menu(callback)
     else:
@@ -647,13 +766,13 @@ async def back_to_clan_menu(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "clan_war_start")
 async def clan_war_start_callback(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    user_clan = db.get_user_clan(user_id)
+    user_clan = await db_async.get_clan_membership(user_id)
     
     if not user_clan:
         await callback.answer("❌ Вы не состоите в клане!", show_alert=True)
         return
         
-    members = db.get_clan_members(user_clan[0])
+    members = await db_async.get_clan_members(user_clan[0])
     if len(members) < 2:
         await callback.answer("❌ В клане должно быть минимум 2 игрока для битвы!", show_alert=True)
         return
@@ -676,7 +795,7 @@ async def clan_war_start_callback(callback: types.CallbackQuery, state: FSMConte
 async def clan_war_invite_callback(callback: types.CallbackQuery):
     target_id = int(callback.data.split("_")[2])
     sender_id = callback.from_user.id
-    user_clan = db.get_user_clan(sender_id)
+    user_clan = await db_async.get_clan_membership(sender_id)
     
     if not user_clan: return
     
@@ -690,7 +809,7 @@ async def clan_war_invite_callback(callback: types.CallbackQuery):
     )
     
     try:
-        sender_data = db.get_user(sender_id)
+        sender_data = await db_async.get_user(sender_id)
         await bot.send_message(
             target_id,
             f"🤝 Игрок **{sender_data[2]}** приглашает вас в поиск **Клановой Битвы (2x2)** за клан **[{user_clan[1]}]**!",
@@ -705,7 +824,7 @@ async def clan_war_invite_callback(callback: types.CallbackQuery):
 async def cw_accept_callback(callback: types.CallbackQuery):
     sender_id = int(callback.data.split("_")[2])
     acceptor_id = callback.from_user.id
-    user_clan = db.get_user_clan(acceptor_id)
+    user_clan = await db_async.get_clan_membership(acceptor_id)
     
     if not user_clan: return
     
@@ -726,10 +845,12 @@ async def cw_accept_callback(callback: types.CallbackQuery):
     # Ищем оппонента
     if clan_war_queue:
         opponent_clan = clan_war_queue.pop(0)
+        state_store.mark("clan_war_queue")
         # Начинаем матч между двумя кланами
         await start_clan_match(user_clan, pair, opponent_clan[0], opponent_clan[1])
     else:
         clan_war_queue.append((clan_id, pair))
+        state_store.mark("clan_war_queue")
         # Уведомляем о нахождении в поиске
         builder = InlineKeyboardBuilder()
         builder.row(types.InlineKeyboardButton(text="❌ Выйти из поиска", callback_data=f"cw_cancel_{clan_id}"))
@@ -738,28 +859,31 @@ async def cw_accept_callback(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("cw_cancel_"))
 async def cw_cancel_callback(callback: types.CallbackQuery):
     clan_id = int(callback.data.split("_")[2])
-    global clan_war_queue
     initial_len = len(clan_war_queue)
-    clan_war_queue = [q for q in clan_war_queue if q[0] != clan_id]
+    clan_war_queue[:] = [q for q in clan_war_queue if q[0] != clan_id]
     
     if len(clan_war_queue) < initial_len:
+        state_store.mark("clan_war_queue")
         await callback.message.edit_text("❌ Поиск клановой битвы отменен.")
         await callback.answer("Поиск отменен.")
     else:
         await callback.answer("Поиск уже не активен.")
 
 async def start_clan_match(clan1_info, clan1_players, clan2_id, clan2_players):
-    clan2_info = db.get_clan_by_id(clan2_id)
+    # Строка БД -> кортеж: данные матча сохраняются на диск (state_store)
+    clan2_info = tuple(await db_async.get_clan_by_id(clan2_id))
     all_player_ids = clan1_players + clan2_players
     
     # Создаем матч в БД (режим 2x2_clan)
-    match_num = db.create_match("2x2_clan", all_player_ids)
+    match_num = await db_async.create_match("2x2_clan", all_player_ids)
     
     # Формируем данные для памяти (аналогично обычному матчу)
+    users = await db_async.get_users(all_player_ids)
+    vip_flags = await db_async.get_vip_flags(all_player_ids)
     players_data = []
     for uid in all_player_ids:
-        u = db.get_user(uid)
-        players_data.append((uid, {"nickname": u[2], "level": db.get_level_by_elo(u[3]), "game_id": u[1], "is_vip": db.is_user_vip(uid)}))
+        u = users[uid]
+        players_data.append((uid, {"nickname": u[2], "level": db.get_level_by_elo(u[3]), "game_id": u[1], "is_vip": vip_flags[uid]}))
 
     pending_matches[match_num] = {
         "players": players_data,
@@ -775,29 +899,30 @@ async def start_clan_match(clan1_info, clan1_players, clan2_id, clan2_players):
             "clan2": {"info": clan2_info, "players": clan2_players}
         }
     }
+    state_store.mark("pending_matches_data", match_num)
     
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="Принять ✅", callback_data=f"accept_{match_num}"))
     
-    for uid in all_player_ids:
-        try:
-            msg = await bot.send_message(
-                uid, 
-                f"🔔 **КЛАНОВАЯ БИТВА НАЙДЕНА!** (№{match_num})\n"
-                f"🛡️ **[{clan1_info[1]}]** vs **[{clan2_info[1]}]**\n\n"
-                f"Подтвердите участие! У вас есть 60 секунд.",
-                reply_markup=builder.as_markup(),
-                parse_mode="Markdown"
-            )
-            pending_matches[match_num]["messages"][uid] = msg.message_id
-        except: pass
+    sent = await notify_players(
+        all_player_ids,
+        f"🔔 **КЛАНОВАЯ БИТВА НАЙДЕНА!** (№{match_num})\n"
+        f"🛡️ **[{clan1_info[1]}]** vs **[{clan2_info[1]}]**\n\n"
+        f"Подтвердите участие! У вас есть 60 секунд.",
+        priority=outbox.HIGH,
+        reply_markup=builder.as_markup(),
+        parse_mode="Markdown"
+    )
+    for uid, msg in sent.items():
+        pending_matches[match_num]["messages"][uid] = msg.message_id
+    state_store.mark("pending_matches", match_num)
     
-    asyncio.create_task(check_accept_timeout(match_num))
+    timers.schedule((match_num, "accept"), ACCEPT_TIMEOUT, check_accept_timeout, match_num)
 
 @dp.message(F.text == "Профиль 👤")
 async def profile(message: types.Message):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -807,7 +932,7 @@ async def profile(message: types.Message):
                 await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы.")
             return
@@ -824,7 +949,7 @@ async def profile(message: types.Message):
         )
         return
 
-    user = db.get_user(message.from_user.id)
+    user = await db_async.get_user(message.from_user.id)
     if not user: return
     _, game_id, nickname, elo, level, matches, wins, _, _, _, is_vip, vip_until = user
     # Вычисляем уровень на лету на основе ELO
@@ -860,7 +985,7 @@ async def profile(message: types.Message):
 @dp.message(F.text == "Поиск матча 🔍")
 async def find_match(message: types.Message):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -870,7 +995,7 @@ async def find_match(message: types.Message):
                 await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы.")
             return
@@ -887,7 +1012,7 @@ async def find_match(message: types.Message):
         )
         return
 
-    user = db.get_user(message.from_user.id)
+    user = await db_async.get_user(message.from_user.id)
     if not user: return
     
     # Сначала выбор режима
@@ -896,12 +1021,12 @@ async def find_match(message: types.Message):
         "Выберите режим, в котором хотите соревноваться:",
         reply_markup=get_mode_selection_keyboard()
     )
-    lobby_viewers[message.from_user.id] = {"mode": None, "lobby_id": None, "message_id": msg.message_id, "chat_id": msg.chat.id}
+    lobby_viewers.set(message.from_user.id, None, None, msg.message_id, msg.chat.id)
 
 @dp.callback_query(F.data == "back_to_modes")
 async def back_to_modes(callback: types.CallbackQuery):
     # Проверка на бан
-    user_db_data = db.get_user(callback.from_user.id)
+    user_db_data = await db_async.get_user(callback.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -912,7 +1037,7 @@ async def back_to_modes(callback: types.CallbackQuery):
                 except TelegramBadRequest: pass
                 return
             else:
-                db.set_ban_status(callback.from_user.id, False)
+                await db_async.set_ban_status(callback.from_user.id, False)
         else:
             try: await callback.answer("❌ Вы заблокированы.", show_alert=True)
             except TelegramBadRequest: pass
@@ -927,17 +1052,12 @@ async def back_to_modes(callback: types.CallbackQuery):
         reply_markup=get_mode_selection_keyboard()
     )
     # Обновляем инфо о зрителе
-    lobby_viewers[callback.from_user.id] = {
-        "mode": None, 
-        "lobby_id": None,
-        "message_id": callback.message.message_id,
-        "chat_id": callback.message.chat.id
-    }
+    lobby_viewers.set(callback.from_user.id, None, None, callback.message.message_id, callback.message.chat.id)
 
 @dp.callback_query(F.data.startswith("mode_"))
 async def select_mode(callback: types.CallbackQuery):
     # Проверка на бан
-    user_db_data = db.get_user(callback.from_user.id)
+    user_db_data = await db_async.get_user(callback.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -947,7 +1067,7 @@ async def select_mode(callback: types.CallbackQuery):
                 await callback.answer(f"❌ Вы заблокированы до {ban_until_str}.", show_alert=True)
                 return
             else:
-                db.set_ban_status(callback.from_user.id, False)
+                await db_async.set_ban_status(callback.from_user.id, False)
         else:
             await callback.answer("❌ Вы заблокированы.", show_alert=True)
             return
@@ -956,7 +1076,7 @@ async def select_mode(callback: types.CallbackQuery):
     
     # Проверка для режима битва кланов
     if mode == "2x2_clan":
-        user_clan = db.get_user_clan(callback.from_user.id)
+        user_clan = await db_async.get_clan_membership(callback.from_user.id)
         if not user_clan:
             await callback.answer("❌ Этот режим доступен только участникам кланов!", show_alert=True)
             return
@@ -970,17 +1090,12 @@ async def select_mode(callback: types.CallbackQuery):
         parse_mode="HTML"
     )
     # Обновляем инфо о зрителе
-    lobby_viewers[callback.from_user.id] = {
-        "mode": mode, 
-        "lobby_id": None,
-        "message_id": callback.message.message_id,
-        "chat_id": callback.message.chat.id
-    }
+    lobby_viewers.set(callback.from_user.id, mode, None, callback.message.message_id, callback.message.chat.id)
 
 @dp.callback_query(F.data.startswith("view_l_"))
 async def view_lobby(callback: types.CallbackQuery):
     # Проверка на бан
-    user_db_data = db.get_user(callback.from_user.id)
+    user_db_data = await db_async.get_user(callback.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -990,7 +1105,7 @@ async def view_lobby(callback: types.CallbackQuery):
                 await callback.answer(f"❌ Вы заблокированы до {ban_until_str}.", show_alert=True)
                 return
             else:
-                db.set_ban_status(callback.from_user.id, False)
+                await db_async.set_ban_status(callback.from_user.id, False)
         else:
             await callback.answer("❌ Вы заблокированы.", show_alert=True)
             return
@@ -1002,56 +1117,13 @@ async def view_lobby(callback: types.CallbackQuery):
         mode = "_".join(parts[2:-1])
         
         # Обновляем инфо о зрителе
-        lobby_viewers[callback.from_user.id] = {
-            "mode": mode, 
-            "lobby_id": lobby_id, 
-            "message_id": callback.message.message_id,
-            "chat_id": callback.message.chat.id
-        }
-        
-        players_in_lobby = lobby_players[mode][lobby_id]
-        if mode == "1x1":
-            max_players = 2
-        elif mode in ["2x2", "2x2_clan"]:
-            max_players = 4
-        else: # 5x5
-            max_players = 10
-        
-        status_text = f"📍 Режим: {'🛡️ ' if mode == '2x2_clan' else ''}{mode} | Лобби №{lobby_id} ({len(players_in_lobby)}/{max_players})\n\nСписок игроков 💻📱:\n"
+        lobby_viewers.set(callback.from_user.id, mode, lobby_id, callback.message.message_id, callback.message.chat.id)
         
-        if not players_in_lobby:
-            status_text += "Пусто..."
-        else:
-            if mode == "2x2_clan":
-                # Группируем по кланам для режима Битва кланов
-                clans_in_lobby = {} # {clan_id: {"tag": tag, "players": [p_data, ...]}}
-                for uid, data in players_in_lobby.items():
-                    clan = db.get_user_clan(uid)
-                    if clan:
-                        cid, tag = clan[0], clan[1]
-                        if cid not in clans_in_lobby:
-                            clans_in_lobby[cid] = {"tag": tag, "players": []}
-                        clans_in_lobby[cid]["players"].append(data)
-                    else:
-                        if "no_clan" not in clans_in_lobby:
-                            clans_in_lobby["no_clan"] = {"tag": "БЕЗ КЛАНА", "players": []}
-                        clans_in_lobby["no_clan"]["players"].append(data)
-                
-                for cid, cdata in clans_in_lobby.items():
-                    status_text += f"\n🛡️ [{cdata['tag']}]:\n"
-                    for p_data in cdata["players"]:
-                        is_vip = p_data.get("is_vip", False)
-                        nick = f"🏆 VIP 🏆 <b>{p_data['nickname']}</b>" if is_vip else p_data['nickname']
-                        status_text += f"  • {nick} (Lvl: {p_data['level']})\n"
-            else:
-                for uid, data in players_in_lobby.items():
-                    is_vip = data.get("is_vip", False)
-                    if is_vip:
-                        status_text += f"👤 👑 <b>{data['nickname']}</b> | Lvl: {data['level']}\n"
-                    else:
-                        status_text += f"👤 {data['nickname']} | Lvl: {data['level']}\n"
-            
+        shown = lobby_screen_state(callback.from_user.id, mode, lobby_id)
+        status_text = await render_lobby_status(mode, lobby_id)
         await callback.message.edit_text(status_text, reply_markup=get_lobby_keyboard(callback.from_user.id, mode, lobby_id), parse_mode="HTML")
+        viewer = lobby_viewers.get(callback.from_user.id)
+        if viewer: viewer["rendered"] = shown
     except Exception as e:
         logging.error(f"Error in view_lobby: {e}")
     finally:
@@ -1060,7 +1132,7 @@ async def view_lobby(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("l_enter_"))
 async def lobby_enter_callback(callback: types.CallbackQuery):
     # Проверка на бан
-    user_db_data = db.get_user(callback.from_user.id)
+    user_db_data = await db_async.get_user(callback.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -1070,7 +1142,7 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
                 await callback.message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(callback.from_user.id, False)
+                await db_async.set_ban_status(callback.from_user.id, False)
         else:
             await callback.message.answer("❌ Вы заблокированы.")
             return
@@ -1081,30 +1153,34 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     # ПРОВЕРКА: не находится ли пользователь уже в КАКОМ-ЛИБО лобби
-    for m in lobby_players:
-        for lid in lobby_players[m]:
-            if user_id in lobby_players[m][lid]:
-                if m == mode and lid == lobby_id:
-                    await callback.answer("Вы уже в этом лобби.")
-                    return
-                else:
-                    await callback.answer(f"❌ Вы уже находитесь в другом лобби ({m}, №{lid})! Выйдите из него сначала.", show_alert=True)
-                    return
+    seat = lobby_registry.locate(user_id)
+    if seat:
+        m, lid = seat
+        if m == mode and lid == lobby_id:
+            await callback.answer("Вы уже в этом лобби.")
+            return
+        else:
+            await callback.answer(f"❌ Вы уже находитесь в другом лобби ({m}, №{lid})! Выйдите из него сначала.", show_alert=True)
+            return
+    queued_mode = matchmaker.locate(user_id)
+    if queued_mode:
+        await callback.answer(f"❌ Вы в автоподборе ({queued_mode})! Выйдите из поиска сначала.", show_alert=True)
+        return
 
     if mode == "2x2_clan":
         # Специальная логика для входа кланом
-        user_clan = db.get_user_clan(user_id)
+        user_clan = await db_async.get_clan_membership(user_id)
         if not user_clan:
             await callback.answer("❌ Для этого режима необходимо состоять в клане!", show_alert=True)
             return
             
         # Проверяем вместимость (нужно 2 места)
-        if len(lobby_players[mode][lobby_id]) >= 3: # Если уже 3 или 4 игрока, 2 места не влезет
+        if lobby_registry.count(mode, lobby_id) >= 3: # Если уже 3 или 4 игрока, 2 места не влезет
             await callback.answer("❌ В этом лобби недостаточно места для вашего клана (нужно 2 свободных слота)!", show_alert=True)
             return
 
         # Запускаем процесс выбора напарника
-        members = db.get_clan_members(user_clan[0])
+        members = await db_async.get_clan_members(user_clan[0])
         if len(members) < 2:
             await callback.answer("❌ В клане должно быть минимум 2 игрока!", show_alert=True)
             return
@@ -1120,22 +1196,17 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
         return
 
     # Обновляем инфо о зрителе (гарантируем актуальность message_id)
-    lobby_viewers[user_id] = {
-        "mode": mode, 
-        "lobby_id": lobby_id, 
-        "message_id": callback.message.message_id,
-        "chat_id": callback.message.chat.id
-    }
+    lobby_viewers.set(user_id, mode, lobby_id, callback.message.message_id, callback.message.chat.id)
     
     # Удаляем устаревшие проверки рассинхрона, так как новая проверка в начале функции надежнее
     
-    user = db.get_user(user_id)
+    user = await db_async.get_user(user_id)
     if not user:
         await callback.answer("Ошибка: пользователь не найден в БД.", show_alert=True)
         return
         
     level = db.get_level_by_elo(user[3])
-    is_vip = db.is_user_vip(user_id)
+    is_vip = await db_async.is_user_vip(user_id)
     
     # Атомарная проверка вместимости перед входом
     if mode == "1x1":
@@ -1145,12 +1216,17 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
     else: # 5x5
         max_p = 10
         
-    if len(lobby_players[mode][lobby_id]) >= max_p:
+    # Пока ждали БД, мог пройти повторный клик или другой игрок занять последнее место:
+    # проверяем заново, и до add больше никаких await
+    if user_id in lobby_registry or matchmaker.locate(user_id):
+        await callback.answer("❌ Вы уже в лобби или в автоподборе.", show_alert=True)
+        return
+    if lobby_registry.count(mode, lobby_id) >= max_p:
         await callback.answer("Лобби уже заполнено!", show_alert=True)
         return
 
-    lobby_players[mode][lobby_id][user_id] = {"nickname": user[2], "level": level, "game_id": user[1], "is_vip": is_vip}
-    db.add_lobby_member(mode, lobby_id, user_id)
+    lobby_registry.add(mode, lobby_id, user_id, {"nickname": user[2], "level": level, "game_id": user[1], "is_vip": is_vip})
+    await db_async.add_lobby_member(mode, lobby_id, user_id)
     # Используем message.answer вместо callback.answer для надежности отображения
     await callback.message.answer(f"✅ Вы вошли в лобби №{lobby_id} ({mode})")
     await callback.answer()
@@ -1158,52 +1234,148 @@ async def lobby_enter_callback(callback: types.CallbackQuery):
     await update_all_lobby_messages(mode, lobby_id)
     await update_lobby_list_for_all(mode)
     
-    if len(lobby_players[mode][lobby_id]) >= max_p:
+    if lobby_registry.count(mode, lobby_id) >= max_p:
         # Небольшая задержка перед подтверждением, чтобы пользователи увидели заполнение
         await asyncio.sleep(0.5)
         await request_match_accept(mode, lobby_id)
 
 async def request_match_accept(mode, lobby_id):
-    if not lobby_players[mode][lobby_id]:
+    players = lobby_registry.clear(mode, lobby_id)
+    if not players:
         return
         
-    players = list(lobby_players[mode][lobby_id].items())
-    player_ids = [uid for uid, _ in players]
-    
     # Удаляем участников лобби из БД при создании матча
-    for uid in player_ids:
-        db.remove_lobby_member(uid)
-        
-    lobby_players[mode][lobby_id].clear()
+    for uid, _ in players:
+        await db_async.remove_lobby_member(uid)
+    
+    # Убираем всех из зрителей (чтобы не спамило обновлениями)
+    for uid, _ in players:
+        lobby_viewers.remove(uid)
     
-    match_num = db.create_match(mode, player_ids)
+    await update_lobby_list_for_all(mode) # Обновляем список лобби (теперь оно пустое)
+    await offer_match(mode, players)
+
+async def offer_match(mode, players, source="lobby"):
+    # Создает матч и просит игроков подтвердить участие.
+    # source: "lobby" — собрались в лобби, "queue" — собраны автоподбором
+    player_ids = [uid for uid, _ in players]
+    match_num = await db_async.create_match(mode, player_ids)
     
     pending_matches[match_num] = {
         "players": players,
         "accepted": set(),
         "messages": {},
-        "mode": mode
+        "mode": mode,
+        "source": source
     }
-    
-    # Убираем всех из зрителей (чтобы не спамило обновлениями)
-    for uid, _ in players:
-        if uid in lobby_viewers: del lobby_viewers[uid]
-    
-    await update_lobby_list_for_all(mode) # Обновляем список лобби (теперь оно пустое)
         
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="Принять ✅", callback_data=f"accept_{match_num}"))
     
-    for uid, _ in players:
-        try:
-            msg = await bot.send_message(uid, f"🔔 Игра {mode} найдена! Подтвердите участие (Матч №{match_num})\nУ вас есть 60 секунд.", reply_markup=builder.as_markup())
-            pending_matches[match_num]["messages"][uid] = msg.message_id
-        except: pass
-    
-    asyncio.create_task(check_accept_timeout(match_num))
+    sent = await notify_players(
+        [uid for uid, _ in players],
+        f"🔔 Игра {mode} найдена! Подтвердите участие (Матч №{match_num})\nУ вас есть 60 секунд.",
+        priority=outbox.HIGH,
+        reply_markup=builder.as_markup()
+    )
+    for uid, msg in sent.items():
+        pending_matches[match_num]["messages"][uid] = msg.message_id
+    state_store.mark("pending_matches", match_num)
+    
+    timers.schedule((match_num, "accept"), ACCEPT_TIMEOUT, check_accept_timeout, match_num)
+
+def queue_conflict(user_id):
+    # Почему игрок не может встать в автоподбор, или None. Без await: вызывать прямо перед join
+    seat = lobby_registry.locate(user_id)
+    if seat:
+        return f"❌ Вы уже находитесь в лобби ({seat[0]}, №{seat[1]})! Выйдите из него сначала."
+    queued_mode = matchmaker.locate(user_id)
+    if queued_mode:
+        return f"Вы уже в автоподборе ({queued_mode})."
+    for match_num, match in list(pending_matches.items()) + list(active_matches.items()):
+        if any(p[0] == user_id for p in match["players"]):
+            return f"❌ Вы уже участвуете в матче №{match_num}."
+    return None
+
+@dp.callback_query(F.data.startswith("mmq_join_"))
+async def matchmaking_join(callback: types.CallbackQuery):
+    # Проверка на бан
+    user_db_data = await db_async.get_user(callback.from_user.id)
+    if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
+        # Проверка временного бана
+        ban_until_str = user_db_data[8]
+        if ban_until_str:
+            ban_until = datetime.strptime(ban_until_str, "%Y-%m-%d %H:%M:%S")
+            if datetime.now() < ban_until:
+                await callback.answer(f"❌ Вы заблокированы до {ban_until_str}.", show_alert=True)
+                return
+            else:
+                await db_async.set_ban_status(callback.from_user.id, False)
+        else:
+            await callback.answer("❌ Вы заблокированы.", show_alert=True)
+            return
+
+    mode = callback.data.replace("mmq_join_", "")
+    user_id = callback.from_user.id
+    if mode not in matchmaker.queues:
+        await callback.answer()
+        return
+    busy = queue_conflict(user_id)
+    if busy:
+        await callback.answer(busy, show_alert=True)
+        return
+
+    user = await db_async.get_user(user_id)
+    if not user:
+        await callback.answer("Ошибка: пользователь не найден в БД.", show_alert=True)
+        return
+    is_vip = await db_async.is_user_vip(user_id)
+    data = {"nickname": user[2], "level": db.get_level_by_elo(user[3]), "game_id": user[1], "is_vip": is_vip}
+    # Пока ждали БД, мог пройти повторный клик: проверяем заново, до join без await
+    busy = queue_conflict(user_id)
+    if busy:
+        await callback.answer(busy, show_alert=True)
+        return
+    group = matchmaker.join(mode, user_id, user[3], data)
+
+    builder = InlineKeyboardBuilder()
+    builder.row(types.InlineKeyboardButton(text="❌ Выйти из поиска", callback_data="mmq_leave"))
+    await callback.message.edit_text(
+        f"⚡ Автоподбор {mode}: ищем соперников по ELO...\n\n"
+        f"Ваш ELO: {user[3]}. Чем дольше поиск, тем шире диапазон соперников.",
+        reply_markup=builder.as_markup()
+    )
+    # Экран лобби больше не нужно обновлять
+    lobby_viewers.remove(user_id)
+    await callback.answer()
+    if group:
+        await offer_match(mode, group, source="queue")
+
+@dp.callback_query(F.data == "mmq_leave")
+async def matchmaking_leave(callback: types.CallbackQuery):
+    if matchmaker.leave(callback.from_user.id) is None:
+        await callback.answer("Поиск уже не активен.")
+        return
+    await callback.answer("Поиск отменен.")
+    await callback.message.edit_text(
+        "🎮 ВЫБОР РЕЖИМА ИГРЫ\n\n"
+        "Выберите режим, в котором хотите соревноваться:",
+        reply_markup=get_mode_selection_keyboard()
+    )
+    lobby_viewers.set(callback.from_user.id, None, None, callback.message.message_id, callback.message.chat.id)
+
+async def matchmaking_loop():
+    # Ожидающие дольше получают более широкое окно ELO — пересобираем группы
+    while True:
+        await asyncio.sleep(MM_POLL_INTERVAL)
+        for mode, group in matchmaker.poll():
+            try:
+                await offer_match(mode, group, source="queue")
+            except Exception:
+                logging.exception(f"Failed to start matchmaking match {mode}")
 
+@match_actors.serialized(timer_match_id)
 async def check_accept_timeout(match_num):
-    await asyncio.sleep(60) 
     if match_num in pending_matches:
         match = pending_matches[match_num]
         accepted_ids = match["accepted"]
@@ -1217,15 +1389,15 @@ async def check_accept_timeout(match_num):
         # Обработка тех, кто не принял
         for p_uid, p_data in not_accepted:
             # Инкремент предупреждений
-            count = db.increment_missed_games(p_uid)
+            count = await db_async.increment_missed_games(p_uid)
             
             try:
                 if count >= 3:
                     # Бан на 30 минут
                     ban_until = datetime.now() + timedelta(minutes=30)
                     until_str = ban_until.strftime("%Y-%m-%d %H:%M:%S")
-                    db.set_ban_status(p_uid, True, until_str)
-                    db.reset_missed_games(p_uid)
+                    await db_async.set_ban_status(p_uid, True, until_str)
+                    await db_async.reset_missed_games(p_uid)
                     await bot.send_message(p_uid, f"❌ Вы не подтвердили игру (3/3). Бан на 30 минут до {until_str}.")
                 else:
                     await bot.send_message(p_uid, f"⚠️ Вы не подтвердили игру! Предупреждение: {count}/3. При 3/3 — бан на 30 минут.")
@@ -1235,24 +1407,35 @@ async def check_accept_timeout(match_num):
             except: pass
 
         # Обработка тех, кто принял
-        if accepted_players:
+        if accepted_players and match.get("source") == "queue":
+            # Собраны автоподбором — возвращаем в очередь, а не в лобби
+            users = await db_async.get_users([p[0] for p in accepted_players])
+            regrouped = []
+            for p_uid, p_data in accepted_players:
+                if p_uid in lobby_registry or matchmaker.locate(p_uid) or p_uid not in users: continue
+                group = matchmaker.join(mode, p_uid, users[p_uid][3], p_data)
+                if group: regrouped.append(group)
+                try:
+                    await bot.edit_message_text("Матч отменен: не все игроки подтвердили участие.\nВы возвращены в автоподбор.", chat_id=p_uid, message_id=match["messages"].get(p_uid))
+                except: pass
+            for group in regrouped:
+                await offer_match(mode, group, source="queue")
+        elif accepted_players:
             # Возвращаем их в лобби (или просто уведомляем, что они остаются в очереди)
             # Находим свободное лобби для них или создаем видимость, что они там
             # Но по логике текущего кода, лобби было очищено. 
             # Нам нужно найти ПЕРВОЕ свободное лобби этого режима и закинуть их туда.
             
-            target_lobby_id = 1
-            for lid in range(1, 11):
-                if len(lobby_players[mode][lid]) == 0:
-                    target_lobby_id = lid
-                    break
+            target_lobby_id = lobby_registry.first_free(mode) or 1
             
             for p_uid, p_data in accepted_players:
+                # Пока шло подтверждение, игрок мог зайти в другое лобби
+                if p_uid in lobby_registry: continue
                 try:
                     # Возвращаем в память
-                    lobby_players[mode][target_lobby_id][p_uid] = p_data
+                    lobby_registry.add(mode, target_lobby_id, p_uid, p_data)
                     # Возвращаем в БД
-                    db.add_lobby_member(mode, target_lobby_id, p_uid)
+                    await db_async.add_lobby_member(mode, target_lobby_id, p_uid)
                     
                     await bot.edit_message_text(f"Матч отменен: не все игроки подтвердили участие.\nВы возвращены в лобби №{target_lobby_id}.", chat_id=p_uid, message_id=match["messages"].get(p_uid))
                 except: pass
@@ -1260,13 +1443,16 @@ async def check_accept_timeout(match_num):
             await update_all_lobby_messages(mode, target_lobby_id)
             await update_lobby_list_for_all(mode)
 
-        db.cancel_match(match_num)
+        await db_async.cancel_match(match_num)
         if match_num in pending_matches:
             del pending_matches[match_num]
         if match_num in pending_matches_data:
             del pending_matches_data[match_num]
+        state_store.mark("pending_matches", match_num)
+        state_store.mark("pending_matches_data", match_num)
 
 @dp.callback_query(F.data.startswith("accept_"))
+@match_actors.serialized(callback_match_id(1))
 async def handle_accept(callback: types.CallbackQuery):
     await callback.answer()
     match_num = int(callback.data.split("_")[1])
@@ -1275,22 +1461,23 @@ async def handle_accept(callback: types.CallbackQuery):
     # Сначала пытаемся найти в памяти
     if match_num not in pending_matches:
         # Если в памяти нет (после перезагрузки), проверяем БД
-        match_db = db.get_pending_match(match_num)
+        match_db = await db_async.get_pending_match(match_num)
         if not match_db:
             await callback.answer("Матч уже отменен, не существует или уже начат.", show_alert=True)
             return
             
         # Восстанавливаем в памяти из БД
-        players_db = db.get_match_players(match_num)
+        players_db = await db_async.get_match_players(match_num)
         # [(user_id, nickname, elo, level, accepted), ...]
         
         # Нам нужно восстановить players как список кортежей (uid, data_dict)
         restored_players = []
         accepted_set = set()
+        users = await db_async.get_users([p[0] for p in players_db])
         for p in players_db:
             uid, nick, elo, lvl, accepted = p
-            u_full = db.get_user(uid)
-            gid = u_full[0] if u_full else str(uid)
+            u_full = users.get(uid)
+            gid = u_full[1] if u_full else str(uid)
             
             p_data = {"nickname": nick, "level": lvl, "game_id": gid}
             restored_players.append((uid, p_data))
@@ -1311,7 +1498,8 @@ async def handle_accept(callback: types.CallbackQuery):
         return
         
     match["accepted"].add(user_id)
-    db.accept_match_player(match_num, user_id)
+    state_store.mark("pending_matches", match_num)
+    await db_async.accept_match_player(match_num, user_id)
     
     try:
         await callback.message.edit_text("Вы подтвердили участие! Ожидание остальных... ⏳")
@@ -1321,14 +1509,42 @@ async def handle_accept(callback: types.CallbackQuery):
     if len(match["accepted"]) == len(match["players"]):
         players = match["players"]
         mode = match["mode"]
+        timers.cancel((match_num, "accept"))
         if match_num in pending_matches:
             del pending_matches[match_num]
         await start_match_setup(match_num, players, mode)
         # Очищаем дополнительные данные после старта настройки
         if match_num in pending_matches_data:
             del pending_matches_data[match_num]
+        state_store.mark("pending_matches", match_num)
+        state_store.mark("pending_matches_data", match_num)
+
+async def balanced_rosters(players, cap_1, cap_2):
+    # {captain_id: [капитан, игроки...]} — лучшее деление по ELO
+    users = await db_async.get_users([p[0] for p in players])
+    elos = [users[p[0]][3] if p[0] in users else 1000 for p in players]
+    index = {p[0]: i for i, p in enumerate(players)}
+    team_a, team_b, _ = team_balance.balance_teams(elos, apart=[(index[cap_1[0]], index[cap_2[0]])])
+    rosters = {}
+    for team in (team_a, team_b):
+        team = [players[i] for i in team]
+        captain = cap_1 if cap_1 in team else cap_2
+        rosters[captain[0]] = [captain] + [p for p in team if p is not captain]
+    return rosters
+
+def apply_rosters(match, rosters):
+    # Команды уже собраны — фазы пика не будет
+    match["teams"] = {"ct": rosters[match["captains"]["ct"]], "t": rosters[match["captains"]["t"]]}
+    match["available_players"] = []
+
+def format_nick(player, vip_flags):
+    # VIP-ники выделяются во всех сообщениях матча
+    nickname = player[1]['nickname']
+    return f"🏆 VIP 🏆 <b>{nickname}</b>" if vip_flags.get(player[0]) else nickname
 
 async def start_match_setup(match_num, players, mode):
+    # VIP-статусы всех игроков одним запросом
+    vip_flags = await db_async.get_vip_flags([p[0] for p in players])
     if mode == "2x2_clan":
         # Кланы уже имеют фиксированные составы
         clan_data = pending_matches_data.get(match_num, {}).get("clans")
@@ -1350,7 +1566,7 @@ async def start_match_setup(match_num, players, mode):
                 "players": players,
                 "mode": "2x2_clan",
                 "captains": {"ct": cap_ct[0], "t": cap_t[0]},
-                "maps": MAP_LIST_2X2.copy(),
+                "bans": 0,
                 "turn": "ct",
                 "phase": "ban",
                 "teams": {
@@ -1359,13 +1575,12 @@ async def start_match_setup(match_num, players, mode):
                 },
                 "clans": clan_data,
                 "final_map": None,
-                "elo_gain": random.randint(25, 35),
                 "message_ids": {}
             }
             
             for uid, _ in players:
-                nick_ct = f"🏆 VIP 🏆 <b>{cap_ct[1]['nickname']}</b>" if db.is_user_vip(cap_ct[0]) else cap_ct[1]['nickname']
-                nick_t = f"🏆 VIP 🏆 <b>{cap_t[1]['nickname']}</b>" if db.is_user_vip(cap_t[0]) else cap_t[1]['nickname']
+                nick_ct = format_nick(cap_ct, vip_flags)
+                nick_t = format_nick(cap_t, vip_flags)
                 await bot.send_message(
                     uid, 
                     f"🔔 КЛАНОВАЯ БИТВА №{match_num}!\n"
@@ -1377,10 +1592,11 @@ async def start_match_setup(match_num, players, mode):
             return
 
     random.shuffle(players)
+    rosters = None
     
     # Логика выбора капитанов с учетом VIP (60% шанс для VIP быть капитаном)
     if mode in ["2x2", "5x5"]:
-        vip_players = [p for p in players if db.is_user_vip(p[0])]
+        vip_players = [p for p in players if vip_flags.get(p[0])]
         other_players = [p for p in players if p not in vip_players]
         
         captains = []
@@ -1416,10 +1632,12 @@ async def start_match_setup(match_num, players, mode):
         
         cap_1 = captains[0]
         cap_2 = captains[1]
+        if TEAM_SELECTION == "balanced":
+            rosters = await balanced_rosters(players, cap_1, cap_2)
         
         # Логика выбора сторон для VIP
-        vip1 = db.is_user_vip(cap_1[0])
-        vip2 = db.is_user_vip(cap_2[0])
+        vip1 = vip_flags.get(cap_1[0], False)
+        vip2 = vip_flags.get(cap_2[0], False)
         
         needs_side_choice = False
         choosing_captain = None
@@ -1447,9 +1665,9 @@ async def start_match_setup(match_num, players, mode):
                 "captains_temp": [choosing_captain, other_cap], # choosing_captain всегда первый в списке на выбор
                 "phase": "side_choice",
                 "choosing_id": choosing_captain[0],
-                "maps": (MAP_LIST_2X2.copy() if mode != "1x1" else MAP_LIST_1X1.copy()),
+                "bans": 0,
                 "teams": {"ct": [], "t": []}, # Будет заполнено после выбора
-                "elo_gain": (random.randint(20, 30) if mode == "2x2" else random.randint(25, 35)),
+                "rosters": rosters, # Готовые составы при TEAM_SELECTION == "balanced"
                 "message_ids": {}
             }
             
@@ -1461,6 +1679,7 @@ async def start_match_setup(match_num, players, mode):
                     parse_mode="HTML"
                 )
             
+            state_store.mark("active_matches", match_num)
             # Отправляем кнопки выбора только капитану
             builder = InlineKeyboardBuilder()
             builder.row(
@@ -1484,12 +1703,11 @@ async def start_match_setup(match_num, players, mode):
         active_matches[match_num] = {
             "players": players,
             "mode": "1x1",
-            "maps": MAP_LIST_1X1.copy(),
+            "bans": 0,
             "turn": "p1",
             "phase": "ban",
             "teams": {"ct": [p1], "t": [p2]},
             "final_map": None,
-            "elo_gain": random.randint(5, 15),
             "message_ids": {}
         }
         for uid, _ in players:
@@ -1506,17 +1724,18 @@ async def start_match_setup(match_num, players, mode):
             "mode": "2x2",
             "available_players": available_players, 
             "captains": {"ct": cap_ct[0], "t": cap_t[0]},
-            "maps": MAP_LIST_2X2.copy(),
+            "bans": 0,
             "turn": "ct",
             "phase": "ban",
             "teams": {"ct": [cap_ct], "t": [cap_t]},
             "final_map": None,
-            "elo_gain": random.randint(20, 30),
             "message_ids": {}
         }
+        if rosters:
+            apply_rosters(active_matches[match_num], rosters)
         for uid, _ in players:
-            nick_ct = f"🏆 VIP 🏆 <b>{cap_ct[1]['nickname']}</b>" if db.is_user_vip(cap_ct[0]) else cap_ct[1]['nickname']
-            nick_t = f"🏆 VIP 🏆 <b>{cap_t[1]['nickname']}</b>" if db.is_user_vip(cap_t[0]) else cap_t[1]['nickname']
+            nick_ct = format_nick(cap_ct, vip_flags)
+            nick_t = format_nick(cap_t, vip_flags)
             await bot.send_message(
                 uid, 
                 f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 2x2 №{match_num})\nКапитан CT: {nick_ct}\nКапитан T: {nick_t}\n\nНачинаем бан карт. Первые банят CT.",
@@ -1534,17 +1753,18 @@ async def start_match_setup(match_num, players, mode):
             "mode": "5x5",
             "available_players": available_players, 
             "captains": {"ct": cap_ct[0], "t": cap_t[0]},
-            "maps": MAP_LIST_2X2.copy(), # Тот же мап-пул
+            "bans": 0, # Тот же мап-пул, что и в 2x2
             "turn": "ct",
             "phase": "ban",
             "teams": {"ct": [cap_ct], "t": [cap_t]},
             "final_map": None,
-            "elo_gain": random.randint(25, 35),
             "message_ids": {}
         }
+        if rosters:
+            apply_rosters(active_matches[match_num], rosters)
         for uid, _ in players:
-            nick_ct = f"🏆 VIP 🏆 <b>{cap_ct[1]['nickname']}</b>" if db.is_user_vip(cap_ct[0]) else cap_ct[1]['nickname']
-            nick_t = f"🏆 VIP 🏆 <b>{cap_t[1]['nickname']}</b>" if db.is_user_vip(cap_t[0]) else cap_t[1]['nickname']
+            nick_ct = format_nick(cap_ct, vip_flags)
+            nick_t = format_nick(cap_t, vip_flags)
             await bot.send_message(
                 uid, 
                 f"🔔 ВСЕ ПОДТВЕРДИЛИ! (Матч 5x5 №{match_num})\nКапитан CT: {nick_ct}\nКапитан T: {nick_t}\n\nНачинаем бан карт. Первые банят CT.",
@@ -1552,40 +1772,63 @@ async def start_match_setup(match_num, players, mode):
             )
         await send_map_selection(match_num)
 
+def match_veto(match):
+    # Вето матча как veto.Veto (общий с веб-версией): порядок ходов p1/p2 в 1x1,
+    # иначе ct/t; в матче хранятся только маска банов и текущая сторона
+    sides = ("p1", "p2") if match.get("mode") == "1x1" else ("ct", "t")
+    return Veto.resume(pool_for_mode(match.get("mode")), sides, match["bans"], match["turn"])
+
+def current_ban_uid(match):
+    # Кто сейчас банит: в 1x1 игрок p1/p2, иначе капитан стороны
+    if match.get("mode") == "1x1":
+        return match['players'][0 if match['turn'] == 'p1' else 1][0]
+    return match['captains'][match['turn']]
+
+async def play_ban(match_id, match, veto, actions):
+    # Ход вето уже сделан в veto: сохраняем его в матч и журнал (veto_actions),
+    # затем следующий ход или переход к пику/старту
+    match["bans"], match["turn"] = veto.bans, veto.current
+    try: await db_async.add_veto_actions(match_id, actions)
+    except Exception as e: logging.error(f"Не удалось записать вето матча {match_id}: {e}")
+    
+    if not veto.picked:
+        await send_map_selection(match_id)
+        return
+    
+    match["final_map"] = veto.picked
+    # Очищаем старые сообщения перед переходом к следующей фазе
+    for uid, msg_id in match.get("message_ids", {}).items():
+        try: await bot.delete_message(chat_id=uid, message_id=msg_id)
+        except: pass
+    match["message_ids"] = {}
+    
+    if match.get("mode") in ["2x2", "5x5"] and match.get("available_players"):
+        match["phase"] = "pick"
+        match["turn"] = "t"
+        if actions[0][2] == "auto_ban":
+            text = f"Время вышло! Карта определена автоматически: {match['final_map']}!\nПереходим к выбору игроков."
+        else:
+            text = f"Карта определена: {match['final_map']}!\nПереходим к выбору игроков. Первые выбирают T."
+        for uid, _ in match["players"]:
+            await bot.send_message(uid, text)
+        await send_player_selection(match_id)
+    else:
+        # В 1x1 и при готовых составах сразу финиш
+        await finish_match_setup(match_id)
+
+@match_actors.serialized(timer_match_id)
 async def auto_ban_timer(match_id, turn_at_start):
-    await asyncio.sleep(30)
     if match_id not in active_matches: return
     match = active_matches[match_id]
-    if match.get("phase") != "ban" or match.get("turn") != turn_at_start: return
+    if match.get("phase") != "ban" or match.get("turn") != turn_at_start or match.get("final_map"): return
     
     # Если время вышло и это всё еще тот же ход и фаза бана
-    map_to_ban = random.choice(match["maps"])
-    match["maps"].remove(map_to_ban)
-    
-    if len(match["maps"]) > 1:
-        if match.get("mode") == "1x1":
-            match["turn"] = "p2" if match["turn"] == "p1" else "p1"
-        else:
-            match["turn"] = "t" if match["turn"] == "ct" else "ct"
-        await send_map_selection(match_id)
-    else:
-        match["final_map"] = match["maps"][0]
-        for uid, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=uid, message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
-        
-        if match.get("mode") in ["2x2", "5x5"]:
-            match["phase"] = "pick"
-            match["turn"] = "t"
-            for uid, _ in match["players"]:
-                await bot.send_message(uid, f"Время вышло! Карта определена автоматически: {match['final_map']}!\nПереходим к выбору игроков.")
-            await send_player_selection(match_id)
-        else:
-            await finish_match_setup(match_id)
+    veto = match_veto(match)
+    actions = veto.timeout(current_ban_uid(match))
+    await play_ban(match_id, match, veto, actions)
 
+@match_actors.serialized(timer_match_id)
 async def auto_pick_timer(match_id, turn_at_start):
-    await asyncio.sleep(30)
     if match_id not in active_matches: return
     match = active_matches[match_id]
     if match.get("phase") != "pick" or match.get("turn") != turn_at_start: return
@@ -1606,6 +1849,7 @@ async def auto_pick_timer(match_id, turn_at_start):
         await finish_match_setup(match_id)
 
 @dp.callback_query(F.data.startswith("side_select_"))
+@match_actors.serialized(callback_match_id(2))
 async def side_select_callback(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     match_num = int(parts[2])
@@ -1617,6 +1861,10 @@ async def side_select_callback(callback: types.CallbackQuery):
         return
         
     match = active_matches[match_num]
+    if match.get("phase") != "side_choice":
+        try: await callback.answer("Сторона уже выбрана.")
+        except TelegramBadRequest: pass
+        return
     if callback.from_user.id != match.get("choosing_id"):
         try: await callback.answer("Сейчас не ваша очередь выбирать сторону!", show_alert=True)
         except: pass
@@ -1635,18 +1883,22 @@ async def side_select_callback(callback: types.CallbackQuery):
     # Обновляем структуру матча до стандартной
     match["captains"] = {"ct": cap_ct[0], "t": cap_t[0]}
     match["teams"] = {"ct": [cap_ct], "t": [cap_t]}
+    if match.get("rosters"):
+        apply_rosters(match, match["rosters"])
     match["turn"] = "ct"
     match["phase"] = "ban"
     
     # Очищаем временные поля
     if "captains_temp" in match: del match["captains_temp"]
     if "choosing_id" in match: del match["choosing_id"]
+    match.pop("rosters", None)
     
     await callback.message.edit_text(f"✅ Вы выбрали сторону: {side.upper()}")
     
+    vip_flags = await db_async.get_vip_flags([cap_ct[0], cap_t[0]])
+    nick_ct = format_nick(cap_ct, vip_flags)
+    nick_t = format_nick(cap_t, vip_flags)
     for uid, _ in match["players"]:
-        nick_ct = f"🏆 VIP 🏆 <b>{cap_ct[1]['nickname']}</b>" if db.is_user_vip(cap_ct[0]) else cap_ct[1]['nickname']
-        nick_t = f"🏆 VIP 🏆 <b>{cap_t[1]['nickname']}</b>" if db.is_user_vip(cap_t[0]) else cap_t[1]['nickname']
         await bot.send_message(
             uid, 
             f"🔔 Стороны выбраны! (Матч {match['mode']} №{match_num})\nКапитан CT: {nick_ct}\nКапитан T: {nick_t}\n\nНачинаем бан карт. Первые банят CT.",
@@ -1662,9 +1914,11 @@ async def send_map_selection(match_id):
     builder = InlineKeyboardBuilder()
     
     # Кнопки в 2 столбика
+    pool = pool_for_mode(match.get("mode"))
+    available = pool.indexes(pool.available(match["bans"]))
     buttons = []
-    for m in match['maps']:
-        buttons.append(types.InlineKeyboardButton(text=f"Бан {m}", callback_data=f"ban_{match_id}_{m}"))
+    for i in available:
+        buttons.append(types.InlineKeyboardButton(text=f"Бан {pool.maps[i]}", callback_data=f"ban_{match_id}_{i}"))
     
     # Группируем по 2
     for i in range(0, len(buttons), 2):
@@ -1674,15 +1928,14 @@ async def send_map_selection(match_id):
         p1_name = match['players'][0][1]['nickname']
         p2_name = match['players'][1][1]['nickname']
         turn_text = f"игрока {p1_name if match['turn'] == 'p1' else p2_name}"
-        current_turn_uid = match['players'][0 if match['turn'] == 'p1' else 1][0]
     else:
         turn_text = f"капитана {'CT' if match['turn'] == 'ct' else 'T'}"
-        current_turn_uid = match['captains'][match['turn']]
+    current_turn_uid = current_ban_uid(match)
         
-    text = f"⏳ У вас 30 секунд!\nЭтап: БАН КАРТ\nХод {turn_text}\nКарты в пуле: {', '.join(match['maps'])}"
+    text = f"⏳ У вас 30 секунд!\nЭтап: БАН КАРТ\nХод {turn_text}\nКарты в пуле: {', '.join(pool.maps[i] for i in available)}"
     
     # Запускаем таймер авто-бана
-    asyncio.create_task(auto_ban_timer(match_id, match['turn']))
+    timers.schedule((match_id, "ban"), TURN_TIMEOUT, auto_ban_timer, match_id, match['turn'])
     
     for uid, _ in match['players']:
         markup = builder.as_markup() if uid == current_turn_uid else None
@@ -1704,48 +1957,30 @@ async def send_map_selection(match_id):
             new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
             if "message_ids" not in match: match["message_ids"] = {}
             match["message_ids"][uid] = new_msg.message_id
+    state_store.mark("active_matches", match_id)
 
 @dp.callback_query(F.data.startswith("ban_"))
+@match_actors.serialized(callback_match_id(1))
 async def handle_ban(callback: types.CallbackQuery):
-    _, match_id, map_name = callback.data.split("_")
+    _, match_id, map_index = callback.data.split("_")
     match_id = int(match_id)
-    match = active_matches[match_id]
+    map_index = int(map_index) if map_index.isdigit() else -1
+    match = active_matches.get(match_id)
+    veto = match_veto(match) if match and match.get("phase") == "ban" and not match.get("final_map") else None
+    # Повторное нажатие или таймер уже сделал ход: события матча идут по очереди,
+    # поэтому достаточно сверить состояние
+    if not veto or not veto.pool.is_available(veto.bans, map_index):
+        try: await callback.answer("Этот ход уже сделан.")
+        except TelegramBadRequest: pass
+        return
     
-    if match.get("mode") == "1x1":
-        current_turn_uid = match['players'][0 if match['turn'] == 'p1' else 1][0]
-    else:
-        current_turn_uid = match['captains'][match['turn']]
-        
-    if callback.from_user.id != current_turn_uid: 
+    if callback.from_user.id != current_ban_uid(match): 
         await callback.answer("Сейчас не ваш ход!", show_alert=True)
         return
     
-    await callback.answer(f"Вы забанили {map_name}")
-    match['maps'].remove(map_name)
-    
-    if len(match['maps']) > 1:
-        if match.get("mode") == "1x1":
-            match['turn'] = "p2" if match['turn'] == "p1" else "p1"
-        else:
-            match['turn'] = "t" if match['turn'] == "ct" else "ct"
-        await send_map_selection(match_id)
-    else:
-        match['final_map'] = match['maps'][0]
-        # Очищаем старые сообщения перед переходом к следующей фазе
-        for uid, msg_id in match.get("message_ids", {}).items():
-            try: await bot.delete_message(chat_id=uid, message_id=msg_id)
-            except: pass
-        match["message_ids"] = {}
-        
-        if match.get("mode") in ["2x2", "5x5"]:
-            match['phase'] = "pick"
-            match['turn'] = "t"
-            for uid, _ in match['players']:
-                await bot.send_message(uid, f"Карта определена: {match['final_map']}!\nПереходим к выбору игроков. Первые выбирают T.")
-            await send_player_selection(match_id)
-        else:
-            # В 1x1 сразу финиш
-            await finish_match_setup(match_id)
+    await callback.answer(f"Вы забанили {veto.pool.maps[map_index]}")
+    actions = veto.ban(map_index, callback.from_user.id)
+    await play_ban(match_id, match, veto, actions)
 
 async def send_player_selection(match_id):
     match = active_matches[match_id]
@@ -1758,7 +1993,8 @@ async def send_player_selection(match_id):
     current_cap = match['captains'][match['turn']]
     
     # Запускаем таймер авто-пика
-    asyncio.create_task(auto_pick_timer(match_id, match['turn']))
+    timers.cancel((match_id, "ban"))
+    timers.schedule((match_id, "pick"), TURN_TIMEOUT, auto_pick_timer, match_id, match['turn'])
     
     for uid, _ in match['players']:
         markup = builder.as_markup() if uid == current_cap else None
@@ -1778,12 +2014,18 @@ async def send_player_selection(match_id):
         else:
             new_msg = await bot.send_message(uid, msg_text, reply_markup=markup)
             match["message_ids"][uid] = new_msg.message_id
+    state_store.mark("active_matches", match_id)
 
 @dp.callback_query(F.data.startswith("pick_"))
+@match_actors.serialized(callback_match_id(1))
 async def handle_pick(callback: types.CallbackQuery):
     _, match_id, p_id = callback.data.split("_")
     match_id, p_id = int(match_id), int(p_id)
-    match = active_matches[match_id]
+    match = active_matches.get(match_id)
+    if not match or match.get("phase") != "pick" or all(p[0] != p_id for p in match["available_players"]):
+        try: await callback.answer("Этот ход уже сделан.")
+        except TelegramBadRequest: pass
+        return
     if callback.from_user.id != match['captains'][match['turn']]: 
         await callback.answer("Сейчас не ваш ход!", show_alert=True)
         return
@@ -1807,6 +2049,16 @@ async def handle_pick(callback: types.CallbackQuery):
 
 async def finish_match_setup(match_id):
     match = active_matches[match_id]
+    # Бан/пик закончились — их таймеры больше не нужны
+    timers.cancel((match_id, "ban"))
+    timers.cancel((match_id, "pick"))
+    
+    # Ставка ELO по рейтингу команд: фаворит за победу получает меньше, андердог — больше
+    users = await db_async.get_users([p[0] for p in match['players']])
+    team_elos = {side: [users[p[0]][3] if p[0] in users else rating.BASE_RATING for p in match['teams'][side]] for side in ("ct", "t")}
+    ct_gain, t_gain = rating.match_gains(team_elos["ct"], team_elos["t"], match.get("mode"))
+    match["elo_gains"] = {"ct": ct_gain, "t": t_gain}
+    state_store.mark("active_matches", match_id)
     
     # Заголовок и инфо о кланах
     clan_header = ""
@@ -1815,15 +2067,16 @@ async def finish_match_setup(match_id):
         clan2 = match["clans"]["clan2"]["info"]
         clan_header = f"⚔️ **БИТВА КЛАНОВ: [{clan1[1]}] vs [{clan2[1]}]**\n\n"
 
+    vip_flags = await db_async.get_vip_flags([p[0] for p in match['players']])
     ct_team = []
     for p in match['teams']['ct']:
-        nick = f"🏆 VIP 🏆 <b>{p[1]['nickname']}</b>" if db.is_user_vip(p[0]) else p[1]['nickname']
+        nick = format_nick(p, vip_flags)
         ct_team.append(f"• {nick} (Lvl {p[1]['level']})")
     ct_team_str = "\n".join(ct_team)
 
     t_team = []
     for p in match['teams']['t']:
-        nick = f"🏆 VIP 🏆 <b>{p[1]['nickname']}</b>" if db.is_user_vip(p[0]) else p[1]['nickname']
+        nick = format_nick(p, vip_flags)
         t_team.append(f"• {nick} (Lvl {p[1]['level']})")
     t_team_str = "\n".join(t_team)
     
@@ -1843,20 +2096,15 @@ async def finish_match_setup(match_id):
         f"🔵 КОМАНДА CT {'<b>['+match['clans']['clan1']['info'][1]+']</b>' if match.get('mode') == '2x2_clan' else ''}:\n{ct_team_str}\n"
         f"🔴 КОМАНДА T {'<b>['+match['clans']['clan2']['info'][1]+']</b>' if match.get('mode') == '2x2_clan' else ''}:\n{t_team_str}\n\n"
         f"👑 Капитан CT (ID в игре): {cap_ct_id}\n\n"
-        f"📈 За победу: +{match['elo_gain']} ELO\n"
-        f"📉 За поражение: -{match['elo_gain']} ELO\n\n"
+        f"📈 Победа CT: +{ct_gain} ELO (T: -{ct_gain})\n"
+        f"📈 Победа T: +{t_gain} ELO (CT: -{t_gain})\n\n"
         f"⚠️ Напоминание: Ваши никнеймы в игре ДОЛЖЕНЫ совпадать с никнеймами в боте!"
     )
-    for uid, _ in match['players']:
-        await bot.send_message(uid, text, reply_markup=builder.as_markup(), parse_mode="HTML")
+    player_ids = [p[0] for p in match['players']]
+    await notify_players(player_ids, text, priority=outbox.HIGH, reply_markup=builder.as_markup(), parse_mode="HTML")
     
     # Отправка того же сообщения админам (если они не игроки в этом матче)
-    player_ids = [p[0] for p in match['players']]
-    for admin_id in ADMINS:
-        if admin_id not in player_ids:
-            try:
-                await bot.send_message(admin_id, text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except: pass
+    await notify_players([a for a in ADMINS if a not in player_ids], text, reply_markup=builder.as_markup(), parse_mode="HTML")
     
     # Не удаляем матч сразу, чтобы кнопка скриншота работала
     # del active_matches[match_id]
@@ -1893,7 +2141,7 @@ async def process_screenshot(message: types.Message, state: FSMContext):
 
     data = await state.get_data()
     match_id = data.get("current_match_id")
-    user = db.get_user(message.from_user.id)
+    user = await db_async.get_user(message.from_user.id)
     nickname = user[2] if user else "Unknown"
     
     # Кнопки для админов
@@ -1919,7 +2167,6 @@ async def process_screenshot(message: types.Message, state: FSMContext):
             
             # Фоновая задача для добавления кнопок через 3 секунды
             async def add_buttons_after_delay(admin_id, message_id, match_id, nickname, user_id):
-                await asyncio.sleep(3)
                 builder = InlineKeyboardBuilder()
                 builder.row(
                     types.InlineKeyboardButton(text="✅ CT WIN", callback_data=f"admin_win_{match_id}_ct"),
@@ -1936,13 +2183,14 @@ async def process_screenshot(message: types.Message, state: FSMContext):
                     )
                 except: pass
 
-            asyncio.create_task(add_buttons_after_delay(admin_id, msg.message_id, match_id, nickname, message.from_user.id))
+            timers.schedule((match_id, f"admin_buttons_{admin_id}_{msg.message_id}"), 3, add_buttons_after_delay, admin_id, msg.message_id, match_id, nickname, message.from_user.id)
             
             if match_id not in admin_messages:
                 admin_messages[match_id] = {}
             admin_messages[match_id][admin_id] = msg.message_id
         except Exception as e:
             logging.error(f"Failed to send to admin {admin_id}: {e}")
+    state_store.mark("admin_messages", match_id)
             
     await message.answer("Скриншот отправлен админам! Ожидайте подтверждения и обновления ELO. ✅")
     await state.clear()
@@ -2022,6 +2270,7 @@ async def admin_back_to_match(callback: types.CallbackQuery, answered: bool = Fa
     except TelegramBadRequest: pass
 
 @dp.callback_query(F.data.startswith("admin_win_"))
+@match_actors.serialized(callback_match_id(2))
 async def admin_confirm_win(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMINS: return
     
@@ -2033,9 +2282,13 @@ async def admin_confirm_win(callback: types.CallbackQuery):
         return
         
     match = active_matches[match_id]
-    elo_gain = match['elo_gain']
+    # elo_gain — у матчей, собранных до перехода на рейтинг
+    elo_gain = match["elo_gains"][winner_team] if "elo_gains" in match else match["elo_gain"]
     
-    # Начисляем/вычитаем ELO
+    # Считаем изменения ELO для всех игроков
+    results = []
+    notifications = []
+    vip_flags = await db_async.get_vip_flags([p[0] for p in match['players']])
     for team_name, players in match['teams'].items():
         is_win = (team_name == winner_team)
         
@@ -2044,8 +2297,7 @@ async def admin_confirm_win(callback: types.CallbackQuery):
             final_change = elo_gain if is_win else -elo_gain
             
             # Бонус для VIP при победе (10-15%)
-            if is_win and db.is_user_vip(p_uid):
-                import random
+            if is_win and vip_flags.get(p_uid):
                 bonus_pct = random.randint(10, 15) / 100.0
                 bonus = int(elo_gain * bonus_pct)
                 if bonus < 1: bonus = 1
@@ -2054,21 +2306,34 @@ async def admin_confirm_win(callback: types.CallbackQuery):
             else:
                 vip_bonus_text = ""
 
-            db.update_elo(p_uid, final_change, is_win)
-            try:
-                result_text = "ПОБЕДА! 🎉" if is_win else "ПОРАЖЕНИЕ... 📉"
-                await bot.send_message(p_uid, f"🔔 Результат матча №{match_id} подтвержден!\n\nРезультат: {result_text}\nИзменение ELO: {final_change:+}{vip_bonus_text}")
-            except: pass
-            
-    # Обновляем статистику кланов, если это клановая битва
+            results.append((p_uid, final_change, is_win))
+            notifications.append((p_uid, is_win, final_change, vip_bonus_text))
+
+    # Статистика кланов, если это клановая битва
+    clan_results = None
     if match.get("mode") == "2x2_clan":
         clan1_id = match["clans"]["clan1"]["info"][0]
         clan2_id = match["clans"]["clan2"]["info"][0]
         
-        # Расчет изменения ELO для клана (упрощенно как и у игроков)
+        # Клан получает ту же ставку, что и его игроки
         clan_elo_change = elo_gain
-        db.update_clan_stats(clan1_id, winner_team == "ct", clan_elo_change if winner_team == "ct" else -clan_elo_change)
-        db.update_clan_stats(clan2_id, winner_team == "t", clan_elo_change if winner_team == "t" else -clan_elo_change)
+        clan_results = [
+            (clan1_id, clan_elo_change if winner_team == "ct" else -clan_elo_change, winner_team == "ct"),
+            (clan2_id, clan_elo_change if winner_team == "t" else -clan_elo_change, winner_team == "t"),
+        ]
+
+    # Все изменения применяются одной транзакцией
+    settled = await db_async.settle_match(match_id, results, clan_results)
+    if settled is None:
+        try: await callback.answer("Результат этого матча уже подтвержден.", show_alert=True)
+        except TelegramBadRequest: pass
+        return
+
+    for p_uid, is_win, final_change, vip_bonus_text in notifications:
+        try:
+            result_text = "ПОБЕДА! 🎉" if is_win else "ПОРАЖЕНИЕ... 📉"
+            await bot.send_message(p_uid, f"🔔 Результат матча №{match_id} подтвержден!\n\nРезультат: {result_text}\nИзменение ELO: {final_change:+}{vip_bonus_text}")
+        except: pass
 
     # Синхронизация: удаляем кнопки у всех админов
     if match_id in admin_messages:
@@ -2084,10 +2349,14 @@ async def admin_confirm_win(callback: types.CallbackQuery):
         
     if match_id in active_matches:
         del active_matches[match_id]
+    timers.cancel_group(match_id)
+    state_store.mark("admin_messages", match_id)
+    state_store.mark("active_matches", match_id)
     try: await callback.answer("Результат подтвержден!")
     except TelegramBadRequest: pass
 
 @dp.callback_query(F.data.startswith("admin_cancel_"))
+@match_actors.serialized(callback_match_id(2))
 async def admin_cancel_match(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMINS: return
     match_id = int(callback.data.split("_")[2])
@@ -2102,6 +2371,8 @@ async def admin_cancel_match(callback: types.CallbackQuery):
     # Синхронизация: удаляем кнопки у всех админов
     if match_id in admin_messages:
         for admin_id, msg_id in admin_messages[match_id].items():
+            # Кнопки еще не успели появиться — и не должны
+            timers.cancel((match_id, f"admin_buttons_{admin_id}_{msg_id}"))
             try:
                 await bot.edit_message_caption(
                     chat_id=admin_id,
@@ -2110,6 +2381,7 @@ async def admin_cancel_match(callback: types.CallbackQuery):
                 )
             except: pass
         del admin_messages[match_id]
+        state_store.mark("admin_messages", match_id)
         
     try: await callback.answer("Результат отклонен")
     except TelegramBadRequest: pass
@@ -2120,16 +2392,14 @@ async def clan_lobby_invite_callback(callback: types.CallbackQuery):
     lobby_id = int(parts[2])
     target_id = int(parts[3])
     sender_id = callback.from_user.id
-    user_clan = db.get_user_clan(sender_id)
+    user_clan = await db_async.get_clan_membership(sender_id)
     
     if not user_clan: return
     
     # ПРОВЕРКА: не находится ли ТАРГЕТ уже в КАКОМ-ЛИБО лобби
-    for m in lobby_players:
-        for lid in lobby_players[m]:
-            if target_id in lobby_players[m][lid]:
-                await callback.answer("❌ Этот игрок уже находится в лобби!", show_alert=True)
-                return
+    if target_id in lobby_registry:
+        await callback.answer("❌ Этот игрок уже находится в лобби!", show_alert=True)
+        return
     
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -2138,7 +2408,7 @@ async def clan_lobby_invite_callback(callback: types.CallbackQuery):
     )
     
     try:
-        sender_data = db.get_user(sender_id)
+        sender_data = await db_async.get_user(sender_id)
         await bot.send_message(
             target_id,
             f"🤝 Игрок **{sender_data[2]}** приглашает вас зайти в **Клановое Лобби №{lobby_id}** за клан **[{user_clan[1]}]**!",
@@ -2155,44 +2425,65 @@ async def cl_accept_callback(callback: types.CallbackQuery):
     lobby_id = int(parts[2])
     sender_id = int(parts[3])
     acceptor_id = callback.from_user.id
-    user_clan = db.get_user_clan(acceptor_id)
+    user_clan = await db_async.get_clan_membership(acceptor_id)
     
     if not user_clan: return
     
     mode = "2x2_clan"
     
+    users = await db_async.get_users([sender_id, acceptor_id])
+    vip_flags = await db_async.get_vip_flags([sender_id, acceptor_id])
+
+    # Проверки стоят сразу перед посадкой, без await между ними и add:
+    # иначе повторное нажатие или чужой вход успеют вклиниться
     # Проверка места еще раз
-    if len(lobby_players[mode][lobby_id]) >= 3:
+    if lobby_registry.count(mode, lobby_id) >= 3:
         await callback.answer("❌ Лобби уже заполнилось, пока вы подтверждали!", show_alert=True)
         return
 
+    # Пока шло приглашение, кто-то из двоих мог сесть в другое лобби или встать
+    # в автоподбор: тогда не сажаем никого, иначе лобби останется наполовину заполненным
+    for uid in [sender_id, acceptor_id]:
+        who = "Вы" if uid == acceptor_id else "Напарник"
+        seat = lobby_registry.locate(uid)
+        if seat:
+            await callback.answer(f"❌ {who} уже находится в лобби ({seat[0]}, №{seat[1]})!", show_alert=True)
+            return
+        queued_mode = matchmaker.locate(uid)
+        if queued_mode:
+            await callback.answer(f"❌ {who} уже в автоподборе ({queued_mode}).", show_alert=True)
+            return
+
     # Входим оба
+    seated = []
     for uid in [sender_id, acceptor_id]:
-        user = db.get_user(uid)
+        user = users.get(uid)
         if user:
             level = db.get_level_by_elo(user[3])
-            is_vip = db.is_user_vip(uid)
-            lobby_players[mode][lobby_id][uid] = {"nickname": user[2], "level": level, "game_id": user[1], "is_vip": is_vip}
-            db.add_lobby_member(mode, lobby_id, uid)
-            
-            # Уведомляем каждого
-            try:
-                if uid == acceptor_id:
-                    await callback.message.edit_text(f"✅ Вы вошли в лобби №{lobby_id} ({mode})")
-                else:
-                    await bot.send_message(uid, f"✅ Напарник принял приглашение! Вы вошли в лобби №{lobby_id} ({mode})")
-            except: pass
+            is_vip = vip_flags[uid]
+            lobby_registry.add(mode, lobby_id, uid, {"nickname": user[2], "level": level, "game_id": user[1], "is_vip": is_vip})
+            seated.append(uid)
+
+    for uid in seated:
+        await db_async.add_lobby_member(mode, lobby_id, uid)
+
+        # Уведомляем каждого
+        try:
+            if uid == acceptor_id:
+                await callback.message.edit_text(f"✅ Вы вошли в лобби №{lobby_id} ({mode})")
+            else:
+                await bot.send_message(uid, f"✅ Напарник принял приглашение! Вы вошли в лобби №{lobby_id} ({mode})")
+        except: pass
 
     await update_all_lobby_messages(mode, lobby_id)
     await update_lobby_list_for_all(mode)
     
     # Проверка на старт матча
-    if len(lobby_players[mode][lobby_id]) >= 4:
-        players = list(lobby_players[mode][lobby_id].items())
+    if lobby_registry.count(mode, lobby_id) >= 4:
         # Очищаем лобби
+        players = lobby_registry.clear(mode, lobby_id)
         for pid, _ in players:
-            db.remove_lobby_member(pid)
-        lobby_players[mode][lobby_id] = {}
+            await db_async.remove_lobby_member(pid)
         await update_all_lobby_messages(mode, lobby_id)
         await update_lobby_list_for_all(mode)
         
@@ -2202,10 +2493,11 @@ async def cl_accept_callback(callback: types.CallbackQuery):
         
         # Первый игрок определяет первый клан
         first_p_id = players[0][0]
-        clan1_info = db.get_user_clan(first_p_id)
+        player_clans = await db_async.get_clan_memberships([pid for pid, _ in players])
+        clan1_info = player_clans.get(first_p_id)
         
         for pid, pdata in players:
-            p_clan = db.get_user_clan(pid)
+            p_clan = player_clans.get(pid)
             if p_clan and p_clan[0] == clan1_info[0]:
                 clan1_players.append(pid)
             else:
@@ -2218,7 +2510,7 @@ async def cl_accept_callback(callback: types.CallbackQuery):
             # Для простоты считаем что все ок, так как вход по 2 человека.
             pass
             
-        await start_clan_match(clan1_info, clan1_players, db.get_user_clan(clan2_players[0])[0], clan2_players)
+        await start_clan_match(clan1_info, clan1_players, player_clans[clan2_players[0]][0], clan2_players)
 
 @dp.callback_query(F.data.startswith("cl_decline_"))
 async def cl_decline_callback(callback: types.CallbackQuery):
@@ -2243,39 +2535,31 @@ async def lobby_exit_callback(callback: types.CallbackQuery):
     
     # СПЕЦИАЛЬНАЯ ЛОГИКА ДЛЯ 2X2_CLAN: выход обоих соклановцев
     if mode == "2x2_clan":
-        user_clan = db.get_user_clan(user_id)
+        user_clan = await db_async.get_clan_membership(user_id)
         if user_clan:
             clan_id = user_clan[0]
             # Ищем всех игроков из этого лобби, которые в этом же клане
-            to_remove = []
-            for uid in list(lobby_players[mode][lobby_id].keys()):
-                member_clan = db.get_user_clan(uid)
-                if member_clan and member_clan[0] == clan_id:
-                    to_remove.append(uid)
+            member_clans = await db_async.get_clan_memberships(list(lobby_registry.players(mode, lobby_id)))
+            to_remove = [uid for uid, member_clan in member_clans.items() if member_clan[0] == clan_id]
             
             if to_remove:
                 for uid in to_remove:
-                    if uid in lobby_players[mode][lobby_id]:
-                        del lobby_players[mode][lobby_id][uid]
-                        db.remove_lobby_member(uid)
+                    if lobby_registry.locate(uid) == (mode, lobby_id):
+                        lobby_registry.remove(uid)
+                        await db_async.remove_lobby_member(uid)
                 found = True
     
     if not found:
-        if user_id in lobby_players[mode][lobby_id]:
-            del lobby_players[mode][lobby_id][user_id]
+        # Игрок может сидеть и в другом лобби этого же режима
+        seat = lobby_registry.locate(user_id)
+        if seat and seat[0] == mode:
+            lobby_registry.remove(user_id)
+            lobby_id = seat[1] # Обновляем ID для корректного обновления сообщений
             found = True
-        else:
-            # Проверяем другие лобби этого же режима
-            for lid in lobby_players[mode]:
-                if user_id in lobby_players[mode][lid]:
-                    del lobby_players[mode][lid][user_id]
-                    lobby_id = lid # Обновляем ID для корректного обновления сообщений
-                    found = True
-                    break
     
     if found:
         if mode != "2x2_clan":
-            db.remove_lobby_member(user_id)
+            await db_async.remove_lobby_member(user_id)
         
         await callback.message.answer("❌ Вы вышли из лобби." + (" (Ваш клан также покинул лобби)" if mode == "2x2_clan" else ""))
         await update_all_lobby_messages(mode, lobby_id)
@@ -2294,7 +2578,7 @@ async def leaderboard_choice(message: types.Message):
 
 @dp.callback_query(F.data == "top_players")
 async def top_players_callback(callback: types.CallbackQuery):
-    top_players = db.get_top_players(10)
+    top_players = await db_async.get_top_players(10)
     if not top_players:
         await callback.answer("Список лидеров пока пуст.", show_alert=True)
         return
@@ -2307,13 +2591,24 @@ async def top_players_callback(callback: types.CallbackQuery):
         else:
             text += f"{medal} {nickname} — {elo} ELO (Lvl {level})\n"
     
+    # Место игрока и соседи по рейтингу (если он не в топ-10)
+    my_rank = await db_async.get_player_rank(callback.from_user.id)
+    if my_rank:
+        rank, total = my_rank
+        text += f"\n📍 <b>Ваше место: {rank} из {total}</b>\n"
+        if rank > len(top_players):
+            for pos, uid, nickname, elo, level, is_vip in await db_async.get_players_around(callback.from_user.id, 2):
+                if pos <= len(top_players): continue
+                line = f"{pos}. {nickname} — {elo} ELO (Lvl {level})"
+                text += (f"<b>➤ {line}</b>" if uid == callback.from_user.id else line) + "\n"
+    
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="🛡️ К топу кланов", callback_data="top_clans"))
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
 @dp.callback_query(F.data == "top_clans")
 async def top_clans_callback(callback: types.CallbackQuery):
-    top_clans = db.get_top_clans(10)
+    top_clans = await db_async.get_top_clans(10)
     if not top_clans:
         await callback.answer("Список кланов пока пуст.", show_alert=True)
         return
@@ -2331,7 +2626,7 @@ async def top_clans_callback(callback: types.CallbackQuery):
 @dp.message(F.text == "Правила 📖")
 async def rules(message: types.Message):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -2341,7 +2636,7 @@ async def rules(message: types.Message):
                 await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы.")
             return
@@ -2365,26 +2660,61 @@ async def rules(message: types.Message):
     await message.answer(rules_text, reply_markup=main_menu_keyboard(message.from_user.id))
 
 async def main():
-    db.init_db()
+    await db_async.init_db()
     
     # Синхронизация лобби из БД при старте
-    lobby_members = db.get_all_lobby_members()
+    lobby_members = await db_async.get_all_lobby_members()
+    users = await db_async.get_users([uid for _, _, uid in lobby_members])
     for mode, lid, uid in lobby_members:
-        user = db.get_user(uid)
+        user = users.get(uid)
         if user:
             level = db.get_level_by_elo(user[3])
-            lobby_players[mode][lid][uid] = {"nickname": user[2], "level": level, "game_id": user[1]}
+            if uid not in lobby_registry:
+                lobby_registry.add(mode, lid, uid, {"nickname": user[2], "level": level, "game_id": user[1]})
     
     logging.info(f"Восстановлено {len(lobby_members)} участников лобби из БД")
     
+    # Кланы игроков нужны при каждой отрисовке кланового лобби — грузим все членства одним запросом
+    clan_members = await db_async.prime_clan_cache()
+    logging.info(f"Загружено {clan_members} членств в кланах")
+    
+    # Строим рейтинг в памяти заранее, чтобы первый запрос топа не ждал
+    ranked = await db_async.rebuild_leaderboard()
+    logging.info(f"Рейтинг построен: {ranked} игроков")
+    
+    # Матчи, которые шли до перезапуска: снапшот + хвост журнала
+    restored = state_store.restore()
+    for match in active_matches.values():
+        # Снапшоты до перехода на маску банов хранили список оставшихся карт
+        if "maps" in match:
+            pool = pool_for_mode(match.get("mode"))
+            remaining = match.pop("maps")
+            match["bans"] = pool.full & ~sum(1 << pool.index[m] for m in remaining if m in pool.index)
+    for match_num in pending_matches:
+        timers.schedule((match_num, "accept"), ACCEPT_TIMEOUT, check_accept_timeout, match_num)
+    for match_id, match in active_matches.items():
+        # Текущий ход получает полный таймаут заново
+        if match.get("phase") == "ban" and match.get("final_map") is None:
+            timers.schedule((match_id, "ban"), TURN_TIMEOUT, auto_ban_timer, match_id, match["turn"])
+        elif match.get("phase") == "pick" and match.get("available_players"):
+            timers.schedule((match_id, "pick"), TURN_TIMEOUT, auto_pick_timer, match_id, match["turn"])
+    logging.info(f"Восстановлено состояние: {restored} записей, {len(pending_matches)} ожидают подтверждения, {len(active_matches)} активных матчей")
+    state_writer = asyncio.create_task(state_store.run())
+    matchmaking_task = asyncio.create_task(matchmaking_loop())
+    
     # Удаляем вебхук и старые обновления перед началом опроса
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        state_writer.cancel()
+        matchmaking_task.cancel()
+        state_store.close()
 
 @dp.message(F.text == "VIP Shop 💎")
 async def vip_shop_handler(message: types.Message):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -2395,7 +2725,7 @@ async def vip_shop_handler(message: types.Message):
                 except: pass
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             try: await message.answer("❌ Вы заблокированы.")
             except: pass
@@ -2478,7 +2808,7 @@ async def buy_vip_crypto(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "confirm_gold_order")
 async def confirm_gold_order(callback: types.CallbackQuery):
     # Создаем тикет или уведомление админам
-    user = db.get_user(callback.from_user.id)
+    user = await db_async.get_user(callback.from_user.id)
     nickname = user[2] if user else callback.from_user.full_name
     
     for admin_id in ADMINS:
@@ -2507,15 +2837,13 @@ async def successful_payment_handler(message: types.Message):
     if payload == "vip_subscription_30":
         # Выдаем VIP на 30 дней
         vip_until = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
-        db.set_vip_status(message.from_user.id, True, vip_until)
+        await db_async.set_vip_status(message.from_user.id, True, vip_until)
         
         # Обновляем статус в лобби, если пользователь там находится (реальное время)
         user_id = message.from_user.id
-        for m in lobby_players:
-            for lid in lobby_players[m]:
-                if user_id in lobby_players[m][lid]:
-                    lobby_players[m][lid][user_id]["is_vip"] = True
-                    await update_all_lobby_messages(m, lid)
+        seat = lobby_registry.update_player(user_id, is_vip=True)
+        if seat:
+            await update_all_lobby_messages(*seat)
 
         await message.answer(
             f"🎉 **ПОЗДРАВЛЯЕМ!**\n\nВы успешно приобрели VIP статус на 30 дней!\n"
@@ -2571,7 +2899,7 @@ async def process_admin_skin_screenshot(message: types.Message, state: FSMContex
 @dp.callback_query(F.data.startswith("user_skin_listed_"))
 async def user_skin_listed_callback(callback: types.CallbackQuery):
     admin_id = int(callback.data.split("_")[-1])
-    user = db.get_user(callback.from_user.id)
+    user = await db_async.get_user(callback.from_user.id)
     nickname = user[2] if user else callback.from_user.full_name
     
     builder = InlineKeyboardBuilder()
@@ -2599,14 +2927,12 @@ async def admin_give_vip_callback(callback: types.CallbackQuery):
     days = int(parts[4])
     
     vip_until = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-    db.set_vip_status(user_id, True, vip_until)
+    await db_async.set_vip_status(user_id, True, vip_until)
     
     # Обновляем статус в лобби, если пользователь там находится (реальное время)
-    for m in lobby_players:
-        for lid in lobby_players[m]:
-            if user_id in lobby_players[m][lid]:
-                lobby_players[m][lid][user_id]["is_vip"] = True
-                await update_all_lobby_messages(m, lid)
+    seat = lobby_registry.update_player(user_id, is_vip=True)
+    if seat:
+        await update_all_lobby_messages(*seat)
 
     try:
         await bot.send_message(
@@ -2637,7 +2963,7 @@ async def admin_reject_gold_callback(callback: types.CallbackQuery):
 @dp.message(F.text == "Поддержка 🛠️")
 async def support_handler(message: types.Message, state: FSMContext):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -2647,7 +2973,7 @@ async def support_handler(message: types.Message, state: FSMContext):
                 await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы в этом боте.")
             return
@@ -2689,8 +3015,8 @@ async def process_support_message(message: types.Message, state: FSMContext):
         await message.answer("Пожалуйста, отправьте текстовое сообщение или фото.")
         return
         
-    ticket_id = db.create_support_ticket(message.from_user.id, message.text or "[Фото]")
-    user_data = db.get_user(message.from_user.id)
+    ticket_id = await db_async.create_support_ticket(message.from_user.id, message.text or "[Фото]")
+    user_data = await db_async.get_user(message.from_user.id)
     nickname = user_data[2] if user_data else "Неизвестно"
     
     # Инициализируем в памяти
@@ -2719,6 +3045,7 @@ async def process_support_message(message: types.Message, state: FSMContext):
             sent_to_at_least_one = True
         except Exception as e:
             logging.error(f"Failed to send support notification to admin {admin_id}: {e}")
+    state_store.mark("support_requests", ticket_id)
             
     await message.answer(f"✅ Ваше обращение №{ticket_id} успешно отправлено! 📨\nОжидайте ответа администратора.", reply_markup=main_menu_keyboard(message.from_user.id))
     await state.clear()
@@ -2727,7 +3054,7 @@ async def process_support_message(message: types.Message, state: FSMContext):
 async def handle_support_take(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     # Проверка на бан
-    all_users = db.get_all_users()
+    all_users = await db_async.get_all_users()
     user_db_data = next((u for u in all_users if u[0] == callback.from_user.id), None)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         await callback.answer("❌ Вы заблокированы.", show_alert=True)
@@ -2742,7 +3069,7 @@ async def handle_support_take(callback: types.CallbackQuery, state: FSMContext):
     
     # Если в памяти нет (после перезагрузки), пробуем из БД
     if not req:
-        ticket_db = db.get_support_ticket(ticket_id)
+        ticket_db = await db_async.get_support_ticket(ticket_id)
         if not ticket_db:
             await callback.answer("Обращение не найдено.", show_alert=True)
             return
@@ -2766,7 +3093,8 @@ async def handle_support_take(callback: types.CallbackQuery, state: FSMContext):
         return
         
     req["admin_id"] = callback.from_user.id
-    db.update_support_ticket(ticket_id, admin_id=callback.from_user.id)
+    state_store.mark("support_requests", ticket_id)
+    await db_async.update_support_ticket(ticket_id, admin_id=callback.from_user.id)
     
     # Обновляем сообщение у всех админов (если они есть в памяти)
     for admin_id, msg_id in req.get("messages", {}).items():
@@ -2824,7 +3152,7 @@ async def process_admin_reply(message: types.Message, state: FSMContext):
     # Пытаемся получить из памяти или БД
     req = support_requests.get(ticket_id)
     if not req:
-        ticket_db = db.get_support_ticket(ticket_id)
+        ticket_db = await db_async.get_support_ticket(ticket_id)
         if ticket_db:
             uid, text, admin_id, status = ticket_db
             req = {"user_id": uid, "text": text}
@@ -2843,19 +3171,20 @@ async def process_admin_reply(message: types.Message, state: FSMContext):
         )
         await message.answer(f"✅ Ответ отправлен игроку (ID: {user_id})")
         # Помечаем в БД как закрытое
-        db.update_support_ticket(ticket_id, status='closed')
+        await db_async.update_support_ticket(ticket_id, status='closed')
     except:
         await message.answer("❌ Не удалось отправить сообщение игроку (возможно, бот заблокирован).")
         
     # Удаляем обращение из памяти после ответа
     if ticket_id in support_requests:
         del support_requests[ticket_id]
+        state_store.mark("support_requests", ticket_id)
     await state.clear()
 
 @dp.message(F.text == "Настройки ⚙️")
 async def settings_handler(message: types.Message, state: FSMContext):
     # Проверка на бан
-    user_db_data = db.get_user(message.from_user.id)
+    user_db_data = await db_async.get_user(message.from_user.id)
     if user_db_data and len(user_db_data) > 7 and user_db_data[7] == 1:
         # Проверка временного бана
         ban_until_str = user_db_data[8]
@@ -2865,7 +3194,7 @@ async def settings_handler(message: types.Message, state: FSMContext):
                 await message.answer(f"❌ Вы заблокированы до {ban_until_str}.")
                 return
             else:
-                db.set_ban_status(message.from_user.id, False)
+                await db_async.set_ban_status(message.from_user.id, False)
         else:
             await message.answer("❌ Вы заблокированы в этом боте.")
             return
@@ -2873,7 +3202,7 @@ async def settings_handler(message: types.Message, state: FSMContext):
     # Состояние очищается в мидлвари, но на всякий случай
     await state.clear()
     
-    user = db.get_user(message.from_user.id)
+    user = await db_async.get_user(message.from_user.id)
     if not user: return
     
     game_id, nickname = user[1], user[2]
@@ -2919,7 +3248,7 @@ async def process_new_nick(message: types.Message, state: FSMContext):
         await message.answer("Никнейм должен быть текстовым и не длиннее 20 символов.")
         return
     
-    db.update_user_profile(message.from_user.id, nickname=message.text)
+    await db_async.update_user_profile(message.from_user.id, nickname=message.text)
     await message.answer(f"✅ Ваш никнейм успешно изменен на: {message.text}")
     await state.clear()
 
@@ -2952,7 +3281,7 @@ async def process_new_id(message: types.Message, state: FSMContext):
         await message.answer("ID должен состоять только из 8-9 цифр.")
         return
     
-    db.update_user_profile(message.from_user.id, game_id=message.text)
+    await db_async.update_user_profile(message.from_user.id, game_id=message.text)
     await message.answer(f"✅ Ваш игровой ID успешно изменен на: {message.text}")
     await state.clear()
 
@@ -2962,21 +3291,49 @@ async def admin_panel_handler(message: types.Message, state: FSMContext):
     await state.clear()
     if message.from_user.id not in ADMINS: return
     
-    users = db.get_all_users()
+    users = await db_async.get_all_users()
     text = f"👑 АДМИН-ПАНЕЛЬ\nВсего игроков: {len(users)}\n\nВыберите действие:"
     
     builder = InlineKeyboardBuilder()
     builder.row(types.InlineKeyboardButton(text="👥 Список игроков", callback_data="admin_users_list_0"))
+    builder.row(types.InlineKeyboardButton(text="📊 Состояние системы", callback_data="admin_system_stats"))
     # Добавляем другие кнопки, если они были нужны
     
     await message.answer(text, reply_markup=builder.as_markup())
 
+@dp.callback_query(F.data == "admin_system_stats")
+async def admin_system_stats_callback(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMINS: return
+    
+    lines = ["📊 СОСТОЯНИЕ СИСТЕМЫ\n"]
+    pool = db.get_pool_stats()
+    if pool:
+        lines.append(f"БД ({pool['backend']}): соединений {pool['in_use']}/{pool['size']}, ожиданий {pool['waits']} (всего {pool['wait_time']}с, макс {pool['max_wait']}с)")
+    cache_stats = db.get_cache_stats()
+    cache_stats['subscriptions'] = subscription_cache.stats()
+    for name, stats in cache_stats.items():
+        lines.append(f"Кэш {name}: {stats['size']}/{stats['maxsize']}, попаданий {stats['hits']}, промахов {stats['misses']} ({stats['hit_rate']:.0%})")
+    lines.append(f"Таймеры: ожидают {timers.pending()}, сработало {timers.fired}")
+    bins = [f"<{bound}с" for bound in WAIT_BINS] + [f"{WAIT_BINS[-1]}с+"]
+    for mode, mm in matchmaker.stats().items():
+        histogram = ", ".join(f"{label}: {count}" for label, count in zip(bins, mm['wait_histogram']))
+        lines.append(f"Автоподбор {mode}: в очереди {mm['queued']} (дольше всех {mm['longest_wait']}с), собрано матчей {mm['formed']}, ожидание: {histogram}")
+    actors = match_actors.stats()
+    lines.append(f"Матчи: активных очередей {actors['actors']}, событий в очереди {actors['queued']}, обработано {actors['processed']}, ошибок {actors['failed']}")
+    lines.append(f"Состояние: в журнале {state_store.records} записей, снапшотов {state_store.snapshots}, ждут записи {state_store.pending()}")
+    lines.append(f"Обновления лобби: запрошено {lobby_refresher.scheduled + lobby_list_refresher.scheduled}, отрисовано {lobby_refresher.runs + lobby_list_refresher.runs}, зрителей {len(lobby_viewers)}")
+    out = outbox_middleware.stats()
+    lines.append(f"Отправка: в очереди {out['queued']}, отправлено {out['sent']}, задержано {out['throttled']}, flood wait {out['retries']}, потеряно {out['dropped']}")
+    
+    await callback.message.answer("\n".join(lines))
+    await callback.answer()
+
 @dp.callback_query(F.data.startswith("admin_users_list_"))
 async def admin_users_list_callback(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMINS: return
     
     page = int(callback.data.split("_")[-1])
-    users = db.get_all_users()
+    users = await db_async.get_all_users()
     
     # Пагинация по 10 человек
     per_page = 10
@@ -3043,7 +3400,7 @@ async def admin_ban_callback(callback: types.CallbackQuery, state: FSMContext):
     page = int(parts[4])
     
     if duration_type == "0":
-        db.set_ban_status(target_uid, False)
+        await db_async.set_ban_status(target_uid, False)
         try: await bot.send_message(target_uid, "✅ Администратор разблокировал ваш аккаунт.")
         except: pass
         await callback.answer("Пользователь разблокирован!")
@@ -3082,7 +3439,7 @@ async def process_ban_reason(message: types.Message, state: FSMContext):
     page = data['ban_page']
     reason = message.text
     
-    db.set_ban_status(target_uid, True, until=until)
+    await db_async.set_ban_status(target_uid, True, until=until)
     
     try:
         ban_msg = f"🛑 Вы были заблокированы {duration}.\nПричина: {reason}"
@@ -3095,7 +3452,7 @@ async def process_ban_reason(message: types.Message, state: FSMContext):
     await state.clear()
     
     # Возвращаемся к списку
-    users = db.get_all_users()
+    users = await db_async.get_all_users()
     # Эмулируем callback для вызова списка
     class FakeCallback:
         def __init__(self, msg, user):
@@ -3115,7 +3472,7 @@ async def admin_gift_vip_callback(callback: types.CallbackQuery):
     page = int(parts[4])
     
     vip_until = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S")
-    db.set_vip_status(target_uid, True, vip_until)
+    await db_async.set_vip_status(target_uid, True, vip_until)
     
     try:
         await bot.send_message(
@@ -3199,7 +3556,7 @@ async def process_admin_stats_change(callback: types.CallbackQuery):
         wins_change = -1
         msg = "Удалена 1 победа"
         
-    db.adjust_user_stats(target_uid, matches_change, wins_change)
+    await db_async.adjust_user_stats(target_uid, matches_change, wins_change)
     await callback.message.answer(f"✅ Для игрока {target_uid} успешно: {msg}")
     await callback.answer()
 
@@ -3226,10 +3583,10 @@ async def process_admin_elo_change(message: types.Message, state: FSMContext):
     data = await state.get_data()
     target_uid = data['elo_target']
     
-    db.manual_update_elo(target_uid, elo_change)
+    await db_async.manual_update_elo(target_uid, elo_change)
     
     # Получаем обновленные данные
-    user_data = db.get_user(target_uid)
+    user_data = await db_async.get_user(target_uid)
     new_elo = user_data[3]
     new_lvl = user_data[4]
     
@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import logging
+from collections import deque
+
+class MatchActors:
+    # One mailbox per live match. Everything that changes a match (button
+    # callbacks, timer expirations, admin decisions) is queued to its mailbox and
+    # run strictly one after another, so awaits inside a handler can't interleave
+    # with another event of the same match. Different matches run concurrently.
+    # A worker task exists only while its mailbox is non-empty.
+    def __init__(self):
+        self._mailboxes = {} # match_id -> deque of (handler, args, kwargs)
+        self._tasks = set()  # running workers; the loop only keeps weak references
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, match_id, handler, *args, **kwargs):
+        mailbox = self._mailboxes.get(match_id)
+        if mailbox is None:
+            mailbox = self._mailboxes[match_id] = deque()
+            task = asyncio.create_task(self._run(match_id, mailbox))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        mailbox.append((handler, args, kwargs))
+
+    async def _run(self, match_id, mailbox):
+        try:
+            while mailbox:
+                handler, args, kwargs = mailbox.popleft()
+                try:
+                    await handler(*args, **kwargs)
+                except Exception:
+                    self.failed += 1
+                    logging.exception(f"Match {match_id}: {handler.__name__} failed")
+                self.processed += 1
+        finally:
+            # No await between the empty check and here, so nothing can be lost
+            del self._mailboxes[match_id]
+
+    def serialized(self, get_match_id):
+        # Decorator: calls are queued to the mailbox of get_match_id(*args, **kwargs)
+        # and return immediately. functools.wraps keeps the handler signature
+        # visible to aiogram (it unwraps to pick the kwargs to pass).
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(*args, **kwargs):
+                self.submit(get_match_id(*args, **kwargs), handler, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {
+            'actors': len(self._mailboxes),
+            'queued': sum(len(mailbox) for mailbox in self._mailboxes.values()),
+            'processed': self.processed,
+            'failed': self.failed,
+        }
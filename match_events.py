@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+
+# Change feed behind the web match room's event stream. Every write to a match
+# bumps matches.version; one watcher thread per process checks the versions of
+# all watched matches with a single query and, when one moves, loads that match
+# once and wakes every stream subscribed to it. A match nobody changes costs one
+# row in the version query, however many tabs have it open.
+
+MATCH_EVENTS_POLL = float(os.environ.get('MATCH_EVENTS_POLL', 0.5))           # seconds between version checks
+MATCH_EVENTS_HEARTBEAT = float(os.environ.get('MATCH_EVENTS_HEARTBEAT', 15))  # keep-alive for quiet streams
+# Each open stream holds a web worker thread (gthread, WEB_THREADS per process): past
+# MATCH_EVENTS_MAX_STREAMS the page is refused and polls instead, and a stream ends
+# after MATCH_EVENTS_MAX_AGE seconds (the browser reconnects) so threads turn over
+MATCH_EVENTS_MAX_STREAMS = int(os.environ.get('MATCH_EVENTS_MAX_STREAMS', 16))
+MATCH_EVENTS_MAX_AGE = float(os.environ.get('MATCH_EVENTS_MAX_AGE', 300))
+
+class MatchFeed:
+    # Latest state of one match and its recent chat, shared by all its subscribers
+    def __init__(self, match_id, lock):
+        self.match_id = match_id
+        self.version = None
+        self.state = None # None once the match is gone
+        self.chat = []
+        self.trimmed_id = 0 # newest chat id dropped from `chat` by chat_history
+        self.subscribers = 0
+        self.changed = threading.Condition(lock)
+
+    @property
+    def last_chat_id(self):
+        return self.chat[-1]['id'] if self.chat else 0
+
+    def chat_after(self, chat_id):
+        # Chat ids only grow, so walk back from the end
+        i = len(self.chat)
+        while i and self.chat[i - 1]['id'] > chat_id:
+            i -= 1
+        return self.chat[i:]
+
+class MatchEventHub:
+    def __init__(self, get_versions, load, poll_interval=MATCH_EVENTS_POLL, chat_history=None):
+        # get_versions([match_id]) -> {match_id: version}
+        # load(match_id, after_chat_id) -> (version, state, chat messages newer than after_chat_id),
+        # or None if the match doesn't exist. Chat messages are dicts with an 'id'.
+        # chat_history: how many of the latest chat messages a feed keeps (None: all).
+        self.get_versions = get_versions
+        self.load = load
+        self.poll_interval = poll_interval
+        self.chat_history = chat_history
+        self._feeds = {} # match_id -> MatchFeed
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.checks = 0
+        self.loads = 0
+        self.catchups = 0
+
+    def subscribe(self, match_id):
+        # Returns the match's feed, loaded, or None if there is no such match
+        with self._lock:
+            feed = self._feeds.get(match_id)
+            if feed is None:
+                feed = self._feeds[match_id] = MatchFeed(match_id, self._lock)
+            feed.subscribers += 1
+            loaded = feed.version is not None
+        if not loaded:
+            self._refresh(match_id, feed)
+        if feed.state is None:
+            self.unsubscribe(match_id, feed)
+            return None
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='match-events', daemon=True)
+                self._thread.start()
+        return feed
+
+    def unsubscribe(self, match_id, feed):
+        with self._lock:
+            feed.subscribers -= 1
+            if feed.subscribers <= 0 and self._feeds.get(match_id) is feed:
+                del self._feeds[match_id]
+
+    def wait(self, feed, version, timeout):
+        # True once the feed has moved past `version`, False on timeout
+        with feed.changed:
+            return feed.changed.wait_for(lambda: feed.version != version, timeout)
+
+    def read(self, feed, after_chat_id=0):
+        # (version, state, chat messages newer than after_chat_id)
+        with self._lock:
+            version, state = feed.version, feed.state
+            if not after_chat_id or after_chat_id >= feed.trimmed_id:
+                return version, state, feed.chat_after(after_chat_id)
+            self.catchups += 1
+        # The reader fell further behind than chat_history keeps: its gap comes
+        # from the database instead of being skipped
+        result = self.load(feed.match_id, after_chat_id)
+        return version, state, result[2] if result else []
+
+    def poke(self):
+        # Check versions now instead of at the next tick; called after local writes
+        self._wakeup.set()
+
+    def _refresh(self, match_id, feed):
+        with self._lock:
+            after = feed.last_chat_id
+        result = self.load(match_id, after)
+        with self._lock:
+            self.loads += 1
+            if result is None:
+                feed.version, feed.state = -1, None
+            else:
+                version, state, chat = result
+                if feed.version is not None and version < feed.version:
+                    return # a slower concurrent load, already superseded
+                last = feed.last_chat_id
+                feed.chat.extend(message for message in chat if message['id'] > last)
+                if self.chat_history is not None and len(feed.chat) > self.chat_history:
+                    feed.trimmed_id = feed.chat[-self.chat_history - 1]['id']
+                    del feed.chat[:-self.chat_history]
+                feed.version, feed.state = version, state
+            feed.changed.notify_all()
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                if not self._feeds:
+                    self._thread = None
+                    return
+                feeds = dict(self._feeds)
+            try:
+                versions = self.get_versions(list(feeds))
+                self.checks += 1
+                for match_id, feed in feeds.items():
+                    if feed.state is not None and versions.get(match_id, -1) != feed.version:
+                        self._refresh(match_id, feed)
+            except Exception as e:
+                logging.error(f"Match events watcher failed: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'matches': len(self._feeds),
+                'subscribers': sum(feed.subscribers for feed in self._feeds.values()),
+                'checks': self.checks,
+                'loads': self.loads,
+                'catchups': self.catchups,
+            }
@@ -0,0 +1,104 @@
+import os
+import random
+import time
+
+import db
+from cache import TTLCache
+from veto import Veto
+
+# Hot cache of the web matches' veto state machines (veto.Veto) with
+# write-through to the matches table. A match is loaded once, row and players
+# in turn order together; after that whose turn it is, whether a map is still in
+# play and what comes next are answered from memory. Every transition is written
+# with a compare-and-set on veto_bans (db.save_vetoes), so when another worker
+# or the sweeper moved first the write misses, the entry is reloaded and the
+# move is checked again.
+
+MATCH_STATE_CACHE_SIZE = int(os.environ.get('MATCH_STATE_CACHE_SIZE', 10000))
+MATCH_STATE_TTL = float(os.environ.get('MATCH_STATE_TTL', 3600))
+
+class MatchStates:
+    def __init__(self, pool, on_change=None, clock=time.time, maxsize=MATCH_STATE_CACHE_SIZE, ttl=MATCH_STATE_TTL):
+        self.pool = pool # veto.MapPool
+        self.on_change = on_change # called after a transition was written
+        self.clock = clock
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl) # match_id -> Veto
+        self.loads = 0
+        self.conflicts = 0
+
+    def get(self, match_id):
+        # The match's Veto, or None if it isn't an active match with players.
+        # Cached entries are never mutated, transitions swap in a copy.
+        veto = self._cache.get(match_id)
+        return veto if veto is not None else self.load(match_id)
+
+    def load(self, match_id):
+        self.loads += 1
+        state = db.get_veto_state(match_id)
+        if state is None or not state[2]:
+            self._cache.pop(match_id)
+            return None
+        bans, current_turn, player_ids = state
+        if bans is None and db.start_veto(match_id, player_ids[0], int(self.clock())) and self.on_change:
+            self.on_change()
+        veto = Veto.resume(self.pool, player_ids, bans, current_turn)
+        self._cache.set(match_id, veto)
+        return veto
+
+    def discard(self, match_id):
+        self._cache.pop(match_id)
+
+    def ban(self, match_id, user_id, map_name):
+        # A player's ban. Returns None once it is written, else why it was refused.
+        i = self.pool.index.get(map_name, -1)
+        veto, fresh = self.get(match_id), False
+        # Bans only grow, so every missed write means the stored veto moved on
+        # and this ends after at most one retry per map
+        while True:
+            error = veto.check(user_id, i) if veto else 'Match not active'
+            if error is None:
+                moved = veto.copy()
+                actions = moved.ban(i, user_id)
+                if db.save_vetoes([(match_id, veto.bans, moved.bans, moved.picked, moved.current, actions)], int(self.clock())):
+                    self._cache.set(match_id, moved)
+                    if self.on_change:
+                        self.on_change()
+                    return None
+                self.conflicts += 1
+            elif fresh:
+                return error
+            # A stale entry can refuse a move that is valid by now: check again
+            veto, fresh = self.load(match_id), True
+
+    def time_out(self, overdue, now, rng=random):
+        # Auto-bans for overdue turns, rows from db.get_overdue_vetoes. The rows
+        # are newer than the cache, so they are used as they are; returns the ids
+        # of the matches that were advanced.
+        updates, moved = [], {}
+        for match_id, bans, current_turn, player_ids in overdue:
+            if not player_ids:
+                continue
+            veto = Veto.resume(self.pool, player_ids, bans, current_turn)
+            if veto.picked:
+                continue
+            old_bans = veto.bans
+            actions = veto.timeout(rng=rng)
+            moved[match_id] = veto
+            updates.append((match_id, old_bans, veto.bans, veto.picked, veto.current, actions))
+        applied = db.save_vetoes(updates, now) if updates else []
+        for match_id in moved:
+            if match_id in applied:
+                self._cache.set(match_id, moved[match_id])
+            else:
+                self._cache.pop(match_id)
+        if applied and self.on_change:
+            self.on_change()
+        return applied
+
+    def stats(self):
+        return {
+            'cached': len(self._cache),
+            'hits': self._cache.hits,
+            'loads': self.loads,
+            'conflicts': self.conflicts,
+        }
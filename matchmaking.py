@@ -0,0 +1,167 @@
+import os
+import time
+
+from leaderboard import ELO_MAX, ELO_MIN, FenwickTree
+
+# Automatic ELO-based queue. Players are bucketed by rating; a Fenwick tree over
+# the buckets counts who is inside an ELO window in O(log n), so an enqueue that
+# can't form a match is rejected without scanning the queue. The window starts
+# at MM_BASE_WINDOW and widens by MM_WIDEN_RATE per second of waiting.
+
+MM_BUCKET = int(os.environ.get('MM_BUCKET', 25))                   # ELO points per bucket
+MM_BASE_WINDOW = int(os.environ.get('MM_BASE_WINDOW', 100))        # +-ELO accepted right away
+MM_WIDEN_RATE = float(os.environ.get('MM_WIDEN_RATE', 5))          # +ELO per second in queue
+MM_MAX_WINDOW = int(os.environ.get('MM_MAX_WINDOW', 1000))
+
+WAIT_BINS = (10, 30, 60, 120, 300) # upper bounds in seconds, the last bin is open-ended
+
+class MatchmakingQueue:
+    # One mode. enqueue()/tick() return groups of `size` players as
+    # [(user_id, data), ...], oldest anchor first; grouped players leave the queue.
+    def __init__(self, size, elo_min=ELO_MIN, elo_max=ELO_MAX, bucket=MM_BUCKET, base_window=MM_BASE_WINDOW,
+                 widen_rate=MM_WIDEN_RATE, max_window=MM_MAX_WINDOW, clock=time.monotonic):
+        self.size = size
+        self.elo_min = elo_min
+        self.elo_max = elo_max
+        self.bucket = bucket
+        self.base_window = base_window
+        self.widen_rate = widen_rate
+        self.max_window = max_window
+        self.clock = clock
+        self._tree = FenwickTree((elo_max - elo_min) // bucket + 1)
+        self._buckets = {} # bucket index -> {user_id: None}, in join order
+        self._players = {} # user_id -> (elo, data, joined_at), in join order
+        self.formed = 0
+        self.wait_histogram = [0] * (len(WAIT_BINS) + 1)
+
+    def _index(self, elo):
+        elo = min(max(int(elo), self.elo_min), self.elo_max)
+        return (elo - self.elo_min) // self.bucket + 1
+
+    def window(self, user_id, now=None):
+        now = self.clock() if now is None else now
+        waited = now - self._players[user_id][2]
+        return min(self.max_window, self.base_window + self.widen_rate * waited)
+
+    def enqueue(self, user_id, elo, data):
+        if user_id in self._players:
+            raise ValueError(f"user {user_id} is already queued")
+        elo = int(elo)
+        self._players[user_id] = (elo, data, self.clock())
+        index = self._index(elo)
+        self._buckets.setdefault(index, {})[user_id] = None
+        self._tree.add(index, 1)
+        return self._try(user_id, self.clock())
+
+    def remove(self, user_id):
+        # Returns the player's data, or None if not queued
+        player = self._players.pop(user_id, None)
+        if player is None:
+            return None
+        index = self._index(player[0])
+        bucket = self._buckets[index]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[index]
+        self._tree.add(index, -1)
+        return player[1]
+
+    def tick(self):
+        # Retries everyone with their widened windows, longest wait first
+        now = self.clock()
+        groups = []
+        for user_id in list(self._players):
+            if user_id in self._players:
+                group = self._try(user_id, now)
+                if group:
+                    groups.append(group)
+        return groups
+
+    def _try(self, anchor, now):
+        elo = self._players[anchor][0]
+        window = self.window(anchor, now)
+        lo, hi = self._index(elo - window), self._index(elo + window)
+        if self._tree.prefix(hi) - self._tree.prefix(lo - 1) < self.size:
+            return None
+
+        # Walk buckets outwards from the anchor; a bucket `dist` away is at least
+        # (dist - 1) * bucket points off, so stop once that can't beat the picks
+        center = self._index(elo)
+        need = self.size - 1
+        picked = [] # (elo diff, joined_at, user_id)
+        for dist in range(max(center - lo, hi - center) + 1):
+            if len(picked) >= need:
+                picked.sort()
+                del picked[need:]
+                if (dist - 1) * self.bucket > picked[-1][0]:
+                    break
+            for index in {center - dist, center + dist}:
+                if not lo <= index <= hi:
+                    continue
+                for user_id in self._buckets.get(index, ()):
+                    p_elo, _, joined_at = self._players[user_id]
+                    diff = abs(p_elo - elo)
+                    if user_id != anchor and diff <= window:
+                        picked.append((diff, joined_at, user_id))
+        if len(picked) < need:
+            return None
+        picked.sort()
+
+        group = []
+        for user_id in [anchor] + [uid for _, _, uid in picked[:need]]:
+            joined_at = self._players[user_id][2]
+            group.append((user_id, self.remove(user_id)))
+            self._record_wait(now - joined_at)
+        self.formed += 1
+        return group
+
+    def _record_wait(self, waited):
+        for i, bound in enumerate(WAIT_BINS):
+            if waited < bound:
+                self.wait_histogram[i] += 1
+                return
+        self.wait_histogram[-1] += 1
+
+    def __contains__(self, user_id):
+        return user_id in self._players
+
+    def __len__(self):
+        return len(self._players)
+
+    def stats(self):
+        now = self.clock()
+        oldest = next(iter(self._players.values()), None)
+        return {
+            'queued': len(self._players),
+            'formed': self.formed,
+            'longest_wait': int(now - oldest[2]) if oldest else 0,
+            'wait_histogram': list(self.wait_histogram),
+        }
+
+class Matchmaker:
+    # Queues of all modes; a player can wait in one of them at a time
+    def __init__(self, sizes, **options):
+        self.queues = {mode: MatchmakingQueue(size, **options) for mode, size in sizes.items()}
+
+    def locate(self, user_id):
+        return next((mode for mode, queue in self.queues.items() if user_id in queue), None)
+
+    def join(self, mode, user_id, elo, data):
+        current = self.locate(user_id)
+        if current is not None:
+            raise ValueError(f"user {user_id} is already queued for {current}")
+        return self.queues[mode].enqueue(user_id, elo, data)
+
+    def leave(self, user_id):
+        # Returns the mode the player left, or None
+        mode = self.locate(user_id)
+        if mode is not None:
+            self.queues[mode].remove(user_id)
+        return mode
+
+    def poll(self):
+        # [(mode, group), ...] formed thanks to widened windows
+        return [(mode, group) for mode, queue in self.queues.items() for group in queue.tick()]
+
+    def stats(self):
+        return {mode: queue.stats() for mode, queue in self.queues.items()}
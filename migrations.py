@@ -0,0 +1,431 @@
+import time
+
+import db
+from db import execute_query
+
+# Versioned schema migrations.
+# Each migration runs once; applied versions are recorded in schema_version.
+# Add new migrations at the end of the file with the next version number.
+
+MIGRATIONS = []
+
+# Arbitrary constant for pg_advisory_xact_lock, shared by every worker
+MIGRATION_LOCK_ID = 7301450
+
+def migration(version, name):
+    def decorator(func):
+        if MIGRATIONS and MIGRATIONS[-1][0] >= version:
+            raise ValueError(f"Migration {version} ({name}) is out of order")
+        MIGRATIONS.append((version, name, func))
+        return func
+    return decorator
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def current_version(conn):
+    cursor = conn.cursor()
+    try:
+        execute_query(cursor, 'SELECT MAX(version) FROM schema_version')
+        row = cursor.fetchone()
+        return (row[0] or 0) if row else 0
+    except Exception:
+        # No schema_version table yet (fresh or pre-migration database)
+        conn.rollback()
+        return 0
+
+def migrate(conn):
+    # Warm start: one query, nothing else
+    if current_version(conn) >= latest_version():
+        return []
+
+    conn.commit()
+    cursor = conn.cursor()
+    # Take the lock before looking at the version again, so concurrent workers
+    # wait for each other instead of running the same ALTERs twice
+    if db.IS_POSTGRES:
+        execute_query(cursor, 'SELECT pg_advisory_xact_lock(?)', (MIGRATION_LOCK_ID,))
+    else:
+        cursor.execute('BEGIN IMMEDIATE')
+
+    try:
+        execute_query(cursor, '''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at INTEGER
+            )
+        ''')
+        execute_query(cursor, 'SELECT MAX(version) FROM schema_version')
+        version = cursor.fetchone()[0] or 0
+
+        applied = []
+        for number, name, func in MIGRATIONS:
+            if number <= version:
+                continue
+            print(f"Applying migration {number}: {name}")
+            func(cursor)
+            execute_query(cursor, 'INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)', (number, name, int(time.time())))
+            applied.append(number)
+        conn.commit()
+        return applied
+    except Exception as e:
+        conn.rollback()
+        print(f"Migration failed: {e}")
+        raise
+
+# Helpers
+
+def create_table(cursor, sql):
+    if db.IS_POSTGRES:
+        sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
+        sql = sql.replace('DATETIME', 'TIMESTAMP')
+    execute_query(cursor, sql)
+
+def add_column(cursor, table, column, definition):
+    if db.IS_POSTGRES:
+        definition = definition.replace('DATETIME', 'TIMESTAMP')
+        execute_query(cursor, f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [col[1] for col in cursor.fetchall()]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Migrations
+
+@migration(1, 'initial_schema')
+def initial_schema(cursor):
+    # Users
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            game_id TEXT,
+            nickname TEXT,
+            elo INTEGER DEFAULT 1000,
+            level INTEGER DEFAULT 4,
+            matches INTEGER DEFAULT 0,
+            wins INTEGER DEFAULT 0,
+            is_admin INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Matches
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS matches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT DEFAULT 'active',
+            mode TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Match Players
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS match_players (
+            match_id INTEGER,
+            user_id BIGINT,
+            accepted INTEGER DEFAULT 0,
+            PRIMARY KEY (match_id, user_id)
+        )
+    ''')
+
+    # Support Tickets
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS support_tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id BIGINT,
+            text TEXT,
+            status TEXT DEFAULT 'open',
+            admin_id BIGINT
+        )
+    ''')
+
+    # Lobby Members
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS lobby_members (
+            mode TEXT,
+            lobby_id INTEGER,
+            user_id BIGINT,
+            PRIMARY KEY (mode, lobby_id, user_id)
+        )
+    ''')
+
+    # Clans
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS clans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tag TEXT UNIQUE,
+            name TEXT,
+            owner_id BIGINT,
+            level INTEGER DEFAULT 1,
+            exp INTEGER DEFAULT 0,
+            matches_played INTEGER DEFAULT 0,
+            matches_won INTEGER DEFAULT 0,
+            clan_elo INTEGER DEFAULT 1000,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            logo_url TEXT
+        )
+    ''')
+
+    # Clan Members
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS clan_members (
+            clan_id INTEGER,
+            user_id BIGINT UNIQUE,
+            role TEXT DEFAULT 'member',
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (clan_id, user_id),
+            FOREIGN KEY (clan_id) REFERENCES clans(id)
+        )
+    ''')
+
+    # Polls
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS polls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS poll_options (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            poll_id INTEGER,
+            option_text TEXT,
+            FOREIGN KEY (poll_id) REFERENCES polls(id)
+        )
+    ''')
+
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS poll_votes (
+            poll_id INTEGER,
+            option_id INTEGER,
+            user_id BIGINT,
+            PRIMARY KEY (poll_id, user_id),
+            FOREIGN KEY (poll_id) REFERENCES polls(id),
+            FOREIGN KEY (option_id) REFERENCES poll_options(id)
+        )
+    ''')
+
+    # Clan Matchmaking Queue
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS clan_matchmaking_queue (
+            clan_id INTEGER PRIMARY KEY,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (clan_id) REFERENCES clans(id)
+        )
+    ''')
+
+    # Clan Matches
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS clan_matches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            clan1_id INTEGER,
+            clan2_id INTEGER,
+            winner_clan_id INTEGER,
+            status TEXT DEFAULT 'active',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (clan1_id) REFERENCES clans(id),
+            FOREIGN KEY (clan2_id) REFERENCES clans(id)
+        )
+    ''')
+
+    # Matchmaking Queue
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS matchmaking_queue (
+            user_id BIGINT PRIMARY KEY,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Match Stats
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS match_stats (
+            match_id INTEGER,
+            user_id BIGINT,
+            kills INTEGER DEFAULT 0,
+            deaths INTEGER DEFAULT 0,
+            headshots INTEGER DEFAULT 0,
+            mvps INTEGER DEFAULT 0,
+            score INTEGER DEFAULT 0,
+            PRIMARY KEY (match_id, user_id)
+        )
+    ''')
+
+    # Match Chat
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS match_chat (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            match_id INTEGER,
+            user_id BIGINT,
+            message TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Friends
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id BIGINT,
+            friend_id BIGINT,
+            status TEXT DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, friend_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (friend_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Columns added over time (previously ALTERed on every start, plus
+    # fix_db_schema.py and migration_ban_system.py)
+    add_column(cursor, 'users', 'level', 'INTEGER DEFAULT 4')
+    add_column(cursor, 'users', 'is_banned', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'users', 'ban_until', 'DATETIME')
+    add_column(cursor, 'users', 'missed_games', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'users', 'is_vip', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'users', 'vip_until', 'DATETIME')
+    add_column(cursor, 'users', 'is_admin', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'users', 'avatar_url', 'TEXT')
+    add_column(cursor, 'users', 'steam_url', 'TEXT')
+    add_column(cursor, 'users', 'bio', 'TEXT')
+    add_column(cursor, 'users', 'warnings', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'users', 'ban_expiration', 'INTEGER DEFAULT 0')
+
+    add_column(cursor, 'support_tickets', 'admin_id', 'BIGINT')
+
+    add_column(cursor, 'matches', 'mode', 'TEXT')
+    add_column(cursor, 'matches', 'created_at', 'DATETIME')
+    add_column(cursor, 'matches', 'team1_score', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'matches', 'team2_score', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'matches', 'winner_team', 'INTEGER')
+    add_column(cursor, 'matches', 'veto_status', 'TEXT')
+    add_column(cursor, 'matches', 'current_veto_turn', 'BIGINT')
+    add_column(cursor, 'matches', 'map_picked', 'TEXT')
+    add_column(cursor, 'matches', 'last_action_time', 'INTEGER DEFAULT 0')
+
+    add_column(cursor, 'match_players', 'team', 'INTEGER DEFAULT 1')
+    add_column(cursor, 'match_players', 'is_annulled', 'INTEGER DEFAULT 0')
+    add_column(cursor, 'match_players', 'has_left', 'INTEGER DEFAULT 0')
+
+    add_column(cursor, 'clans', 'logo_url', 'TEXT')
+    add_column(cursor, 'clans', 'clan_elo', 'INTEGER DEFAULT 1000')
+
+@migration(2, 'default_level_for_new_players')
+def default_level_for_new_players(cursor):
+    # Used to run as a full-table UPDATE on every start
+    execute_query(cursor, 'UPDATE users SET level = 4 WHERE elo = 1000')
+
+@migration(3, 'promote_initial_admin')
+def promote_initial_admin(cursor):
+    # From migration.py
+    execute_query(cursor, 'UPDATE users SET is_admin = 1 WHERE user_id = ?', (8565678796,))
+
+@migration(4, 'hot_path_indexes')
+def hot_path_indexes(cursor):
+    # match history / active match lookups by player (/play, /matches, profile)
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_match_players_user_id ON match_players (user_id)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_matches_status_created_at ON matches (status, created_at)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_matches_created_at ON matches (created_at)')
+    # leaderboards and user lookups
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_users_elo ON users (elo)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_users_game_id ON users (game_id)')
+    # incoming friend requests / friend lists
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_friends_friend_id_status ON friends (friend_id, status)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_match_chat_match_id_created_at ON match_chat (match_id, created_at)')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_lobby_members_user_id ON lobby_members (user_id)')
+
+@migration(5, 'match_player_results')
+def match_player_results(cursor):
+    # Per-player outcome of settled matches, so ratings can be replayed from history
+    add_column(cursor, 'match_players', 'is_win', 'INTEGER')
+    add_column(cursor, 'match_players', 'elo_change', 'INTEGER')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_match_players_match_id ON match_players (match_id)')
+
+@migration(6, 'match_versions')
+def match_versions(cursor):
+    # Bumped on every write to a match, its players or its chat; the web match
+    # room streams updates when it moves instead of re-reading on every poll
+    add_column(cursor, 'matches', 'version', 'INTEGER DEFAULT 0')
+
+@migration(7, 'veto_deadline_index')
+def veto_deadline_index(cursor):
+    # Background veto sweeper: active matches whose ban turn has run out
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_matches_status_last_action_time ON matches (status, last_action_time)')
+
+@migration(8, 'match_chat_cursor_index')
+def match_chat_cursor_index(cursor):
+    # Incremental match chat: WHERE match_id = ? AND id > ? ORDER BY id
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_match_chat_match_id_id ON match_chat (match_id, id)')
+
+@migration(9, 'veto_bans')
+def veto_bans(cursor):
+    # Map veto as a bitmask over veto.MAP_POOL instead of veto_status JSON,
+    # plus a log of every ban and the final pick (auto bans carry the id of the
+    # player whose turn ran out; only pick rows have a NULL user_id)
+    import json
+    import veto
+    add_column(cursor, 'matches', 'veto_bans', 'INTEGER')
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS veto_actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            match_id INTEGER,
+            user_id BIGINT,
+            map_name TEXT,
+            action TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_veto_actions_match_id ON veto_actions (match_id)')
+
+    pool = veto.POOLS['web']
+    execute_query(cursor, 'SELECT id, veto_status FROM matches WHERE veto_status IS NOT NULL')
+    for match_id, veto_status in cursor.fetchall():
+        try:
+            status = json.loads(veto_status) if isinstance(veto_status, str) else veto_status
+        except ValueError:
+            status = {}
+        execute_query(cursor, 'UPDATE matches SET veto_bans = ? WHERE id = ?', (pool.from_status(status), match_id))
+
+@migration(10, 'elo_version')
+def elo_version(cursor):
+    # Change marker for the in-memory leaderboards: every ELO write stamps its
+    # rows with MAX(elo_version) + 1, so one indexed MAX tells a process whether
+    # anyone changed a rating since it built its tree
+    add_column(cursor, 'users', 'elo_version', 'BIGINT DEFAULT 0')
+    execute_query(cursor, 'CREATE INDEX IF NOT EXISTS idx_users_elo_version ON users (elo_version)')
+
+@migration(11, 'veto_timer_backfill')
+def veto_timer_backfill(cursor):
+    # Ban timers are started where the veto opens (match creation, db.start_veto);
+    # active matches from before that get theirs started once here, so the
+    # sweeper never has to write to find them. 0 is the schema default, not a time
+    import time
+    execute_query(cursor, '''
+        UPDATE matches SET last_action_time = ?
+        WHERE status = 'active' AND (last_action_time IS NULL OR last_action_time = 0) AND map_picked IS NULL
+    ''', (int(time.time()),))
+
+@migration(12, 'elo_marker')
+def elo_marker(cursor):
+    # Two writers could read the same MAX(elo_version) and stamp the same
+    # version; the marker is now one row whose UPDATE serializes them
+    create_table(cursor, '''
+        CREATE TABLE IF NOT EXISTS elo_marker (
+            id INTEGER PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+    ''')
+    execute_query(cursor, 'SELECT COUNT(*) FROM elo_marker')
+    if cursor.fetchone()[0] == 0:
+        execute_query(cursor, 'INSERT INTO elo_marker (id, version) SELECT 1, COALESCE(MAX(elo_version), 0) FROM users')
+    execute_query(cursor, 'DROP INDEX IF EXISTS idx_users_elo_version')
+
+if __name__ == '__main__':
+    db.init_db()
+    conn = db.get_db_connection()
+    print(f"Schema version: {current_version(conn)} (latest {latest_version()})")
+    conn.close()
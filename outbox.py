@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, DeleteMessage, EditMessageCaption, EditMessageReplyMarkup, EditMessageText,
+    ForwardMessage, SendDocument, SendInvoice, SendMediaGroup, SendMessage, SendPhoto,
+)
+
+# Outbound scheduler for every message the bot sends, edits or deletes.
+# Installed as a session middleware, so plain `await bot.send_message(...)` goes
+# through it: per-chat and global token buckets, priority ordering when the
+# global budget is short, RetryAfter backoff and a cap on concurrent requests.
+
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', 25))                  # messages/s for the whole bot
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))         # messages/s per chat
+OUTBOX_CHAT_BURST = int(os.environ.get('OUTBOX_CHAT_BURST', 3))
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 10))
+OUTBOX_MAX_RETRIES = int(os.environ.get('OUTBOX_MAX_RETRIES', 3))
+
+# Priority classes, lower is sent first
+HIGH = 0    # match found / accept prompts, match start
+NORMAL = 1  # replies and notifications
+LOW = 2     # lobby refreshes and other edits
+
+_EDIT_METHODS = (EditMessageText, EditMessageReplyMarkup, EditMessageCaption)
+_LIMITED_METHODS = _EDIT_METHODS + (
+    SendMessage, SendPhoto, SendDocument, SendMediaGroup, SendInvoice, CopyMessage, ForwardMessage, DeleteMessage,
+)
+
+_priority = contextvars.ContextVar('outbox_priority', default=None)
+
+@contextmanager
+def priority(level):
+    # with outbox.priority(outbox.HIGH): await bot.send_message(...)
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        # Takes a token (possibly borrowing from the future) and returns how long
+        # the caller has to wait before using it. Callers queue up in call order.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        # Nothing goes out for `seconds` (Telegram's retry_after)
+        self.reserve()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class OutboxMiddleware(BaseRequestMiddleware):
+    def __init__(self, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                 concurrency=OUTBOX_CONCURRENCY, max_retries=OUTBOX_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate, max(1, int(rate)))
+        self._chats = {} # chat_id -> TokenBucket
+        self._queue = [] # [priority, seq, future]
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._semaphore = None
+        self._concurrency = concurrency
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+        self.throttled = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _dispatch(self):
+        # Hands out global tokens to the highest-priority waiter
+        while self._queue:
+            delay = self._global.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            while self._queue:
+                _, _, future = heapq.heappop(self._queue)
+                if not future.done():
+                    future.set_result(None)
+                    break
+        self._dispatcher = None
+
+    async def _acquire(self, chat_id, level):
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay:
+            self.throttled += 1
+            await asyncio.sleep(delay)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, [level, next(self._seq), future])
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or not isinstance(method, _LIMITED_METHODS):
+            # getUpdates, answerCallbackQuery, getChatMember, inline edits... go straight through
+            return await make_request(bot, method)
+
+        level = _priority.get()
+        if level is None:
+            level = LOW if isinstance(method, _EDIT_METHODS) else NORMAL
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrency)
+
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, level)
+            try:
+                async with self._semaphore:
+                    response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.retries += 1
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                if attempt > self.max_retries:
+                    self.dropped += 1
+                    logging.warning(f"Outbox: {type(method).__name__} to {chat_id} dropped after {attempt} flood waits")
+                    raise
+                logging.info(f"Outbox: flood wait {e.retry_after}s for chat {chat_id}")
+
+    def stats(self):
+        return {
+            'queued': sum(1 for _, _, future in self._queue if not future.done()),
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Team Elo: each team is rated by the average ELO of its players and every
+# player of a team gets the same, zero-sum delta. K is chosen per mode so that
+# an even match moves the same amount the old fixed gains did on average.
+
+BASE_RATING = 1000
+K_FACTORS = {"1x1": 20, "2x2": 50, "5x5": 60, "2x2_clan": 60}
+DEFAULT_K = 50 # web matches used a fixed +-25
+
+def k_factor(mode):
+    return K_FACTORS.get(mode, DEFAULT_K)
+
+def expected_score(rating, opponent):
+    return 1 / (1 + 10 ** ((opponent - rating) / 400))
+
+def win_gain(winners, losers, mode=None):
+    # ELO the winning team gains (and the losing team loses), from player ratings
+    expected = expected_score(sum(winners) / len(winners), sum(losers) / len(losers))
+    return int(round(k_factor(mode) * (1 - expected)))
+
+def match_gains(team_a, team_b, mode=None):
+    # (gain if A wins, gain if B wins); the two always add up to K
+    return win_gain(team_a, team_b, mode), win_gain(team_b, team_a, mode)
+
+def replay(history, initial=None, base=BASE_RATING):
+    # Recomputes ratings from scratch. history: [(mode, winners, losers), ...]
+    # in play order, teams as lists of user ids. Returns {user_id: rating}.
+    #
+    # Matches are grouped into layers: a match goes one layer after the last
+    # match of any of its players, so no player appears twice in a layer and
+    # everything a match depends on is in earlier layers. Each layer is then a
+    # single NumPy step, with results identical to replaying one by one.
+    initial = initial or {}
+    index = {}
+    entry_match, entry_player, entry_win = [], [], []
+    match_layer, match_k = [], []
+    last_layer = {}
+    for m, (mode, winners, losers) in enumerate(history):
+        players = list(winners) + list(losers)
+        layer = max((last_layer.get(uid, -1) for uid in players), default=-1) + 1
+        for uid in players:
+            last_layer[uid] = layer
+            entry_match.append(m)
+            entry_player.append(index.setdefault(uid, len(index)))
+        entry_win.extend([1] * len(winners) + [0] * len(losers))
+        match_layer.append(layer)
+        match_k.append(k_factor(mode))
+
+    ratings = np.array([initial.get(uid, base) for uid in index], dtype=np.float64)
+    if not history:
+        return {uid: int(ratings[i]) for uid, i in index.items()}
+
+    entry_match = np.array(entry_match)
+    entry_player = np.array(entry_player)
+    entry_win = np.array(entry_win)
+    entry_layer = np.array(match_layer)[entry_match]
+    match_k = np.array(match_k, dtype=np.float64)
+
+    order = np.argsort(entry_layer, kind='stable')
+    bounds = np.searchsorted(entry_layer[order], np.arange(entry_layer.max() + 2))
+    for layer in range(len(bounds) - 1):
+        entries = order[bounds[layer]:bounds[layer + 1]]
+        players = entry_player[entries]
+        wins = entry_win[entries]
+        matches, local = np.unique(entry_match[entries], return_inverse=True)
+        slots = 2 * local + wins # (match, team) within the layer: odd slots are winners
+        team_sum = np.bincount(slots, weights=ratings[players], minlength=2 * len(matches))
+        team_avg = team_sum / np.maximum(np.bincount(slots, minlength=2 * len(matches)), 1)
+        expected = 1 / (1 + 10 ** ((team_avg[0::2] - team_avg[1::2]) / 400))
+        gain = np.rint(match_k[matches] * (1 - expected))[local]
+        ratings[players] += np.where(wins == 1, gain, -gain)
+
+    return {uid: int(ratings[i]) for uid, i in index.items()}
@@ -0,0 +1,20 @@
+import sys
+
+import db
+
+# Recomputes every player's ELO from the settled match history (rating.replay).
+# Dry run by default; pass --apply to write the new ratings.
+
+def recompute_ratings(apply):
+    db.init_db()
+    history = db.get_rated_history()
+    changes = db.recompute_ratings(apply=apply)
+    print(f"Rated matches: {len(history)}")
+    print(f"Players with a different rating: {len(changes)}")
+    for user_id, old_elo, new_elo in sorted(changes, key=lambda c: abs(c[2] - c[1]), reverse=True)[:20]:
+        print(f"  {user_id}: {old_elo} -> {new_elo} ({new_elo - old_elo:+})")
+    if changes and not apply:
+        print("Dry run, nothing written. Run with --apply to update the users table.")
+
+if __name__ == "__main__":
+    recompute_ratings('--apply' in sys.argv)
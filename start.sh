@@ -1,6 +1,7 @@
 #!/bin/bash
-# Start Flask App in background
-gunicorn web.app:app --bind 0.0.0.0:$PORT &
+# Start Flask App in background (threaded workers: match rooms hold an open event stream per tab,
+# at most MATCH_EVENTS_MAX_STREAMS per process so the other WEB_THREADS stay free for requests)
+gunicorn web.app:app --bind 0.0.0.0:$PORT --worker-class gthread --threads ${WEB_THREADS:-32} &
 
 # Start Telegram Bot in foreground
 python main.py
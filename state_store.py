@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import pickle
+import threading
+
+# Persistence for the bot's in-memory match state (pending/active matches,
+# admin and support message maps, the clan war queue). Changes are appended to
+# a journal and periodically folded into a snapshot, so a restart only has to
+# read one snapshot plus a short journal tail.
+
+STATE_PATH = os.environ.get('STATE_PATH', 'bot_state')
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 0.5))  # seconds between journal writes
+STATE_SNAPSHOT_EVERY = int(os.environ.get('STATE_SNAPSHOT_EVERY', 5000))   # journal records between snapshots
+
+class StateStore:
+    # Tables are live objects owned by the caller. Dicts are journaled per key,
+    # lists (small queues) as a whole. Callers mark what they changed; the next
+    # flush pickles the current value of every marked key, or a delete record if
+    # the key is gone.
+    def __init__(self, path=STATE_PATH, snapshot_every=STATE_SNAPSHOT_EVERY):
+        self.snapshot_path = path + '.snapshot'
+        self.journal_path = path + '.journal'
+        self.snapshot_every = snapshot_every
+        self._tables = {}  # name -> dict or list
+        self._dirty = {}   # name -> {key}
+        self._seq = 0
+        self._journal = None
+        self._io_lock = threading.Lock() # file writes run in run()'s worker threads
+        self._since_snapshot = 0
+        self.records = 0
+        self.snapshots = 0
+
+    def track(self, name, table):
+        self._tables[name] = table
+
+    def mark(self, name, key=None):
+        self._dirty.setdefault(name, set()).add(key)
+
+    def pending(self):
+        return sum(len(keys) for keys in self._dirty.values())
+
+    def load(self):
+        # {name: value} from the snapshot with the journal replayed on top.
+        # A torn record at the end of the journal (crash mid-write) ends the replay.
+        state, seq = {}, 0
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                seq, state = pickle.load(f)
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(self.journal_path, 'rb') as f:
+                while True:
+                    try:
+                        record_seq, name, key, exists, value = pickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception:
+                        logging.warning(f"State journal is truncated after record {seq}")
+                        break
+                    if record_seq <= seq:
+                        # Already folded into the snapshot
+                        continue
+                    seq = record_seq
+                    if key is None:
+                        state[name] = value
+                    elif exists:
+                        state.setdefault(name, {})[key] = value
+                    else:
+                        state.get(name, {}).pop(key, None)
+        except FileNotFoundError:
+            pass
+        return seq, state
+
+    def restore(self):
+        # Fills the tracked tables in place and starts a fresh journal.
+        # Returns the number of restored entries.
+        self._seq, state = self.load()
+        restored = 0
+        for name, table in self._tables.items():
+            value = state.get(name)
+            if not value:
+                continue
+            if isinstance(table, dict):
+                table.clear()
+                table.update(value)
+            else:
+                table[:] = value
+            restored += len(value)
+        self.snapshot()
+        return restored
+
+    def _collect(self):
+        # Pickles dirty keys right away: the tables keep changing while the
+        # bytes are written out
+        dirty, self._dirty = self._dirty, {}
+        chunks = []
+        for name, keys in dirty.items():
+            table = self._tables[name]
+            for key in keys:
+                self._seq += 1
+                if key is None:
+                    record = (self._seq, name, None, True, list(table))
+                elif key in table:
+                    record = (self._seq, name, key, True, table[key])
+                else:
+                    record = (self._seq, name, key, False, None)
+                chunks.append(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        return chunks
+
+    def _append(self, chunks):
+        with self._io_lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'ab')
+            self._journal.write(b''.join(chunks))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._since_snapshot += len(chunks)
+            self.records += len(chunks)
+
+    def _collect_snapshot(self):
+        self._dirty = {}
+        tables = {name: (dict(table) if isinstance(table, dict) else list(table)) for name, table in self._tables.items()}
+        return pickle.dumps((self._seq, tables), pickle.HIGHEST_PROTOCOL)
+
+    def _write_snapshot(self, data):
+        with self._io_lock:
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            # The journal may only be dropped once the snapshot is on disk; if we
+            # crash in between, load() skips records the snapshot already covers
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.journal_path, 'wb')
+            self._since_snapshot = 0
+            self.snapshots += 1
+
+    def flush(self):
+        chunks = self._collect()
+        if chunks:
+            self._append(chunks)
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        self._write_snapshot(self._collect_snapshot())
+
+    async def run(self, interval=STATE_FLUSH_INTERVAL):
+        # Background writer: pickling happens on the event loop, disk I/O in a thread
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                chunks = self._collect()
+                if chunks:
+                    await asyncio.to_thread(self._append, chunks)
+                if self._since_snapshot >= self.snapshot_every:
+                    await asyncio.to_thread(self._write_snapshot, self._collect_snapshot())
+            except Exception:
+                logging.exception("Failed to persist bot state")
+                # Records may be lost: the next round writes a full snapshot
+                self._since_snapshot = self.snapshot_every
+
+    def close(self):
+        # Cancelling run() doesn't stop a write already handed to a thread: the
+        # lock makes the final snapshot and the close wait for it
+        self.snapshot()
+        with self._io_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+from cache import TTLCache
+
+# Channel subscription status per user. Subscribers are remembered for long and
+# re-checked in the background shortly before their entry expires; non-subscribers
+# only briefly, so a fresh subscription counts quickly. When the check itself
+# fails (Telegram API down, bot not an admin of a channel) the user is let
+# through for SUB_ERROR_TTL without background re-checks, so an outage costs
+# one API retry per user per SUB_ERROR_TTL rather than one per message.
+
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", 600))
+SUB_NEGATIVE_TTL = float(os.getenv("SUB_NEGATIVE_TTL", 30))
+SUB_ERROR_TTL = float(os.getenv("SUB_ERROR_TTL", 120))
+SUB_REFRESH_AHEAD = float(os.getenv("SUB_REFRESH_AHEAD", 60))
+
+class SubscriptionCache:
+    def __init__(self, fetch, ttl=SUB_CACHE_TTL, negative_ttl=SUB_NEGATIVE_TTL, error_ttl=SUB_ERROR_TTL,
+                 refresh_ahead=SUB_REFRESH_AHEAD, maxsize=50000):
+        self.fetch = fetch # async fetch(user_id) -> bool
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.refresh_ahead = refresh_ahead
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl) # user_id -> (is_sub, verified)
+        self._refreshing = {} # user_id -> background refresh task
+        self.errors = 0
+
+    async def refresh(self, user_id):
+        try:
+            is_sub = await self.fetch(user_id)
+            entry, ttl = (is_sub, True), self.ttl if is_sub else self.negative_ttl
+        except Exception:
+            # Fail open: better to let everyone in than to block everyone
+            self.errors += 1
+            entry, ttl = (True, False), self.error_ttl
+        finally:
+            # Only this refresh's own slot: a direct check or a newer task may be running
+            if self._refreshing.get(user_id) is asyncio.current_task():
+                del self._refreshing[user_id]
+        self._cache.set(user_id, entry, ttl=ttl)
+        return entry[0]
+
+    async def check(self, user_id):
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return await self.refresh(user_id)
+
+        is_sub, verified = entry
+        if is_sub and verified and user_id not in self._refreshing:
+            remaining = self._cache.remaining_ttl(user_id)
+            if remaining is not None and remaining < self.refresh_ahead:
+                # Held here so the task isn't garbage-collected mid-refresh
+                self._refreshing[user_id] = asyncio.create_task(self.refresh(user_id))
+        return is_sub
+
+    def invalidate(self, user_id):
+        self._cache.pop(user_id)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['errors'] = self.errors
+        stats['refreshing'] = len(self._refreshing)
+        return stats
@@ -0,0 +1,52 @@
+import itertools
+
+import numpy as np
+
+# Splits 2k players into two teams of k with the smallest difference in
+# average ELO. Every split is scored at once with NumPy: 3 splits for 2x2,
+# 126 for 5x5 (C(10, 5) = 252 halved, since swapping the teams changes nothing).
+
+_SPLITS = {} # player count -> bool matrix (splits, players), row = "is in team A"
+
+def _splits(n):
+    masks = _SPLITS.get(n)
+    if masks is None:
+        # Player 0 is always in team A, which drops the mirrored splits
+        rows = [(0,) + rest for rest in itertools.combinations(range(1, n), n // 2 - 1)]
+        masks = np.zeros((len(rows), n), dtype=bool)
+        for i, row in enumerate(rows):
+            masks[i, list(row)] = True
+        masks.setflags(write=False)
+        _SPLITS[n] = masks
+    return masks
+
+def balance_teams(elos, together=(), apart=()):
+    # elos: ratings of the players, by index.
+    # together: groups of indexes that must end up in one team (clan pairs).
+    # apart: pairs of indexes that must be in different teams (the captains).
+    # Returns (team_a, team_b, avg_diff) with sorted index lists, or None if the
+    # constraints leave no valid split.
+    n = len(elos)
+    if n < 2 or n % 2:
+        raise ValueError(f"need an even number of players, got {n}")
+    masks = _splits(n)
+    ratings = np.asarray(elos, dtype=np.float64)
+    team_a = masks @ ratings
+    diff = np.abs(2 * team_a - ratings.sum()) / (n // 2)
+
+    valid = np.ones(len(masks), dtype=bool)
+    for group in together:
+        members = masks[:, list(group)]
+        valid &= members.all(axis=1) | ~members.any(axis=1)
+    for i, j in apart:
+        valid &= masks[:, i] != masks[:, j]
+    if not valid.any():
+        return None
+
+    best = int(np.argmin(np.where(valid, diff, np.inf)))
+    in_a = masks[best]
+    return (
+        [i for i in range(n) if in_a[i]],
+        [i for i in range(n) if not in_a[i]],
+        float(diff[best]),
+    )
@@ -0,0 +1,206 @@
+import os
+import sys
+import unittest
+import tempfile
+import sqlite3
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+import rating
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        # Create a temporary database
+        self.db_fd, self.db_path = tempfile.mkstemp()
+
+        self.original_get_db = db.get_db_connection
+        self.original_is_postgres = db.IS_POSTGRES
+
+        db.IS_POSTGRES = False # Force SQLite for testing
+
+        def mock_get_db():
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        db.get_db_connection = mock_get_db
+        db.clear_user_cache()
+        db.init_db()
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+        db.get_db_connection = self.original_get_db
+        db.IS_POSTGRES = self.original_is_postgres
+
+    def query(self, sql, params=()):
+        conn = db.get_db_connection()
+        row = conn.execute(sql, params).fetchone()
+        conn.close()
+        return row
+
+    def test_migrations(self):
+        import migrations
+        conn = db.get_db_connection()
+        self.assertEqual(migrations.current_version(conn), migrations.latest_version())
+
+        # Warm start is a single version check
+        statements = []
+        conn.set_trace_callback(statements.append)
+        self.assertEqual(migrations.migrate(conn), [])
+        self.assertEqual(statements, ['SELECT MAX(version) FROM schema_version'])
+        conn.close()
+
+        columns = [col[1] for col in db.get_db_connection().execute('PRAGMA table_info(users)').fetchall()]
+        self.assertIn('ban_expiration', columns)
+
+    def test_user_cache(self):
+        db.add_user(1, "g1", "Player1")
+        db.get_user(1)
+        hits = db.get_cache_stats()['users']['hits']
+        self.assertEqual(db.get_user(1)['nickname'], "Player1")
+        self.assertEqual(db.get_cache_stats()['users']['hits'], hits + 1)
+
+        # Writes through db.py invalidate cached rows
+        db.update_elo(1, 25, True)
+        self.assertEqual(db.get_user(1)['elo'], 1025)
+
+        self.assertEqual(db.get_user_by_nickname("Player1")['user_id'], 1)
+        self.assertEqual(db.get_user_by_game_id("g1"), 1)
+        db.update_user_profile(1, nickname="Renamed", game_id="g2")
+        self.assertIsNone(db.get_user_by_nickname("Player1"))
+        self.assertIsNone(db.get_user_by_game_id("g1"))
+        self.assertEqual(db.get_user(1)['nickname'], "Renamed")
+
+    def test_settle_match(self):
+        for uid in (1, 2, 3, 4):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        clan1 = db.create_clan("AAA", "Alpha", 1)
+        clan2 = db.create_clan("BBB", "Bravo", 3)
+        match_id = db.create_match("2x2_clan", [1, 2, 3, 4])
+
+        settled = db.settle_match(
+            match_id,
+            [(1, 60, True), (2, 60, True), (3, -60, False), (4, -60, False)],
+            [(clan1, 25, True), (clan2, -25, False)],
+        )
+
+        self.assertEqual(settled[1], (1060, 5))
+        self.assertEqual(settled[3], (940, 4))
+
+        user = db.get_user(2)
+        self.assertEqual(user['elo'], 1060)
+        self.assertEqual(user['level'], db.get_level_by_elo(1060))
+        self.assertEqual(user['matches'], 1)
+        self.assertEqual(user['wins'], 1)
+        self.assertEqual(db.get_user(4)['wins'], 0)
+
+        clan = db.get_clan_by_id(clan1)
+        self.assertEqual((clan['matches_played'], clan['matches_won'], clan['exp'], clan['clan_elo']), (1, 1, 50, 1025))
+        self.assertEqual(self.query('SELECT status FROM matches WHERE id = ?', (match_id,))['status'], 'finished')
+
+        # A second confirmation must not apply anything twice
+        self.assertIsNone(db.settle_match(match_id, [(1, 60, True)]))
+        self.assertEqual(db.get_user(1)['elo'], 1060)
+
+    def test_batch_lookups(self):
+        for uid in (1, 2, 3):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        db.set_vip_status(2, 30)
+        clan = db.create_clan("AAA", "Alpha", 1)
+        db.get_user(1)
+
+        users = db.get_users([1, 2, 3, 99])
+        self.assertEqual(sorted(users), [1, 2, 3])
+        self.assertEqual(users[3]['nickname'], "Player3")
+        self.assertEqual(db.get_vip_flags([1, 2, 99]), {1: False, 2: True, 99: False})
+
+        self.assertEqual(db.get_clan_memberships([1, 2]), {1: (clan, "AAA")})
+
+        # Expired VIP is switched off just like is_user_vip does
+        conn = db.get_db_connection()
+        conn.execute("UPDATE users SET vip_until = '2000-01-01 00:00:00' WHERE user_id = 2")
+        conn.commit()
+        conn.close()
+        db.clear_user_cache()
+        self.assertEqual(db.get_vip_flags([2]), {2: False})
+        self.assertEqual(self.query('SELECT is_vip FROM users WHERE user_id = 2')['is_vip'], 0)
+
+    def test_leaderboard(self):
+        for uid in (1, 2, 3):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        db.rebuild_leaderboard()
+        db.update_elo(2, 50, True)
+        db.manual_update_elo(3, -30)
+
+        self.assertEqual([p[0] for p in db.get_top_players(10)], ["Player2", "Player1", "Player3"])
+        self.assertEqual(db.get_player_rank(3), (3, 3))
+        self.assertEqual([p[:2] for p in db.get_players_around(1, 1)], [(1, 2), (2, 1), (3, 3)])
+
+    def test_leaderboard_picks_up_other_processes(self):
+        for uid in (1, 2, 3):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        db.rebuild_leaderboard()
+        original_check = db.LEADERBOARD_CHECK
+        db.LEADERBOARD_CHECK = 0
+        try:
+            # Local writes keep the tree and its marker in step: no rebuild needed
+            db.update_elo(1, 10, True)
+            self.assertEqual(db._leaderboard_version, self.query('SELECT version FROM elo_marker')[0])
+
+            # Another process (the bot) writes without touching this tree
+            conn = db.get_db_connection()
+            conn.execute('UPDATE users SET elo = 1200 WHERE user_id = 3')
+            conn.execute('UPDATE elo_marker SET version = version + 1')
+            conn.commit()
+            conn.close()
+            self.assertEqual([p[0] for p in db.get_top_players(10)], ["Player3", "Player1", "Player2"])
+        finally:
+            db.LEADERBOARD_CHECK = original_check
+
+    def test_clan_membership_cache(self):
+        for uid in (1, 2):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        self.assertIsNone(db.get_clan_membership(1))
+        clan = db.create_clan("AAA", "Alpha", 1)
+        self.assertEqual(db.get_clan_membership(1), (clan, "AAA"))
+
+        # Players without a clan are cached too
+        self.assertIsNone(db.get_clan_membership(2))
+        misses = db.get_cache_stats()['clans']['misses']
+        self.assertIsNone(db.get_clan_membership(2))
+        self.assertEqual(db.get_cache_stats()['clans']['misses'], misses)
+
+        db.add_clan_member(clan, 2)
+        self.assertEqual(db.get_clan_membership(2), (clan, "AAA"))
+        db.remove_clan_member(2)
+        self.assertIsNone(db.get_clan_membership(2))
+
+        db.clear_user_cache()
+        self.assertEqual(db.prime_clan_cache(), 1)
+        self.assertEqual(db.get_clan_memberships([1, 2]), {1: (clan, "AAA")})
+
+    def test_recompute_ratings(self):
+        for uid in (1, 2, 3, 4):
+            db.add_user(uid, f"g{uid}", f"Player{uid}")
+        first = db.create_match("2x2", [1, 2, 3, 4])
+        db.settle_match(first, [(1, 25, True), (2, 25, True), (3, -25, False), (4, -25, False)])
+        second = db.create_match("1x1", [1, 3])
+        gain = rating.win_gain([975], [1025], "1x1")
+        db.settle_match(second, [(1, -gain, False), (3, gain, True)])
+        self.assertEqual(self.query('SELECT is_win, elo_change FROM match_players WHERE match_id = ? AND user_id = 3', (second,))[:], (1, gain))
+        self.assertEqual(db.get_rated_history(), [("2x2", [1, 2], [3, 4]), ("1x1", [3], [1])])
+
+        # Settled with the engine's own gains: nothing to fix
+        self.assertEqual(db.recompute_ratings(), [])
+
+        db.manual_update_elo(2, 300)
+        self.assertEqual(db.recompute_ratings(), [(2, 1325, 1025)])
+        self.assertEqual(db.get_user(2)['elo'], 1325)
+        db.recompute_ratings(apply=True)
+        self.assertEqual(db.get_user(2)['elo'], 1025)
+        self.assertEqual(db.get_user(2)['level'], db.get_level_by_elo(1025))
+
+if __name__ == '__main__':
+    unittest.main()
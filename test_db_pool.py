@@ -0,0 +1,129 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+
+class SQLitePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.original_pool = db._pool
+        self.original_is_postgres = db.IS_POSTGRES
+        db.IS_POSTGRES = False
+        self.pool = db._pool = db.SQLitePool(self.db_path)
+        with db.db_connection() as conn:
+            conn.execute('CREATE TABLE items (name TEXT)')
+
+    def tearDown(self):
+        conn = getattr(self.pool._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        db._pool = self.original_pool
+        db.IS_POSTGRES = self.original_is_postgres
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def names(self):
+        with db.db_connection() as conn:
+            return [row[0] for row in conn.execute('SELECT name FROM items ORDER BY name')]
+
+    def test_thread_reuses_its_connection(self):
+        outer = db.get_db_connection()
+        inner = db.get_db_connection()
+        self.assertIs(outer.conn, inner.conn)
+        self.assertEqual((self.pool._local.depth, outer.savepoint), (2, None))
+        self.assertIsNotNone(inner.savepoint)
+        inner.close()
+        inner.close()
+        self.assertEqual(self.pool._local.depth, 1)
+        outer.close()
+        self.assertEqual(self.pool._local.depth, 0)
+
+        # Other threads get a connection of their own
+        seen = []
+        def other_thread():
+            conn = db.get_db_connection()
+            seen.append(conn.conn)
+            conn.close()
+            conn.conn.close()
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertIsNot(seen[0], outer.conn)
+        self.assertEqual(self.pool.stats()['open'], 2)
+
+    def test_rollback_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with db.db_connection() as conn:
+                conn.execute("INSERT INTO items VALUES ('a')")
+                raise RuntimeError
+        self.assertEqual(self.names(), [])
+        self.assertFalse(self.pool._local.conn.in_transaction)
+
+    def test_uncommitted_work_is_dropped_on_close(self):
+        conn = db.get_db_connection()
+        conn.execute("INSERT INTO items VALUES ('a')")
+        conn.close()
+        self.assertEqual(self.names(), [])
+
+    def test_nested_commit_stays_in_the_outer_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with db.db_connection() as outer:
+                outer.execute("INSERT INTO items VALUES ('a')")
+                with db.db_connection() as inner:
+                    inner.execute("INSERT INTO items VALUES ('b')")
+                raise RuntimeError
+        self.assertEqual(self.names(), [])
+
+    def test_nested_rollback_only_undoes_its_own_work(self):
+        with db.db_connection() as outer:
+            outer.execute("INSERT INTO items VALUES ('a')")
+            with self.assertRaises(RuntimeError):
+                with db.db_connection() as inner:
+                    inner.execute("INSERT INTO items VALUES ('b')")
+                    raise RuntimeError
+            with db.db_connection() as inner:
+                inner.execute("INSERT INTO items VALUES ('c')")
+                inner.commit()
+                inner.execute("INSERT INTO items VALUES ('d')")
+                inner.rollback()
+        self.assertEqual(self.names(), ['a', 'c'])
+
+    def test_stats(self):
+        acquired = self.pool.stats()['acquired']
+        conn = db.get_db_connection()
+        stats = self.pool.stats()
+        self.assertEqual((stats['in_use'], stats['acquired']), (1, acquired + 1))
+        conn.close()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        self.assertEqual(db.get_pool_stats()['backend'], 'sqlite')
+
+@unittest.skipUnless(db.IS_POSTGRES, 'DATABASE_URL is not set')
+class PostgresPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = db.PostgresPool(1, 0.05)
+
+    def tearDown(self):
+        self.pool._pool.closeall()
+
+    def test_bounded_by_the_semaphore(self):
+        conn = db.PooledConnection(self.pool, self.pool.acquire())
+        self.assertRaises(db.PoolTimeout, self.pool.acquire)
+        stats = self.pool.stats()
+        self.assertEqual((stats['in_use'], stats['acquired'], stats['waits'], stats['timeouts']), (1, 1, 1, 1))
+
+        # close() hands the connection back and frees the slot
+        conn.close()
+        conn.close()
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+        second = db.PooledConnection(self.pool, self.pool.acquire())
+        self.assertIsNone(self.pool.savepoint(second.conn))
+        second.close()
+        self.assertEqual(self.pool.stats()['acquired'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
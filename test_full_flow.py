@@ -4,7 +4,6 @@ import sys
 import unittest
 import tempfile
 import sqlite3
-import json
 
 # Add web directory to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'web')))
@@ -12,6 +11,7 @@ sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 # Mock db module before importing app
 import db
+import veto
 from web.app import app
 
 class FacevosaitTestCase(unittest.TestCase):
@@ -109,10 +109,9 @@ class FacevosaitTestCase(unittest.TestCase):
         cursor = conn.cursor()
         db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
         match = cursor.fetchone()
-        self.assertIsNotNone(match['veto_status'])
+        self.assertEqual(match['veto_bans'], 0)
         print("Veto initialized.")
         
-        veto_data = json.loads(match['veto_status'])
         current_turn = match['current_veto_turn']
         print(f"Current turn: {current_turn}")
         
@@ -127,8 +126,9 @@ class FacevosaitTestCase(unittest.TestCase):
         # Verify ban
         db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
         match = cursor.fetchone()
-        veto_data = json.loads(match['veto_status'])
+        veto_data = veto.POOLS['web'].status(match['veto_bans'])
         self.assertEqual(veto_data[map_to_ban], 'banned')
+        self.assertEqual([tuple(row) for row in db.get_veto_actions(match_id)][0][:3], (current_turn, map_to_ban, 'ban'))
         print(f"Map {map_to_ban} banned.")
         conn.close()
         
@@ -0,0 +1,46 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from group_commit import GroupCommit
+
+class GroupCommitTestCase(unittest.TestCase):
+    def test_burst_shares_batches(self):
+        batches = []
+        writer = GroupCommit(batches.append, linger=0.05)
+        threads = [threading.Thread(target=writer.submit, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(item for batch in batches for item in batch), list(range(20)))
+        self.assertLess(len(batches), 20)
+        self.assertEqual(writer.stats(), {'items': 20, 'batches': len(batches), 'pending': 0})
+
+    def test_max_batch(self):
+        batches = []
+        writer = GroupCommit(batches.append, linger=0.05, max_batch=3)
+        threads = [threading.Thread(target=writer.submit, args=(i,)) for i in range(7)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(sum(len(batch) for batch in batches), 7)
+
+    def test_errors_reach_every_writer_of_the_batch(self):
+        def flush(items):
+            raise RuntimeError('disk full')
+        writer = GroupCommit(flush, linger=0)
+        with self.assertRaises(RuntimeError):
+            writer.submit('hello')
+        # The next write gets a fresh leader
+        writer.flush = lambda items: None
+        writer.submit('again')
+        self.assertEqual(writer.stats()['batches'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import unittest
+import tempfile
+import sqlite3
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+
+# Hot queries from db.py and web/app.py. Each one must be served by an index:
+# if a change turns one of them into a full table scan, this test fails.
+HOT_QUERIES = [
+    ('get_user', 'SELECT user_id, game_id, nickname, elo, level FROM users WHERE user_id = ?', (1,)),
+    ('get_user_by_nickname', 'SELECT * FROM users WHERE nickname = ?', ('nick',)),
+    ('get_user_by_game_id', 'SELECT user_id FROM users WHERE game_id = ?', ('123',)),
+    ('get_users', 'SELECT user_id, game_id, nickname, elo, level FROM users WHERE user_id IN (?, ?, ?)', (1, 2, 3)),
+    ('leaderboard', '''
+        SELECT u.*, c.tag as clan_tag
+        FROM users u
+        LEFT JOIN clan_members cm ON u.user_id = cm.user_id
+        LEFT JOIN clans c ON cm.clan_id = c.id
+        WHERE u.user_id IN (?, ?, ?)
+    ''', (1, 2, 3)),
+    ('matches_admin', '''
+        SELECT m.*,
+        (SELECT COUNT(*) FROM match_players WHERE match_id = m.id) as player_count
+        FROM matches m
+        ORDER BY m.created_at DESC LIMIT 50
+    ''', ()),
+    ('matches_user', '''
+        SELECT m.*, mp.has_left, mp.is_annulled,
+        (SELECT COUNT(*) FROM match_players WHERE match_id = m.id) as player_count
+        FROM matches m
+        JOIN match_players mp ON m.id = mp.match_id
+        WHERE mp.user_id = ?
+        ORDER BY m.created_at DESC LIMIT 50
+    ''', (1,)),
+    ('user_profile_recent_matches', '''
+        SELECT m.*, mp.team, mp.is_annulled, mp.accepted, mp.has_left,
+               (CASE WHEN m.winner_team = mp.team THEN 1 ELSE 0 END) as is_win
+        FROM matches m
+        JOIN match_players mp ON m.id = mp.match_id
+        WHERE mp.user_id = ?
+        ORDER BY m.created_at DESC
+        LIMIT 10
+    ''', (1,)),
+    ('play_active_match', '''
+        SELECT m.id FROM matches m
+        JOIN match_players mp ON m.id = mp.match_id
+        WHERE mp.user_id = ? AND m.status = 'active'
+    ''', (1,)),
+    ('matches_by_status', "SELECT id FROM matches WHERE status = 'active' ORDER BY created_at DESC LIMIT 50", ()),
+    ('get_match_players', '''
+        SELECT mp.user_id, u.nickname, u.elo, u.level, mp.accepted
+        FROM match_players mp
+        JOIN users u ON mp.user_id = u.user_id
+        WHERE mp.match_id = ?
+    ''', (1,)),
+    ('get_friends', '''
+        SELECT u.user_id, u.nickname, u.avatar_url, u.elo, u.is_vip
+        FROM users u
+        JOIN friends f ON (f.friend_id = u.user_id AND f.user_id = ?)
+                       OR (f.user_id = u.user_id AND f.friend_id = ?)
+        WHERE f.status = 'accepted'
+    ''', (1, 1)),
+    ('get_friend_requests', '''
+        SELECT u.user_id, u.nickname, u.avatar_url
+        FROM users u
+        JOIN friends f ON f.user_id = u.user_id
+        WHERE f.friend_id = ? AND f.status = 'pending'
+    ''', (1,)),
+    ('get_friend_status', '''
+        SELECT user_id, status FROM friends
+        WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
+    ''', (1, 2, 2, 1)),
+    ('match_chat_latest', '''
+        SELECT id, user_id, message, created_at FROM match_chat
+        WHERE match_id = ? ORDER BY id DESC LIMIT ?
+    ''', (1, 50)),
+    ('match_chat_since', '''
+        SELECT id, user_id, message, created_at FROM match_chat
+        WHERE match_id = ? AND id > ? ORDER BY id ASC LIMIT ?
+    ''', (1, 10, 50)),
+    ('chat_authors', 'SELECT user_id, nickname, avatar_url FROM users WHERE user_id IN (?, ?)', (1, 2)),
+    ('veto_sweeper', '''
+        SELECT id, veto_bans, current_veto_turn FROM matches
+        WHERE status = 'active' AND last_action_time > 0 AND last_action_time <= ? AND map_picked IS NULL
+    ''', (1,)),
+    ('veto_players', 'SELECT match_id, user_id FROM match_players WHERE match_id IN (?, ?) ORDER BY match_id, team, user_id', (1, 2)),
+    ('leaderboard_marker', 'SELECT version FROM elo_marker WHERE id = 1', ()),
+    ('match_versions', 'SELECT id, version FROM matches WHERE id IN (?, ?)', (1, 2)),
+    ('veto_actions', 'SELECT user_id, map_name, action, created_at FROM veto_actions WHERE match_id = ? ORDER BY id', (1,)),
+    ('remove_lobby_member', 'DELETE FROM lobby_members WHERE user_id = ?', (1,)),
+    ('get_user_clan', '''
+        SELECT c.* FROM clans c
+        JOIN clan_members cm ON c.id = cm.clan_id
+        WHERE cm.user_id = ?
+    ''', (1,)),
+]
+
+class SQLiteIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.original_get_db = db.get_db_connection
+        self.original_is_postgres = db.IS_POSTGRES
+        db.IS_POSTGRES = False
+
+        def mock_get_db():
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        db.get_db_connection = mock_get_db
+        db.init_db()
+        self.conn = mock_get_db()
+
+    def tearDown(self):
+        self.conn.close()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+        db.get_db_connection = self.original_get_db
+        db.IS_POSTGRES = self.original_is_postgres
+
+    def test_hot_queries_use_indexes(self):
+        for name, sql, params in HOT_QUERIES:
+            with self.subTest(query=name):
+                plan = [row[3] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+                full_scans = [step for step in plan if step.startswith('SCAN ') and ' USING ' not in step]
+                self.assertEqual(full_scans, [], f"{name} does a full scan: {plan}")
+
+@unittest.skipUnless(db.IS_POSTGRES, 'DATABASE_URL is not set')
+class PostgresIndexTestCase(unittest.TestCase):
+    def test_hot_queries_use_indexes(self):
+        db.init_db()
+        with db.db_connection() as conn:
+            cursor = conn.cursor()
+            # Tables are small in a test database; make the planner prefer indexes whenever one applies
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, sql, params in HOT_QUERIES:
+                with self.subTest(query=name):
+                    db.execute_query(cursor, 'EXPLAIN ' + sql, params)
+                    plan = '\n'.join(row[0] for row in cursor.fetchall())
+                    self.assertNotIn('Seq Scan', plan, f"{name} does a full scan:\n{plan}")
+            conn.rollback()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from leaderboard import Leaderboard
+
+class LeaderboardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.board = Leaderboard(elo_min=0, elo_max=3000)
+        self.elo = {}
+
+    def expected(self):
+        return [(rank, uid, elo) for rank, (uid, elo) in
+                enumerate(sorted(self.elo.items(), key=lambda item: (-item[1], item[0])), 1)]
+
+    def test_matches_sorted_order(self):
+        rng = random.Random(42)
+        self.board.rebuild([(uid, rng.randint(500, 2500)) for uid in range(200)])
+        self.elo = {uid: elo for _, uid, elo in self.board.top(200)}
+
+        for _ in range(1000):
+            uid = rng.randrange(250)
+            if rng.random() < 0.05:
+                self.board.remove(uid)
+                self.elo.pop(uid, None)
+            else:
+                # Includes ratings outside the bucket range
+                self.elo[uid] = rng.randint(-200, 3200)
+                self.board.update(uid, self.elo[uid])
+
+        expected = self.expected()
+        self.assertEqual(len(self.board), len(expected))
+        self.assertEqual(self.board.top(len(expected)), expected)
+        self.assertEqual(self.board.top(10, 95), expected[95:105])
+        for rank, uid, _ in expected:
+            self.assertEqual(self.board.rank(uid), rank)
+
+    def test_around(self):
+        self.board.rebuild([(1, 1500), (2, 1400), (3, 1400), (4, 1000), (5, 900)])
+        self.assertEqual(self.board.rank(3), 3)
+        self.assertEqual([uid for _, uid, _ in self.board.around(3, 1)], [2, 3, 4])
+        self.assertEqual([uid for _, uid, _ in self.board.around(1, 1)], [1, 2, 3])
+        self.assertEqual(self.board.around(99), [])
+
+    def test_updates_during_rebuild_survive(self):
+        self.board.rebuild([(1, 1000), (2, 1100)])
+        self.board.begin_rebuild()
+        self.board.update(1, 1200)   # committed after the snapshot below was read
+        self.board.remove(2)
+        self.board.rebuild([(1, 1000), (2, 1100), (3, 900)])
+        self.assertEqual(self.board.top(10), [(1, 1, 1200), (2, 3, 900)])
+
+if __name__ == '__main__':
+    unittest.main()
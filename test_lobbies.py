@@ -0,0 +1,98 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from lobbies import Debouncer, LobbyRegistry, ViewerIndex
+
+class LobbyRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = LobbyRegistry(modes=("1x1", "2x2"), count=3)
+
+    def test_seats_and_index(self):
+        self.registry.add("2x2", 2, 10, {"nickname": "a"})
+        self.registry.add("2x2", 2, 11, {"nickname": "b"})
+        self.assertEqual(self.registry.locate(10), ("2x2", 2))
+        self.assertIn(11, self.registry)
+        self.assertEqual(self.registry.count("2x2", 2), 2)
+        self.assertEqual(list(self.registry.players("2x2", 2)), [10, 11])
+
+        # A player can sit in one lobby only, and the views are read-only
+        with self.assertRaises(ValueError):
+            self.registry.add("1x1", 1, 10, {})
+        with self.assertRaises(TypeError):
+            self.registry.players("2x2", 2)[12] = {}
+
+        self.assertEqual(self.registry.remove(10), ("2x2", 2, {"nickname": "a"}))
+        self.assertIsNone(self.registry.locate(10))
+        self.assertIsNone(self.registry.remove(10))
+
+        self.assertEqual(self.registry.update_player(11, is_vip=True), ("2x2", 2))
+        self.assertTrue(self.registry.players("2x2", 2)[11]["is_vip"])
+
+        self.assertEqual(self.registry.clear("2x2", 2), [(11, {"nickname": "b", "is_vip": True})])
+        self.assertNotIn(11, self.registry)
+
+    def test_first_free(self):
+        self.assertEqual(self.registry.first_free("1x1"), 1)
+        self.registry.add("1x1", 1, 1, {})
+        self.registry.add("1x1", 2, 2, {})
+        self.assertEqual(self.registry.first_free("1x1"), 3)
+        self.registry.add("1x1", 3, 3, {})
+        self.assertIsNone(self.registry.first_free("1x1"))
+        self.registry.remove(2)
+        self.assertEqual(self.registry.first_free("1x1"), 2)
+        self.registry.clear("1x1", 1)
+        self.assertEqual(self.registry.first_free("1x1"), 1)
+        self.assertEqual(self.registry.first_free("2x2"), 1)
+
+    def test_versions(self):
+        version = self.registry.version("1x1", 1)
+        self.registry.add("1x1", 1, 1, {})
+        self.registry.update_player(1, level=5)
+        self.assertEqual(self.registry.version("1x1", 1), version + 2)
+        self.registry.clear("1x1", 2) # empty lobby: nothing changes
+        self.assertEqual(self.registry.version("1x1", 2), 0)
+        self.assertEqual(self.registry.mode_version("1x1"), 2)
+        self.assertEqual(self.registry.mode_version("2x2"), 0)
+
+class ViewerIndexTestCase(unittest.TestCase):
+    def test_index_follows_screen(self):
+        viewers = ViewerIndex()
+        viewers.set(1, "2x2", 3, 100, 1)
+        viewers.set(2, "2x2", 3, 200, 2)
+        viewers.set(3, "2x2", None, 300, 3)
+        self.assertEqual(sorted(uid for uid, _ in viewers.watching("2x2", 3)), [1, 2])
+        self.assertEqual([uid for uid, _ in viewers.watching("2x2", None)], [3])
+
+        viewers.set(1, "1x1", 1, 101, 1)
+        self.assertEqual([uid for uid, _ in viewers.watching("2x2", 3)], [2])
+        self.assertEqual(viewers.get(1)["message_id"], 101)
+
+        viewers.remove(2)
+        viewers.remove(2)
+        self.assertEqual(viewers.watching("2x2", 3), [])
+        self.assertEqual(len(viewers), 2)
+
+class DebouncerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesces_bursts(self):
+        calls = []
+        async def render(mode, lobby_id):
+            calls.append((mode, lobby_id))
+        debouncer = Debouncer(render, 0.01)
+
+        for _ in range(10):
+            debouncer.schedule(("2x2", 1))
+        debouncer.schedule(("2x2", 2))
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted(calls), [("2x2", 1), ("2x2", 2)])
+
+        debouncer.schedule(("2x2", 1))
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((debouncer.scheduled, debouncer.runs), (12, 3))
+
+if __name__ == '__main__':
+    unittest.main()
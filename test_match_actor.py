@@ -0,0 +1,94 @@
+import os
+import sys
+import asyncio
+import inspect
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from match_actor import MatchActors
+
+class MatchActorsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_events_of_one_match_run_in_order(self):
+        actors = MatchActors()
+        maps = ["Rust", "Dune", "Zone 7"]
+        banned = []
+
+        @actors.serialized(lambda match_id, map_name: match_id)
+        async def ban(match_id, map_name):
+            # Without the mailbox both clicks would pass this check before either removes the map
+            if map_name not in maps:
+                return
+            await asyncio.sleep(0.01)
+            maps.remove(map_name)
+            banned.append(map_name)
+
+        await ban(1, "Rust")
+        await ban(1, "Rust")
+        await ban(1, "Dune")
+        self.assertEqual(actors.stats()['queued'], 3)
+        await asyncio.sleep(0.05)
+        self.assertEqual(banned, ["Rust", "Dune"])
+        self.assertEqual(actors.stats(), {'actors': 0, 'queued': 0, 'processed': 3, 'failed': 0})
+
+    async def test_worker_survives_garbage_collection(self):
+        import gc
+        actors = MatchActors()
+        done = []
+        release = asyncio.Event()
+
+        async def step():
+            await release.wait()
+            done.append(1)
+
+        actors.submit(1, step)
+        await asyncio.sleep(0)
+        # Nothing but the actor references the worker while it waits
+        gc.collect()
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(done, [1])
+        self.assertEqual(len(actors._tasks), 0)
+
+    async def test_matches_run_concurrently(self):
+        actors = MatchActors()
+        running = set()
+        overlap = []
+
+        async def step(match_id):
+            running.add(match_id)
+            await asyncio.sleep(0.01)
+            overlap.append(len(running))
+            running.discard(match_id)
+
+        actors.submit(1, step, 1)
+        actors.submit(2, step, 2)
+        await asyncio.sleep(0.03)
+        self.assertEqual(max(overlap), 2)
+
+    async def test_failure_does_not_block_mailbox(self):
+        actors = MatchActors()
+        done = []
+        async def boom():
+            raise KeyError(1)
+        async def ok():
+            done.append(True)
+
+        actors.submit(1, boom)
+        actors.submit(1, ok)
+        with self.assertLogs(level='ERROR'):
+            await asyncio.sleep(0.01)
+        self.assertEqual(done, [True])
+        self.assertEqual(actors.failed, 1)
+
+    def test_handler_signature_is_preserved(self):
+        actors = MatchActors()
+        async def handle_ban(callback, state=None):
+            pass
+        wrapped = actors.serialized(lambda callback, **kwargs: 1)(handle_ban)
+        # aiogram reads the parameters of the unwrapped callback
+        self.assertEqual(list(inspect.signature(inspect.unwrap(wrapped)).parameters), ["callback", "state"])
+        self.assertTrue(inspect.iscoroutinefunction(wrapped))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+from match_events import MatchEventHub
+
+class FakeMatches:
+    # In-memory stand-in for the matches/match_chat tables
+    def __init__(self):
+        self.versions = {1: 0}
+        self.chat = []
+        self.lock = threading.Lock()
+        self.version_queries = 0
+        self.loads = 0
+
+    def get_versions(self, match_ids):
+        with self.lock:
+            self.version_queries += 1
+            return {match_id: self.versions[match_id] for match_id in match_ids if match_id in self.versions}
+
+    def load(self, match_id, after_chat_id):
+        with self.lock:
+            self.loads += 1
+            if match_id not in self.versions:
+                return None
+            chat = [message for message in self.chat if message['id'] > after_chat_id]
+            return self.versions[match_id], {'status': 'active'}, chat
+
+    def post(self, match_id, text):
+        with self.lock:
+            self.chat.append({'id': len(self.chat) + 1, 'message': text})
+            self.versions[match_id] += 1
+
+class MatchEventHubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matches = FakeMatches()
+        self.hub = MatchEventHub(self.matches.get_versions, self.matches.load, poll_interval=0.01)
+
+    def wait_version(self, feed, version):
+        # The watcher may see several quick changes one at a time
+        for _ in range(100):
+            current = self.hub.read(feed)[0]
+            if current == version:
+                return
+            self.hub.wait(feed, current, 0.1)
+        self.fail(f"feed stuck at version {feed.version}")
+
+    def test_one_load_per_change_for_all_subscribers(self):
+        feeds = [self.hub.subscribe(1) for _ in range(20)]
+        self.assertTrue(all(feed is feeds[0] for feed in feeds))
+        self.assertEqual(self.matches.loads, 1)
+        feed = feeds[0]
+
+        self.matches.post(1, 'gl hf')
+        self.hub.poke()
+        self.assertTrue(self.hub.wait(feed, 0, 1))
+        version, state, chat = self.hub.read(feed)
+        self.assertEqual((version, [m['message'] for m in chat]), (1, ['gl hf']))
+        self.assertEqual(self.matches.loads, 2)
+
+        # Nothing changed: the watcher only checks versions
+        self.assertFalse(self.hub.wait(feed, 1, 0.05))
+        self.assertEqual(self.matches.loads, 2)
+        self.assertGreater(self.matches.version_queries, 1)
+
+        for feed in feeds:
+            self.hub.unsubscribe(1, feed)
+        self.assertEqual(self.hub.stats()['matches'], 0)
+
+    def test_chat_deltas(self):
+        feed = self.hub.subscribe(1)
+        for text in ('a', 'b', 'c'):
+            self.matches.post(1, text)
+        self.hub.poke()
+        self.wait_version(feed, 3)
+        _, _, chat = self.hub.read(feed, after_chat_id=1)
+        self.assertEqual([m['message'] for m in chat], ['b', 'c'])
+        # Later loads only fetch what's new
+        self.matches.post(1, 'd')
+        self.hub.poke()
+        self.wait_version(feed, 4)
+        self.assertEqual([m['message'] for m in feed.chat], ['a', 'b', 'c', 'd'])
+        self.hub.unsubscribe(1, feed)
+
+    def test_reader_behind_the_chat_history_catches_up(self):
+        hub = self.hub = MatchEventHub(self.matches.get_versions, self.matches.load, poll_interval=0.01, chat_history=2)
+        feed = hub.subscribe(1)
+        self.matches.post(1, 'a')
+        hub.poke()
+        self.wait_version(feed, 1)
+        for text in ('b', 'c', 'd'):
+            self.matches.post(1, text)
+        hub.poke()
+        self.wait_version(feed, 4)
+        self.assertEqual([m['message'] for m in feed.chat], ['c', 'd'])
+
+        # Read up to 'a': 'b' is only in the database now
+        loads = self.matches.loads
+        _, _, chat = hub.read(feed, after_chat_id=1)
+        self.assertEqual([m['message'] for m in chat], ['b', 'c', 'd'])
+        self.assertEqual((self.matches.loads, hub.stats()['catchups']), (loads + 1, 1))
+        # Readers still inside the history are served from memory
+        self.assertEqual([m['message'] for m in hub.read(feed, after_chat_id=2)[2]], ['c', 'd'])
+        self.assertEqual(hub.stats()['catchups'], 1)
+        hub.unsubscribe(1, feed)
+
+    def test_missing_and_deleted_match(self):
+        self.assertIsNone(self.hub.subscribe(2))
+        self.assertEqual(self.hub.stats()['matches'], 0)
+
+        feed = self.hub.subscribe(1)
+        with self.matches.lock:
+            del self.matches.versions[1]
+        self.hub.poke()
+        self.assertTrue(self.hub.wait(feed, 0, 1))
+        self.assertIsNone(self.hub.read(feed)[1])
+        self.hub.unsubscribe(1, feed)
+
+class MatchEventsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.original_get_db = db.get_db_connection
+        self.original_is_postgres = db.IS_POSTGRES
+        db.IS_POSTGRES = False
+
+        def mock_get_db():
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        db.get_db_connection = mock_get_db
+        db.clear_user_cache()
+        db.init_db()
+
+        import web.app
+        from web.app import app, match_events
+        self.web_app = web.app
+        self.original_stream_slots = web.app.stream_slots
+        self.match_events = match_events
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['nickname'] = 'PlayerOne'
+
+        conn = mock_get_db()
+        conn.execute("INSERT INTO users (user_id, nickname, elo) VALUES (1, 'PlayerOne', 1000)")
+        conn.execute("INSERT INTO matches (id, status, mode) VALUES (7, 'active', '1x1')")
+        conn.execute("INSERT INTO match_players (match_id, user_id, team) VALUES (7, 1, 1)")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+        db.get_db_connection = self.original_get_db
+        db.IS_POSTGRES = self.original_is_postgres
+        self.web_app.stream_slots = self.original_stream_slots
+
+    def version(self):
+        conn = db.get_db_connection()
+        version = conn.execute('SELECT version FROM matches WHERE id = 7').fetchone()[0]
+        conn.close()
+        return version
+
+    def test_stream_pushes_chat(self):
+        response = self.client.post('/api/match/7/chat', json={'message': 'gl hf'})
+        self.assertEqual(response.get_json(), {'success': True})
+        self.assertEqual(self.version(), 1)
+
+        response = self.client.get('/api/match/7/events', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = (chunk.decode() for chunk in response.response)
+        self.assertTrue(next(chunks).startswith('retry:'))
+        event = next(chunks)
+        self.assertTrue(event.startswith('event: match\n'))
+        data = json.loads(event.split('data: ', 1)[1])
+        self.assertEqual((data['status'], data['version'], data['chat_reset']), ('active', 1, True))
+        self.assertEqual([m['message'] for m in data['chat_messages']], ['gl hf'])
+        response.close()
+        self.assertEqual(self.match_events.stats()['subscribers'], 0)
+
+    def test_status_is_read_only_and_cached(self):
+        conn = db.get_db_connection()
+        conn.execute('UPDATE matches SET last_action_time = 1 WHERE id = 7') # long overdue
+        conn.commit()
+        conn.close()
+
+        response = self.client.get('/api/match/7')
+        data = response.get_json()
+        self.assertEqual((data['status'], data['veto_deadline'], data['chat_messages']), ('active', 31, []))
+        self.assertEqual(self.version(), 0)
+
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/api/match/7', headers={'If-None-Match': etag}).status_code, 304)
+        self.client.post('/api/match/7/chat', json={'message': 'gl hf'})
+        response = self.client.get('/api/match/7', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['chat_messages']), 1)
+
+    def test_incremental_chat(self):
+        for i in range(5):
+            self.client.post('/api/match/7/chat', json={'message': f'msg {i}'})
+        data = self.client.get('/api/match/7/chat?since_id=0&limit=2').get_json()
+        self.assertEqual([m['message'] for m in data['messages']], ['msg 0', 'msg 1'])
+        self.assertTrue(data['has_more'])
+        data = self.client.get(f"/api/match/7/chat?since_id={data['last_id']}").get_json()
+        self.assertEqual([m['message'] for m in data['messages']], ['msg 2', 'msg 3', 'msg 4'])
+        self.assertEqual((data['has_more'], data['messages'][0]['nickname']), (False, 'PlayerOne'))
+        last_id = data['last_id']
+        data = self.client.get(f'/api/match/7/chat?since_id={last_id}').get_json()
+        self.assertEqual((data['messages'], data['last_id']), ([], last_id))
+
+        # Without a cursor: the latest page
+        data = self.client.get('/api/match/7/chat?limit=2').get_json()
+        self.assertEqual([m['message'] for m in data['messages']], ['msg 3', 'msg 4'])
+
+        # The status poll takes the same cursor
+        data = self.client.get(f'/api/match/7?since_id={last_id - 1}').get_json()
+        self.assertEqual(([m['message'] for m in data['chat_messages']], data['chat_reset']), (['msg 4'], False))
+        self.assertEqual(self.version(), 5)
+
+    def test_unknown_match(self):
+        self.assertEqual(self.client.get('/api/match/8/events').status_code, 404)
+        self.assertEqual(self.web_app.stream_slots._value, self.web_app.MATCH_EVENTS_MAX_STREAMS)
+
+    def test_stream_limit(self):
+        # Past the cap the page gets a 503 and falls back to polling
+        self.web_app.stream_slots = threading.BoundedSemaphore(1)
+        response = self.client.get('/api/match/7/events', buffered=False)
+        self.assertEqual(self.client.get('/api/match/7/events').status_code, 503)
+        response.close()
+        response = self.client.get('/api/match/7/events', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_stream_lifetime(self):
+        original_max_age = self.web_app.MATCH_EVENTS_MAX_AGE
+        self.web_app.MATCH_EVENTS_MAX_AGE = 0
+        try:
+            response = self.client.get('/api/match/7/events')
+            self.assertEqual(response.get_data(as_text=True), 'retry: 3000\n\n')
+            response.close()
+        finally:
+            self.web_app.MATCH_EVENTS_MAX_AGE = original_max_age
+        self.assertEqual(self.match_events.stats()['subscribers'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
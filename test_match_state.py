@@ -0,0 +1,106 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+from match_state import MatchStates
+from veto import MAP_POOL, POOLS
+
+POOL = POOLS['web']
+
+class MatchStatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.original_get_db = db.get_db_connection
+        self.original_is_postgres = db.IS_POSTGRES
+        db.IS_POSTGRES = False
+
+        def mock_get_db():
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        db.get_db_connection = mock_get_db
+        db.init_db()
+        self.changes = 0
+        self.states = MatchStates(POOL, on_change=self.changed, clock=lambda: 5000)
+
+        # A fresh match: no veto yet, team 1 goes first
+        self.execute("INSERT INTO matches (id, mode, status, last_action_time) VALUES (1, '1x1', 'active', 4000)")
+        self.execute('INSERT INTO match_players (match_id, user_id, team) VALUES (1, 20, 1)')
+        self.execute('INSERT INTO match_players (match_id, user_id, team) VALUES (1, 10, 2)')
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+        db.get_db_connection = self.original_get_db
+        db.IS_POSTGRES = self.original_is_postgres
+
+    def changed(self):
+        self.changes += 1
+
+    def execute(self, sql, params=()):
+        conn = db.get_db_connection()
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def test_first_load_opens_the_veto(self):
+        veto = self.states.get(1)
+        self.assertEqual((veto.order, veto.current, veto.bans), ((20, 10), 20, 0))
+        self.assertEqual(tuple(self.execute('SELECT veto_bans, current_veto_turn FROM matches WHERE id = 1')[0]), (0, 20))
+        self.assertEqual(self.changes, 1)
+        self.assertIs(self.states.get(1), veto)
+        self.assertEqual(self.states.stats()['loads'], 1)
+        self.assertIsNone(self.states.get(2))
+
+    def test_opening_starts_the_ban_timer(self):
+        for unset in (None, 0):
+            with self.subTest(last_action_time=unset):
+                self.execute('UPDATE matches SET veto_bans = NULL, last_action_time = ? WHERE id = 1', (unset,))
+                self.states.discard(1)
+                self.states.get(1)
+                self.assertEqual(self.execute('SELECT last_action_time FROM matches WHERE id = 1')[0][0], 5000)
+
+    def test_bans_write_through(self):
+        self.assertEqual(self.states.ban(1, 10, MAP_POOL[0]), 'Not your turn')
+        self.assertIsNone(self.states.ban(1, 20, MAP_POOL[0]))
+        self.assertEqual(self.states.ban(1, 10, MAP_POOL[0]), 'Map not available')
+        self.assertIsNone(self.states.ban(1, 10, MAP_POOL[1]))
+        row = self.execute('SELECT veto_bans, current_veto_turn, last_action_time, version FROM matches WHERE id = 1')[0]
+        self.assertEqual(tuple(row), (0b11, 20, 5000, 3))
+        # Bans are served from the cache; only the two refusals were rechecked
+        self.assertEqual(self.states.stats()['loads'], 3)
+        self.assertEqual([tuple(row[:3]) for row in db.get_veto_actions(1)], [(20, MAP_POOL[0], 'ban'), (10, MAP_POOL[1], 'ban')])
+
+    def test_stale_entry_is_reloaded(self):
+        # Another worker has its own cache; whoever writes second reloads
+        other = MatchStates(POOL)
+        self.states.get(1)
+        self.assertIsNone(other.ban(1, 20, MAP_POOL[0]))
+        self.assertIsNone(self.states.ban(1, 10, MAP_POOL[1]))
+        self.assertEqual(self.states.get(1).bans, 0b11)
+        self.assertIsNone(other.ban(1, 20, MAP_POOL[2]))
+        self.assertEqual(other.stats()['conflicts'], 0)
+        self.assertEqual(self.execute('SELECT veto_bans FROM matches WHERE id = 1')[0][0], 0b111)
+
+    def test_cancelled_match(self):
+        self.states.get(1)
+        self.execute("UPDATE matches SET status = 'cancelled' WHERE id = 1")
+        self.assertEqual(self.states.ban(1, 20, MAP_POOL[0]), 'Match not active')
+        self.assertEqual(self.states.stats()['conflicts'], 1)
+        self.assertEqual(db.get_veto_actions(1), [])
+
+    def test_runs_to_a_picked_map(self):
+        for i in range(len(MAP_POOL) - 1):
+            self.assertIsNone(self.states.ban(1, (20, 10)[i % 2], MAP_POOL[i]))
+        self.assertEqual(self.execute('SELECT map_picked FROM matches WHERE id = 1')[0][0], MAP_POOL[-1])
+        self.assertEqual(self.states.ban(1, 20, MAP_POOL[-1]), 'Map already picked')
+
+if __name__ == '__main__':
+    unittest.main()
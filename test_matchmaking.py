@@ -0,0 +1,92 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from matchmaking import Matchmaker, MatchmakingQueue
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class MatchmakingQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_queue(self, size):
+        return MatchmakingQueue(size, base_window=100, widen_rate=10, max_window=1000, clock=self.clock)
+
+    def test_matches_close_ratings_right_away(self):
+        queue = self.make_queue(2)
+        self.assertIsNone(queue.enqueue(1, 1000, "a"))
+        self.assertIsNone(queue.enqueue(2, 1500, "b"))
+        group = queue.enqueue(3, 1060, "c")
+        self.assertEqual(group, [(3, "c"), (1, "a")])
+        self.assertEqual(len(queue), 1)
+        self.assertNotIn(1, queue)
+
+    def test_picks_nearest_ratings(self):
+        queue = self.make_queue(4)
+        for uid, elo in ((1, 1090), (2, 950), (3, 1010), (4, 905)):
+            self.assertIsNone(queue.enqueue(uid, elo, None))
+        group = queue.enqueue(5, 1000, None)
+        self.assertEqual(sorted(uid for uid, _ in group), [1, 2, 3, 5])
+        self.assertIn(4, queue)
+
+    def test_window_widens_with_wait(self):
+        queue = self.make_queue(2)
+        queue.enqueue(1, 1000, None)
+        queue.enqueue(2, 1300, None)
+        self.assertEqual(queue.tick(), [])
+
+        self.clock.now = 25 # window 100 + 25 * 10 = 350
+        self.assertEqual(queue.tick(), [[(1, None), (2, None)]])
+        stats = queue.stats()
+        self.assertEqual((stats['queued'], stats['formed']), (0, 1))
+        self.assertEqual(sum(stats['wait_histogram']), 2)
+        self.assertEqual(stats['wait_histogram'][1], 2) # 10-30 s
+
+    def test_remove(self):
+        queue = self.make_queue(2)
+        queue.enqueue(1, 1000, "a")
+        self.assertEqual(queue.remove(1), "a")
+        self.assertIsNone(queue.remove(1))
+        self.assertIsNone(queue.enqueue(2, 1000, "b"))
+        with self.assertRaises(ValueError):
+            queue.enqueue(2, 1000, "b")
+
+    def test_groups_respect_window(self):
+        rng = random.Random(7)
+        queue = self.make_queue(4)
+        groups = []
+        for uid in range(500):
+            elo = rng.randint(500, 2500)
+            group = queue.enqueue(uid, elo, elo)
+            if group:
+                groups.append(group)
+        self.assertTrue(groups)
+        for group in groups:
+            anchor_elo = group[0][1]
+            self.assertTrue(all(abs(elo - anchor_elo) <= 100 for _, elo in group))
+        self.assertEqual(len(queue) + 4 * len(groups), 500)
+
+class MatchmakerTestCase(unittest.TestCase):
+    def test_one_queue_per_player(self):
+        matchmaker = Matchmaker({"1x1": 2, "2x2": 4})
+        matchmaker.join("2x2", 1, 1000, None)
+        self.assertEqual(matchmaker.locate(1), "2x2")
+        with self.assertRaises(ValueError):
+            matchmaker.join("1x1", 1, 1000, None)
+        self.assertEqual(matchmaker.leave(1), "2x2")
+        self.assertIsNone(matchmaker.leave(1))
+        self.assertEqual(matchmaker.join("1x1", 2, 1000, None), None)
+        self.assertEqual(matchmaker.join("1x1", 1, 1000, None), [(1, None), (2, None)])
+        self.assertEqual(matchmaker.stats()["1x1"]['formed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
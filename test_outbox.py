@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import asyncio
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, GetChatMember, SendMessage
+
+import outbox
+
+class OutboxTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_priority_order(self):
+        middleware = outbox.OutboxMiddleware(rate=20, chat_rate=100, chat_burst=100)
+        middleware._global.tokens = 0 # start with an empty budget so requests queue up
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(method.chat_id)
+            return True
+
+        async def send(method, level=None):
+            if level is None:
+                return await middleware(make_request, None, method)
+            with outbox.priority(level):
+                return await middleware(make_request, None, method)
+
+        await asyncio.gather(
+            send(EditMessageText(chat_id=1, message_id=1, text='lobby')),
+            send(SendMessage(chat_id=2, text='reply')),
+            send(SendMessage(chat_id=3, text='match found'), outbox.HIGH),
+        )
+        self.assertEqual(sent, [3, 2, 1])
+
+    async def test_per_chat_rate(self):
+        middleware = outbox.OutboxMiddleware(rate=1000, chat_rate=20, chat_burst=1)
+
+        async def make_request(bot, method):
+            return time.monotonic()
+
+        started = time.monotonic()
+        times = await asyncio.gather(*(middleware(make_request, None, SendMessage(chat_id=1, text='x')) for _ in range(4)))
+        self.assertGreaterEqual(max(times) - started, 0.14)
+        self.assertEqual(middleware.stats()['sent'], 4)
+
+        # Other chats and non-message methods are not held back
+        started = time.monotonic()
+        await middleware(make_request, None, SendMessage(chat_id=2, text='x'))
+        await middleware(make_request, None, GetChatMember(chat_id=1, user_id=1))
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    async def test_retry_after(self):
+        middleware = outbox.OutboxMiddleware(rate=1000, chat_rate=1000, chat_burst=10, max_retries=1)
+        method = SendMessage(chat_id=1, text='x')
+        calls = []
+
+        async def make_request(bot, method):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise TelegramRetryAfter(method=method, message='Flood control', retry_after=0.1)
+            return 'ok'
+
+        self.assertEqual(await middleware(method=method, make_request=make_request, bot=None), 'ok')
+        self.assertGreaterEqual(calls[1] - calls[0], 0.09)
+
+        async def always_flood(bot, method):
+            raise TelegramRetryAfter(method=method, message='Flood control', retry_after=0)
+
+        with self.assertRaises(TelegramRetryAfter):
+            await middleware(always_flood, None, method)
+        self.assertEqual(middleware.stats()['dropped'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
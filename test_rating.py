@@ -0,0 +1,49 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import rating
+
+def replay_one_by_one(history):
+    ratings = {}
+    for mode, winners, losers in history:
+        gain = rating.win_gain([ratings.get(u, 1000) for u in winners], [ratings.get(u, 1000) for u in losers], mode)
+        for uid in winners:
+            ratings[uid] = ratings.get(uid, 1000) + gain
+        for uid in losers:
+            ratings[uid] = ratings.get(uid, 1000) - gain
+    return ratings
+
+class RatingTestCase(unittest.TestCase):
+    def test_gains(self):
+        # Even match: half of K, same as the old fixed gains on average
+        self.assertEqual(rating.match_gains([1000, 1000], [1000, 1000], "2x2"), (25, 25))
+        self.assertEqual(rating.match_gains([1000], [1000], "1x1"), (10, 10))
+        # Favourite gains less, underdog more; zero-sum per match
+        favourite, underdog = rating.match_gains([1400, 1200], [1000, 1000], "2x2")
+        self.assertLess(favourite, 25)
+        self.assertGreater(underdog, 25)
+        self.assertEqual(favourite + underdog, rating.k_factor("2x2"))
+        self.assertEqual(rating.k_factor(None), rating.DEFAULT_K)
+
+    def test_replay_matches_sequential(self):
+        rng = random.Random(11)
+        history = []
+        for _ in range(3000):
+            mode, size = rng.choice([("1x1", 1), ("2x2", 2), ("5x5", 5)])
+            players = rng.sample(range(300), 2 * size)
+            history.append((mode, players[:size], players[size:]))
+        self.assertEqual(rating.replay(history), replay_one_by_one(history))
+
+    def test_replay_initial_ratings(self):
+        self.assertEqual(rating.replay([]), {})
+        ratings = rating.replay([("1x1", [1], [2]), ("1x1", [2], [1])], initial={1: 1500})
+        first = rating.win_gain([1500], [1000], "1x1")
+        second = rating.win_gain([1000 - first], [1500 + first], "1x1")
+        self.assertEqual(ratings, {1: 1500 + first - second, 2: 1000 - first + second})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from state_store import StateStore
+
+class StateStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open_store(self, snapshot_every=1000):
+        store = StateStore(self.path, snapshot_every=snapshot_every)
+        tables = {"active_matches": {}, "admin_messages": {}, "clan_war_queue": []}
+        for name, table in tables.items():
+            store.track(name, table)
+        return store, tables
+
+    def test_restore_after_restart(self):
+        store, tables = self.open_store()
+        store.restore()
+        tables["active_matches"][1] = {"phase": "ban", "turn": "ct", "maps": ["Rust", "Dune"], "accepted": {10, 11}}
+        tables["active_matches"][2] = {"phase": "pick"}
+        tables["admin_messages"][2] = {100: 5}
+        tables["clan_war_queue"].append((7, [10, 11]))
+        for key in (1, 2):
+            store.mark("active_matches", key)
+        store.mark("admin_messages", 2)
+        store.mark("clan_war_queue")
+        store.flush()
+
+        # Later changes, including a delete
+        tables["active_matches"][1]["turn"] = "t"
+        store.mark("active_matches", 1)
+        del tables["active_matches"][2]
+        store.mark("active_matches", 2)
+        store.flush()
+        # Not flushed yet: lost on crash
+        tables["admin_messages"][3] = {100: 6}
+        store.mark("admin_messages", 3)
+
+        restarted, restored = self.open_store()
+        self.assertEqual(restarted.restore(), 3)
+        self.assertEqual(restored["active_matches"], {1: {"phase": "ban", "turn": "t", "maps": ["Rust", "Dune"], "accepted": {10, 11}}})
+        self.assertEqual(restored["admin_messages"], {2: {100: 5}})
+        self.assertEqual(restored["clan_war_queue"], [(7, [10, 11])])
+
+    def test_snapshot_compacts_journal(self):
+        store, tables = self.open_store(snapshot_every=10)
+        store.restore()
+        for match_id in range(25):
+            tables["active_matches"][match_id] = {"turn": "ct"}
+            store.mark("active_matches", match_id)
+            store.flush()
+        self.assertEqual(store.snapshots, 3) # restore + 2 compactions
+        self.assertLess(os.path.getsize(self.path + '.journal'), os.path.getsize(self.path + '.snapshot'))
+
+        restarted, restored = self.open_store()
+        restarted.restore()
+        self.assertEqual(len(restored["active_matches"]), 25)
+
+    def test_torn_journal_tail(self):
+        store, tables = self.open_store()
+        store.restore()
+        tables["active_matches"][1] = {"turn": "ct"}
+        store.mark("active_matches", 1)
+        store.flush()
+        tables["active_matches"][2] = {"turn": "t"}
+        store.mark("active_matches", 2)
+        store.flush()
+        # Crash in the middle of the last write
+        with open(self.path + '.journal', 'r+b') as f:
+            f.truncate(os.path.getsize(self.path + '.journal') - 5)
+
+        restarted, restored = self.open_store()
+        with self.assertLogs(level='WARNING'):
+            restarted.restore()
+        self.assertEqual(restored["active_matches"], {1: {"turn": "ct"}})
+
+    def test_crash_between_snapshot_and_journal_reset(self):
+        store, tables = self.open_store()
+        store.restore()
+        tables["active_matches"][1] = {"turn": "ct"}
+        store.mark("active_matches", 1)
+        store.flush()
+        with open(self.path + '.journal', 'rb') as f:
+            stale_journal = f.read()
+        tables["active_matches"][1] = {"turn": "t"}
+        store.snapshot()
+        # The old journal survived next to the newer snapshot
+        with open(self.path + '.journal', 'wb') as f:
+            f.write(stale_journal)
+
+        restarted, restored = self.open_store()
+        restarted.restore()
+        self.assertEqual(restored["active_matches"], {1: {"turn": "t"}})
+
+    def test_close_waits_for_a_running_write(self):
+        store, tables = self.open_store()
+        store.restore()
+        tables["active_matches"][1] = {"phase": "ban"}
+        store.mark("active_matches", 1)
+        chunks = store._collect()
+
+        # run() was cancelled while its thread is still in _append
+        entered, go = threading.Event(), threading.Event()
+        journal = store._journal
+        class SlowJournal:
+            def write(self, data):
+                entered.set()
+                go.wait()
+                return journal.write(data)
+            def __getattr__(self, name):
+                return getattr(journal, name)
+        store._journal = SlowJournal()
+        writer = threading.Thread(target=store._append, args=(chunks,))
+        writer.start()
+        entered.wait()
+        closer = threading.Thread(target=store.close)
+        closer.start()
+        closer.join(0.05)
+        self.assertTrue(closer.is_alive())
+        go.set()
+        writer.join()
+        closer.join()
+        self.assertIsNone(store._journal)
+        self.assertEqual(store.load()[1]["active_matches"], {1: {"phase": "ban"}})
+
+    def test_recovery_is_fast(self):
+        store, tables = self.open_store(snapshot_every=10 ** 9)
+        store.restore()
+        for match_id in range(5000):
+            tables["active_matches"][match_id] = {
+                "players": [(uid, {"nickname": f"Player{uid}", "level": 5, "game_id": str(uid)}) for uid in range(10)],
+                "maps": ["Sandstone", "Province", "Breeze"], "turn": "ct", "phase": "ban", "message_ids": {uid: uid for uid in range(10)},
+            }
+            store.mark("active_matches", match_id)
+        store.flush()
+
+        restarted, restored = self.open_store()
+        started = time.perf_counter()
+        restarted.restore()
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(len(restored["active_matches"]), 5000)
+
+if __name__ == '__main__':
+    unittest.main()
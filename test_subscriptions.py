@@ -0,0 +1,86 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from subscriptions import SubscriptionCache
+
+class FakeTelegram:
+    def __init__(self, subscribed=True):
+        self.subscribed = subscribed
+        self.down = False
+        self.calls = 0
+
+    async def fetch(self, user_id):
+        self.calls += 1
+        if self.down:
+            raise RuntimeError("Telegram API unavailable")
+        return self.subscribed
+
+class SubscriptionCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_subscribers_are_cached(self):
+        api = FakeTelegram()
+        subs = SubscriptionCache(api.fetch, ttl=10, refresh_ahead=1)
+        for _ in range(5):
+            self.assertTrue(await subs.check(1))
+        self.assertEqual(api.calls, 1)
+        subs.invalidate(1)
+        self.assertTrue(await subs.check(1))
+        self.assertEqual(api.calls, 2)
+
+    async def test_negative_ttl(self):
+        api = FakeTelegram(subscribed=False)
+        subs = SubscriptionCache(api.fetch, ttl=10, negative_ttl=0.02)
+        self.assertFalse(await subs.check(1))
+        self.assertFalse(await subs.check(1))
+        self.assertEqual(api.calls, 1)
+        # The user subscribes: it counts once the short entry runs out
+        api.subscribed = True
+        await asyncio.sleep(0.03)
+        self.assertTrue(await subs.check(1))
+        self.assertEqual(api.calls, 2)
+
+    async def test_refresh_ahead(self):
+        api = FakeTelegram()
+        subs = SubscriptionCache(api.fetch, ttl=0.1, refresh_ahead=0.08)
+        self.assertTrue(await subs.check(1))
+        await asyncio.sleep(0.03)
+        # Close to expiry: answered from the cache, refreshed once in the background
+        api.subscribed = False
+        self.assertTrue(await subs.check(1))
+        self.assertTrue(await subs.check(1))
+        await asyncio.sleep(0)
+        self.assertEqual(api.calls, 2)
+        self.assertFalse(await subs.check(1))
+        self.assertEqual(subs.stats()['refreshing'], 0)
+
+    async def test_refresh_keeps_a_newer_task(self):
+        api = FakeTelegram()
+        subs = SubscriptionCache(api.fetch, ttl=10, refresh_ahead=1)
+        newer = asyncio.create_task(asyncio.sleep(0))
+        subs._refreshing[1] = newer
+        # A direct refresh finishing doesn't free the slot of the background one
+        self.assertTrue(await subs.refresh(1))
+        self.assertIs(subs._refreshing.get(1), newer)
+        await newer
+
+    async def test_api_outage_fails_open_without_retry_storm(self):
+        api = FakeTelegram()
+        api.down = True
+        # Error entries live shorter than the refresh-ahead window, yet aren't refreshed
+        subs = SubscriptionCache(api.fetch, ttl=10, error_ttl=0.03, refresh_ahead=1)
+        for _ in range(10):
+            self.assertTrue(await subs.check(1))
+        await asyncio.sleep(0)
+        self.assertEqual((api.calls, subs.stats()['errors']), (1, 1))
+
+        api.down = False
+        api.subscribed = False
+        await asyncio.sleep(0.04)
+        self.assertFalse(await subs.check(1))
+        self.assertEqual(api.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
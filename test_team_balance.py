@@ -0,0 +1,64 @@
+import os
+import sys
+import itertools
+import random
+import time
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from team_balance import balance_teams
+
+def brute_force(elos):
+    n = len(elos)
+    best = None
+    for team in itertools.combinations(range(n), n // 2):
+        diff = abs(2 * sum(elos[i] for i in team) - sum(elos)) / (n // 2)
+        best = diff if best is None else min(best, diff)
+    return best
+
+class TeamBalanceTestCase(unittest.TestCase):
+    def test_2x2(self):
+        team_a, team_b, diff = balance_teams([1500, 1000, 1400, 1100])
+        self.assertEqual((team_a, team_b, diff), ([0, 1], [2, 3], 0.0))
+
+    def test_matches_brute_force(self):
+        rng = random.Random(3)
+        for _ in range(50):
+            elos = [rng.randint(600, 2400) for _ in range(10)]
+            team_a, team_b, diff = balance_teams(elos)
+            self.assertEqual(sorted(team_a + team_b), list(range(10)))
+            self.assertEqual(len(team_a), 5)
+            self.assertAlmostEqual(diff, brute_force(elos))
+
+    def test_constraints(self):
+        elos = [2000, 1990, 1000, 1010]
+        # Unconstrained, the two strongest are split
+        self.assertEqual(balance_teams(elos)[:2], ([0, 2], [1, 3]))
+        # Clan pair stays together
+        team_a, team_b, diff = balance_teams(elos, together=[(0, 1)])
+        self.assertEqual((team_a, team_b), ([0, 1], [2, 3]))
+        self.assertEqual(diff, 990.0)
+        # Captains in different teams
+        team_a, _, _ = balance_teams(elos, apart=[(0, 2)])
+        self.assertNotIn(2, team_a)
+        self.assertIsNone(balance_teams(elos, together=[(0, 1)], apart=[(0, 1)]))
+
+    def test_odd_team(self):
+        with self.assertRaises(ValueError):
+            balance_teams([1000, 1000, 1000])
+
+    def test_benchmark(self):
+        # 5x5 with a captain constraint: well under a millisecond per match. Timing
+        # is only printed, a loaded machine must not fail the suite
+        rng = random.Random(5)
+        matches = [[rng.randint(600, 2400) for _ in range(10)] for _ in range(1000)]
+        balance_teams(matches[0])
+        started = time.perf_counter()
+        for elos in matches:
+            balance_teams(elos, apart=[(0, 1)])
+        per_match = (time.perf_counter() - started) / len(matches)
+        print(f"team balance 5x5: {per_match * 1e6:.1f} us per match")
+
+if __name__ == '__main__':
+    unittest.main()
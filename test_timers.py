@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from timers import TimerService
+
+class TimerServiceTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_fires_in_order(self):
+        timers = TimerService()
+        fired = []
+        async def record(name):
+            fired.append(name)
+
+        timers.schedule((1, "ban"), 0.03, record, "ban")
+        timers.schedule((2, "accept"), 0.01, record, "accept")
+        self.assertEqual(timers.pending(), 2)
+        await asyncio.sleep(0.06)
+        self.assertEqual(fired, ["accept", "ban"])
+        self.assertEqual((timers.pending(), timers.fired), (0, 2))
+
+    async def test_reschedule_and_cancel(self):
+        timers = TimerService()
+        fired = []
+        async def record(name):
+            fired.append(name)
+
+        # Same key replaces the previous timer (a new turn restarts the countdown)
+        timers.schedule((1, "ban"), 0.01, record, "first turn")
+        timers.schedule((1, "ban"), 0.02, record, "second turn")
+        timers.schedule((1, "admin_buttons_7"), 0.01, record, "buttons")
+        timers.schedule((2, "pick"), 0.01, record, "other match")
+        self.assertEqual(timers.pending(1), 2)
+
+        self.assertTrue(timers.cancel((1, "admin_buttons_7")))
+        self.assertFalse(timers.cancel((1, "admin_buttons_7")))
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted(fired), ["other match", "second turn"])
+
+        timers.schedule((3, "ban"), 0.01, record, "ban")
+        timers.schedule((3, "pick"), 0.01, record, "pick")
+        self.assertEqual(timers.cancel_group(3), 2)
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(fired), 2)
+        self.assertEqual(timers.pending(), 0)
+
+    async def test_failing_callback_does_not_stop_loop(self):
+        timers = TimerService()
+        fired = []
+        async def boom():
+            raise RuntimeError("boom")
+        async def record():
+            fired.append(True)
+
+        timers.schedule((1, "a"), 0.01, boom)
+        timers.schedule((1, "b"), 0.02, record)
+        with self.assertLogs(level='ERROR'):
+            await asyncio.sleep(0.05)
+        self.assertEqual(fired, [True])
+
+if __name__ == '__main__':
+    unittest.main()
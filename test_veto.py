@@ -0,0 +1,86 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from veto import MAP_POOL, POOLS, Veto, pool_for_mode
+
+class MapPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = POOLS['web']
+
+    def test_ban_until_one_map_left(self):
+        bans = 0
+        self.assertEqual(self.pool.remaining(bans), len(MAP_POOL))
+        for i in range(len(MAP_POOL) - 1):
+            self.assertIsNone(self.pool.last_map(bans))
+            bans = self.pool.ban(bans, i)
+        self.assertEqual(self.pool.remaining(bans), 1)
+        self.assertEqual(self.pool.last_map(bans), MAP_POOL[-1])
+        self.assertEqual(self.pool.names(self.pool.available(bans)), [MAP_POOL[-1]])
+
+    def test_ban_rejects_banned_and_unknown_maps(self):
+        bans = self.pool.ban(0, 2)
+        self.assertRaises(ValueError, self.pool.ban, bans, 2)
+        self.assertRaises(ValueError, self.pool.ban, bans, len(MAP_POOL))
+        self.assertRaises(ValueError, self.pool.ban, bans, -1)
+
+    def test_status_round_trip(self):
+        bans = self.pool.ban(self.pool.ban(0, 0), 3)
+        status = self.pool.status(bans, picked=MAP_POOL[5])
+        self.assertEqual(status[MAP_POOL[0]], 'banned')
+        self.assertEqual(status[MAP_POOL[5]], 'picked')
+        self.assertEqual(status[MAP_POOL[1]], 'available')
+        self.assertEqual(self.pool.from_status(status), bans)
+        self.assertEqual(self.pool.from_status({'Nuke': 'banned'}), 0)
+
+    def test_random_available_skips_banned(self):
+        bans = self.pool.full & ~0b1010
+        rng = random.Random(1)
+        self.assertTrue(all(self.pool.random_available(bans, rng) in (1, 3) for _ in range(20)))
+
+    def test_pool_for_mode(self):
+        self.assertIs(pool_for_mode('1x1'), POOLS['1x1'])
+        for mode in ('2x2', '5x5', '2x2_clan'):
+            self.assertIs(pool_for_mode(mode), POOLS['2x2'])
+
+class VetoTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = POOLS['web']
+
+    def test_turns_alternate_until_a_map_is_picked(self):
+        veto = Veto(self.pool, (1, 2))
+        for i in range(len(MAP_POOL) - 2):
+            self.assertEqual(veto.current, (1, 2)[i % 2])
+            self.assertEqual(veto.ban(i), [((1, 2)[i % 2], MAP_POOL[i], 'ban')])
+        actions = veto.ban(len(MAP_POOL) - 2)
+        self.assertEqual(actions, [(2, MAP_POOL[-2], 'ban'), (None, MAP_POOL[-1], 'pick')])
+        self.assertEqual(veto.picked, MAP_POOL[-1])
+        self.assertEqual(veto.check(2, len(MAP_POOL) - 1), 'Map already picked')
+        self.assertRaises(ValueError, veto.ban, len(MAP_POOL) - 1)
+
+    def test_check(self):
+        veto = Veto.resume(self.pool, ('ct', 't'), self.pool.ban(0, 3), 't')
+        self.assertEqual(veto.current, 't')
+        self.assertEqual(veto.check('ct', 0), 'Not your turn')
+        self.assertEqual(veto.check('t', 3), 'Map not available')
+        self.assertEqual(veto.check('t', -1), 'Map not available')
+        self.assertIsNone(veto.check('t', 0))
+
+    def test_copy_leaves_the_original_alone(self):
+        veto = Veto(self.pool, (1, 2))
+        moved = veto.copy()
+        moved.ban(0)
+        self.assertEqual((veto.bans, veto.current), (0, 1))
+        self.assertEqual((moved.bans, moved.current), (1, 2))
+
+    def test_timeout(self):
+        veto = Veto(self.pool, (1, 2), self.pool.full & ~(1 << self.pool.index['Pool'] | 1 << self.pool.index['Yard']))
+        actions = veto.timeout(rng=random.Random(1))
+        self.assertIn(veto.picked, ('Pool', 'Yard'))
+        self.assertEqual([(player, action) for player, _, action in actions], [(1, 'auto_ban'), (None, 'pick')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import random
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import db
+from veto import MAP_POOL, POOLS
+from match_state import MatchStates
+from veto_sweeper import VetoSweeper
+
+POOL = POOLS['web']
+
+class VetoSweeperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp()
+        self.original_get_db = db.get_db_connection
+        self.original_is_postgres = db.IS_POSTGRES
+        db.IS_POSTGRES = False
+
+        def mock_get_db():
+            conn = sqlite3.connect(self.db_path)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        db.get_db_connection = mock_get_db
+        db.init_db()
+        self.now = 10000
+        self.changes = 0
+        self.states = MatchStates(POOL, on_change=self.changed, clock=lambda: self.now)
+        self.sweeper = VetoSweeper(self.states, 30, clock=lambda: self.now, rng=random.Random(1))
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+        db.get_db_connection = self.original_get_db
+        db.IS_POSTGRES = self.original_is_postgres
+
+    def changed(self):
+        self.changes += 1
+
+    def execute(self, sql, params=()):
+        conn = db.get_db_connection()
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        conn.close()
+        return rows
+
+    def add_match(self, match_id, last_action_time, status='active'):
+        self.execute('INSERT INTO matches (id, mode, status, veto_bans, current_veto_turn, last_action_time) VALUES (?, ?, ?, ?, ?, ?)',
+                     (match_id, '1x1', status, 0, 1, last_action_time))
+        for user_id in (1, 2):
+            self.execute('INSERT INTO match_players (match_id, user_id) VALUES (?, ?)', (match_id, user_id))
+
+    def test_bans_only_overdue_matches(self):
+        self.add_match(1, self.now - 31)   # overdue, nobody watching
+        self.add_match(2, self.now - 10)   # turn still running
+        self.add_match(3, self.now - 60, status='finished')
+        self.add_match(4, None)            # no timer: migration 11 / db.start_veto set one
+        self.add_match(5, 0)               # the schema default is no timer either
+
+        self.assertEqual(self.sweeper.tick(), [1])
+        self.assertEqual(self.changes, 1)
+        row = self.execute('SELECT veto_bans, current_veto_turn, last_action_time, version FROM matches WHERE id = 1')[0]
+        self.assertEqual(POOL.remaining(row[0]), len(MAP_POOL) - 1)
+        self.assertEqual((row[1], row[2], row[3]), (2, self.now, 1))
+        # The sweeper only reads matches it doesn't advance
+        self.assertEqual(tuple(self.execute('SELECT last_action_time, version FROM matches WHERE id = 4')[0]), (None, 0))
+        self.assertEqual(tuple(self.execute('SELECT last_action_time, version FROM matches WHERE id = 5')[0]), (0, 0))
+        self.assertEqual(self.execute('SELECT version FROM matches WHERE id = 2')[0][0], 0)
+
+        # Nothing is due until the next turn runs out
+        self.assertEqual(self.sweeper.tick(), [])
+        self.now += 30
+        self.assertEqual(sorted(self.sweeper.tick()), [1, 2])
+
+    def test_runs_to_a_picked_map(self):
+        self.add_match(1, self.now - 31)
+        for _ in range(len(MAP_POOL) - 1):
+            self.assertEqual(self.sweeper.tick(), [1])
+            self.now += 30
+        row = self.execute('SELECT veto_bans, map_picked FROM matches WHERE id = 1')[0]
+        self.assertEqual(POOL.last_map(row[0]), row[1])
+        # Who banned what is kept: alternating turns, then the pick
+        actions = db.get_veto_actions(1)
+        self.assertEqual([row[0] for row in actions[:4]], [1, 2, 1, 2])
+        self.assertEqual([row[2] for row in actions], ['auto_ban'] * (len(MAP_POOL) - 1) + ['pick'])
+        self.assertEqual(self.sweeper.tick(), [])
+        self.assertEqual(self.sweeper.bans, len(MAP_POOL) - 1)
+
+    def test_player_ban_in_between_wins(self):
+        self.add_match(1, self.now - 31)
+        overdue = db.get_overdue_vetoes(self.now - 30)
+        # The player bans right before the sweeper writes: the stale update is skipped
+        self.assertIsNone(self.states.ban(1, 1, MAP_POOL[0]))
+        self.assertEqual(self.states.time_out(overdue, self.now), [])
+        self.assertEqual([row[2] for row in db.get_veto_actions(1)], ['ban'])
+        # and the cache still has the player's ban
+        self.assertEqual(self.states.get(1).current, 2)
+
+if __name__ == '__main__':
+    unittest.main()
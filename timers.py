@@ -0,0 +1,95 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+class TimerService:
+    # All bot timeouts on one heap and one loop task instead of a sleeping task
+    # per timeout. Timers are keyed by (match_id, phase): scheduling a key again
+    # replaces its previous timer, and cancel_group(match_id) drops all of a match's.
+    def __init__(self):
+        self._heap = []    # [when, seq, key]
+        self._timers = {}  # key -> (when, seq, callback, args)
+        self._groups = {}  # key[0] -> {key}
+        self._seq = itertools.count()
+        self._task = None
+        self._wakeup = None
+        self._firing = set() # callbacks in flight; the loop only keeps weak references
+        self.fired = 0
+
+    def schedule(self, key, delay, callback, *args):
+        # callback(*args) is awaited after `delay` seconds
+        self.cancel(key)
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        seq = next(self._seq)
+        self._timers[key] = (when, seq, callback, args)
+        self._groups.setdefault(key[0], set()).add(key)
+        heapq.heappush(self._heap, [when, seq, key])
+
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        elif self._heap[0][1] == seq:
+            # New earliest deadline: the loop is sleeping for too long
+            self._wakeup.set()
+
+    def cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        group = self._groups.get(key[0])
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self._groups[key[0]]
+        # Heap entries are dropped lazily; compact once they are mostly dead
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers):
+            self._heap = [entry for entry in self._heap if self._is_live(entry)]
+            heapq.heapify(self._heap)
+        return True
+
+    def cancel_group(self, group):
+        return sum(self.cancel(key) for key in list(self._groups.get(group, ())))
+
+    def pending(self, group=None):
+        if group is None:
+            return len(self._timers)
+        return len(self._groups.get(group, ()))
+
+    def _is_live(self, entry):
+        timer = self._timers.get(entry[2])
+        return timer is not None and timer[1] == entry[1]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._heap:
+                entry = self._heap[0]
+                if not self._is_live(entry):
+                    heapq.heappop(self._heap)
+                    continue
+                delay = entry[0] - loop.time()
+                if delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._heap)
+                key = entry[2]
+                _, _, callback, args = self._timers[key]
+                self.cancel(key)
+                self.fired += 1
+                task = loop.create_task(self._fire(key, callback, args))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+        finally:
+            self._task = None
+
+    async def _fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception:
+            logging.exception(f"Timer {key} failed")
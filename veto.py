@@ -0,0 +1,123 @@
+import random
+
+# Map veto state as a bitmask: bit i set = map i of the pool is banned. The
+# web stores it in matches.veto_bans (the picked map stays in map_picked), the
+# bot keeps it in match["bans"]; every ban is also logged to veto_actions.
+# Pools are fixed and ordered, so a map is just its index.
+
+MAP_POOL = ['Cabbleway', 'Pipeline', 'Bridge', 'Pool', 'Temple', 'Yard', 'Desert'] # web match room
+MAP_LIST_2X2 = ["Sandstone", "Province", "Breeze", "Dune", "Zone 7", "Rust", "Hanami"]
+MAP_LIST_1X1 = ["Temple", "Yard", "Bridge", "Pool", "Desert", "Pipeline", "Cableway"]
+
+class MapPool:
+    def __init__(self, name, maps):
+        self.name = name
+        self.maps = tuple(maps)
+        self.index = {m: i for i, m in enumerate(self.maps)}
+        self.full = (1 << len(self.maps)) - 1
+
+    def available(self, bans):
+        # Mask of the maps still in play
+        return self.full & ~(bans or 0)
+
+    def is_available(self, bans, i):
+        return 0 <= i < len(self.maps) and (self.available(bans) >> i) & 1 == 1
+
+    def remaining(self, bans):
+        return bin(self.available(bans)).count('1')
+
+    def indexes(self, mask):
+        return [i for i in range(len(self.maps)) if (mask >> i) & 1]
+
+    def names(self, mask):
+        return [self.maps[i] for i in self.indexes(mask)]
+
+    def ban(self, bans, i):
+        # New mask with map i banned; ValueError if it isn't available
+        if not self.is_available(bans, i):
+            raise ValueError(f"map {i} is not available in pool {self.name}")
+        return (bans or 0) | (1 << i)
+
+    def last_map(self, bans):
+        # The map left once all others are banned, else None
+        available = self.available(bans)
+        if available and available & (available - 1) == 0:
+            return self.maps[available.bit_length() - 1]
+        return None
+
+    def random_available(self, bans, rng=random):
+        return rng.choice(self.indexes(self.available(bans)))
+
+    def status(self, bans, picked=None):
+        # {map: 'available'|'banned'|'picked'}, the old veto_status JSON
+        return {m: 'picked' if m == picked else 'banned' if (bans or 0) >> i & 1 else 'available'
+                for i, m in enumerate(self.maps)}
+
+    def from_status(self, status):
+        # Bans mask from an old veto_status dict; unknown maps are ignored
+        bans = 0
+        for m, s in (status or {}).items():
+            if s == 'banned' and m in self.index:
+                bans |= 1 << self.index[m]
+        return bans
+
+class Veto:
+    # One match's veto as a state machine: the turn order is fixed when the veto
+    # starts and turn n belongs to order[n % len(order)], so finding whose turn
+    # it is, or the next one, never needs the player list. The web orders user
+    # ids, the bot sides ('ct', 't' or 'p1', 'p2').
+    __slots__ = ('pool', 'order', 'bans', 'turn', 'picked')
+
+    def __init__(self, pool, order, bans=0, turn=0):
+        self.pool = pool
+        self.order = tuple(order)
+        self.bans = bans or 0
+        self.turn = turn
+        self.picked = pool.last_map(self.bans)
+
+    @classmethod
+    def resume(cls, pool, order, bans, current):
+        # From stored state: the bans mask and whose turn it is
+        order = tuple(order)
+        return cls(pool, order, bans, order.index(current) if current in order else 0)
+
+    @property
+    def current(self):
+        return self.order[self.turn % len(self.order)]
+
+    def copy(self):
+        return Veto(self.pool, self.order, self.bans, self.turn)
+
+    def check(self, player, i):
+        # Why `player` can't ban map i now, or None if they can
+        if self.picked:
+            return 'Map already picked'
+        if str(player) != str(self.current):
+            return 'Not your turn'
+        if not self.pool.is_available(self.bans, i):
+            return 'Map not available'
+        return None
+
+    def ban(self, i, player=None, action='ban'):
+        # Bans map i on the current turn and passes it on, or picks the last map.
+        # Returns the actions for db.log_veto_action; ValueError if map i can't go.
+        if self.picked:
+            raise ValueError(f"veto in pool {self.pool.name} is over")
+        self.bans = self.pool.ban(self.bans, i)
+        actions = [(self.current if player is None else player, self.pool.maps[i], action)]
+        self.picked = self.pool.last_map(self.bans)
+        if self.picked:
+            actions.append((None, self.picked, 'pick'))
+        else:
+            self.turn += 1
+        return actions
+
+    def timeout(self, player=None, rng=random):
+        # The current turn ran out: a random available map is banned for it
+        return self.ban(self.pool.random_available(self.bans, rng), player, 'auto_ban')
+
+POOLS = {pool.name: pool for pool in (MapPool('web', MAP_POOL), MapPool('1x1', MAP_LIST_1X1), MapPool('2x2', MAP_LIST_2X2))}
+
+def pool_for_mode(mode):
+    # Bot map pool: 1x1 has its own, 2x2/5x5/clan matches share the 2x2 one
+    return POOLS['1x1'] if mode == '1x1' else POOLS['2x2']
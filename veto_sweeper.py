@@ -0,0 +1,47 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import db
+
+# Background auto-ban for the web map veto. Every VETO_SWEEP_INTERVAL seconds
+# one indexed read finds active matches whose ban turn is older than the
+# timeout, and match_state.MatchStates bans a random available map for each of
+# them in a single transaction. Matches advance whether or not anyone has the
+# room open, and GET /api/match/<id> never writes.
+
+VETO_SWEEP_INTERVAL = float(os.environ.get('VETO_SWEEP_INTERVAL', 1))
+
+class VetoSweeper:
+    def __init__(self, states, timeout, interval=VETO_SWEEP_INTERVAL, clock=time.time, rng=random):
+        self.states = states # match_state.MatchStates, notifies its on_change
+        self.timeout = timeout
+        self.interval = interval
+        self.clock = clock
+        self.rng = rng
+        self._thread = None
+        self.ticks = 0
+        self.bans = 0
+
+    def tick(self):
+        # Returns the ids of the matches that were advanced
+        now = int(self.clock())
+        applied = self.states.time_out(db.get_overdue_vetoes(now - self.timeout), now, self.rng)
+        self.ticks += 1
+        self.bans += len(applied)
+        return applied
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='veto-sweeper', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logging.error(f"Veto sweeper failed: {e}")
+            time.sleep(self.interval)
@@ -1,9 +1,11 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, g, send_file, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, g, send_file, jsonify
 import os
 import sys
 import json
 import random
 import logging
+import threading
+import time
 from datetime import datetime
 import sqlite3
 
@@ -16,7 +18,8 @@ logging.basicConfig(filename=log_file, level=logging.ERROR,
                     format='%(asctime)s %(levelname)s: %(message)s')
 
 # Constants
-MAP_POOL = ['Cabbleway', 'Pipeline', 'Bridge', 'Pool', 'Temple', 'Yard', 'Desert']
+VETO_TIMEOUT = 30 # seconds per ban
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', 50)) # chat messages per response
 DATABASE_URL = os.environ.get('DATABASE_URL')
 # Ensure IS_POSTGRES is consistent with db.py
 try:
@@ -37,6 +40,13 @@ except Exception as e:
     print(f"Error initializing database: {e}")
     logging.error(f"Error initializing database: {e}")
 
+import rating
+from veto import MAP_POOL, POOLS
+from group_commit import GroupCommit
+from match_events import MATCH_EVENTS_HEARTBEAT, MATCH_EVENTS_MAX_AGE, MATCH_EVENTS_MAX_STREAMS, MatchEventHub
+from match_state import MatchStates
+from veto_sweeper import VetoSweeper
+
 # Explicitly set template and static folders relative to this file
 basedir = os.path.abspath(os.path.dirname(__file__))
 template_dir = os.path.join(basedir, 'templates')
@@ -48,13 +58,84 @@ app.secret_key = os.environ.get('SECRET_KEY', 'super-secret-key-change-me')
 def get_db_connection():
     try:
         import db as database_module
-        return database_module.get_db_connection()
+        conn = database_module.get_db_connection()
+        # Remember pooled connections so teardown can hand back any that a route forgot to close
+        g.setdefault('_db_connections', []).append(conn)
+        return conn
     except Exception as e:
         print(f"Error connecting to database: {e}")
         logging.error(f"Error connecting to database: {e}")
         g.db_connect_error = str(e)
         return None
 
+def rated_results(players, mode):
+    # [(user_id, is_win)] -> [(user_id, elo_change, is_win)] for db.settle_match
+    users = db.get_users([user_id for user_id, _ in players])
+    elos = {user_id: users[user_id][3] if user_id in users else rating.BASE_RATING for user_id, _ in players}
+    winners = [elos[user_id] for user_id, is_win in players if is_win]
+    losers = [elos[user_id] for user_id, is_win in players if not is_win]
+    gain = rating.win_gain(winners, losers, mode) if winners and losers else rating.k_factor(mode) // 2
+    return [(user_id, gain if is_win else -gain, is_win) for user_id, is_win in players]
+
+# Web veto state is a bitmask over MAP_POOL in matches.veto_bans, see veto.py
+VETO_POOL = POOLS['web']
+
+def chat_messages_json(rows):
+    # db.get_match_chat rows -> JSON messages, authors from a small cache instead of a JOIN
+    authors = db.get_chat_authors({row[1] for row in rows})
+    messages = []
+    for message_id, user_id, message, created_at in rows:
+        if user_id not in authors:
+            continue # deleted user, the JOIN used to drop these too
+        nickname, avatar_url = authors[user_id]
+        messages.append({
+            'id': message_id,
+            'user_id': user_id,
+            'nickname': nickname,
+            'avatar_url': avatar_url,
+            'message': message,
+            'created_at': str(created_at)
+        })
+    return messages
+
+def load_match_feed(match_id, after_chat_id, limit=None):
+    # Without a cursor: the latest page of chat; else up to `limit` (default all) newer messages
+    if after_chat_id:
+        match, chat_rows = db.get_match_feed(match_id, after_chat_id, limit)
+    else:
+        match, chat_rows = db.get_match_feed(match_id, None, CHAT_PAGE_SIZE)
+    if not match:
+        return None
+    state = {
+        'status': match['status'],
+        'veto_bans': match['veto_bans'] or 0,
+        'current_veto_turn': match['current_veto_turn'],
+        'map_picked': match['map_picked'],
+        'winner_team': match['winner_team'],
+        'last_action_time': match['last_action_time'],
+    }
+    return match['version'] or 0, state, chat_messages_json(chat_rows)
+
+# Pushes match room updates to /api/match/<id>/events streams, see match_events.py
+match_events = MatchEventHub(db.get_match_versions, load_match_feed, chat_history=CHAT_PAGE_SIZE)
+# One per open stream, so streams can't take every worker thread
+stream_slots = threading.BoundedSemaphore(MATCH_EVENTS_MAX_STREAMS)
+
+# Chat inserts from concurrent requests share a transaction, see group_commit.py
+chat_writer = GroupCommit(db.add_match_chat_messages)
+
+# Veto state machines of active matches, cached with write-through, see match_state.py
+match_states = MatchStates(VETO_POOL, on_change=match_events.poke)
+
+# Bans a random map for players who let their turn run out; started by gunicorn.conf.py
+veto_sweeper = VetoSweeper(match_states, VETO_TIMEOUT)
+
+def veto_deadline(state):
+    # Unix time the current ban turn runs out, or None outside the map veto
+    if state['status'] != 'active' or state['map_picked'] or not state['last_action_time']:
+        return None
+    return state['last_action_time'] + VETO_TIMEOUT
+
 def log_error(e, context=""):
     msg = f"Error in {context}: {e}"
     print(msg)
@@ -69,61 +150,57 @@ def check_ban():
         return
     
     if 'user_id' in session:
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            # Select is_admin instead of role, as role column does not exist
-            db.execute_query(cursor, 'SELECT is_banned, is_admin, ban_expiration FROM users WHERE user_id = ?', (session['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
+        try:
+            with db.db_cursor() as cursor:
+                # Select is_admin instead of role, as role column does not exist
+                db.execute_query(cursor, 'SELECT is_banned, is_admin, ban_expiration FROM users WHERE user_id = ?', (session['user_id'],))
+                user = cursor.fetchone()
+        except Exception as e:
+            log_error(e, "check_ban")
+            user = None
+
+        if user:
+            # Update session admin status (for immediate admin grant effect)
+            session['is_admin'] = bool(user['is_admin'])
             
-            if user:
-                # Update session admin status (for immediate admin grant effect)
-                session['is_admin'] = bool(user['is_admin'])
+            # Check ban expiration
+            if user['is_banned']:
+                import time
+                current_time = int(time.time())
+                ban_expiration = user.get('ban_expiration', 0)
                 
-                # Check ban expiration
-                if user['is_banned']:
-                    import time
-                    current_time = int(time.time())
-                    ban_expiration = user.get('ban_expiration', 0)
-                    
-                    if ban_expiration and ban_expiration > 0 and current_time > ban_expiration:
-                         # Ban expired
-                         conn = get_db_connection()
-                         cursor = conn.cursor()
+                if ban_expiration and ban_expiration > 0 and current_time > ban_expiration:
+                     # Ban expired
+                     with db.db_cursor() as cursor:
                          db.execute_query(cursor, 'UPDATE users SET is_banned = 0, ban_expiration = 0 WHERE user_id = ?', (session['user_id'],))
-                         conn.commit()
-                         conn.close()
-                         # User is unbanned, continue
-                    else:
-                        # Allow logout to clear session
-                        if request.endpoint == 'logout':
-                            return
-                            
-                        # For API requests, return 403 so frontend can handle it
-                        if request.path.startswith('/api/'):
-                            return jsonify({'error': 'User is banned', 'is_banned': True}), 403
-                            
-                        return render_template('banned.html', ban_expiration=ban_expiration)
+                     # User is unbanned, continue
+                else:
+                    # Allow logout to clear session
+                    if request.endpoint == 'logout':
+                        return
+                        
+                    # For API requests, return 403 so frontend can handle it
+                    if request.path.startswith('/api/'):
+                        return jsonify({'error': 'User is banned', 'is_banned': True}), 403
+                        
+                    return render_template('banned.html', ban_expiration=ban_expiration)
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    for conn in g.pop('_db_connections', []):
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 @app.route('/')
 def index():
     try:
         user = None
         if 'user_id' in session:
-            conn = get_db_connection()
-            if conn:
-                import db  # Ensure db module is available
-                cursor = conn.cursor()
+            with db.db_cursor() as cursor:
                 db.execute_query(cursor, 'SELECT * FROM users WHERE user_id = ?', (session['user_id'],))
                 user = cursor.fetchone()
-                conn.close()
             
             if user is None and 'user_id' in session:
                 session.clear()
@@ -177,6 +254,7 @@ def settings():
             db.execute_query(cursor, 'UPDATE users SET nickname = ?, avatar_url = ?, bio = ?, game_id = ? WHERE user_id = ?',
                          (nickname, avatar_url, bio, game_id, session['user_id']))
             conn.commit()
+            db.invalidate_user(session['user_id'])
             flash('Настройки сохранены!', 'success')
         except Exception as e:
             log_error(e, "/settings")
@@ -608,16 +686,23 @@ def leaderboard():
         flash('Database error', 'error')
         return redirect(url_for('index'))
         
-    cursor = conn.cursor()
-    # Join with clans to get tags
-    db.execute_query(cursor, '''
-        SELECT u.*, c.tag as clan_tag 
-        FROM users u 
-        LEFT JOIN clan_members cm ON u.user_id = cm.user_id 
-        LEFT JOIN clans c ON cm.clan_id = c.id 
-        ORDER BY u.elo DESC LIMIT 50
-    ''')
-    users = cursor.fetchall()
+    # Order comes from the in-memory leaderboard; only the top-50 rows are read
+    top_ids = db.get_top_player_ids(50)
+    users = []
+    if top_ids:
+        cursor = conn.cursor()
+        # Join with clans to get tags
+        placeholders = ', '.join(['?'] * len(top_ids))
+        db.execute_query(cursor, f'''
+            SELECT u.*, c.tag as clan_tag 
+            FROM users u 
+            LEFT JOIN clan_members cm ON u.user_id = cm.user_id 
+            LEFT JOIN clans c ON cm.clan_id = c.id 
+            WHERE u.user_id IN ({placeholders})
+        ''', top_ids)
+        rows = {row['user_id']: row for row in cursor.fetchall()}
+        # Ranked by the ELO shown, in case a write landed since the tree last caught up
+        users = sorted((rows[uid] for uid in top_ids if uid in rows), key=lambda u: (-u['elo'], u['user_id']))
     conn.close()
     return render_template('leaderboard.html', users=users)
 
@@ -1113,9 +1198,10 @@ def admin_edit_user(user_id):
         cursor = conn.cursor()
         if nickname:
             db.execute_query(cursor, 'UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
-        if elo:
-            db.execute_query(cursor, 'UPDATE users SET elo = ? WHERE user_id = ?', (elo, user_id))
         conn.commit()
+        db.invalidate_user(user_id)
+        if elo:
+            db.set_user_elo(user_id, int(elo))
         flash(f'Данные пользователя {user_id} обновлены', 'success')
     except Exception as e:
         log_error(e, "/admin/edit_user")
@@ -1360,22 +1446,18 @@ def api_match_set_winner(match_id):
             
         winner_team = winner_player['team']
         
-        # Update match status
-        db.execute_query(cursor, "UPDATE matches SET status = 'finished', winner_team = ? WHERE id = ?", (winner_id, match_id))
-        
         # Update ELO (simplified)
         db.execute_query(cursor, 'SELECT user_id, team, is_annulled FROM match_players WHERE match_id = ?', (match_id,))
         players = cursor.fetchall()
+        conn.close()
         
-        for p in players:
-            if p['is_annulled']:
-                continue
-                
-            change = 25 if p['user_id'] == int(winner_id) else -25
-            db.execute_query(cursor, 'UPDATE users SET elo = elo + ? WHERE user_id = ?', (change, p['user_id']))
+        results = rated_results([(p['user_id'], p['user_id'] == int(winner_id)) for p in players if not p['is_annulled']], match['mode'])
             
-        conn.commit()
-        conn.close()
+        # Match status, ELO, wins/matches and levels in one transaction
+        if db.settle_match(match_id, results, winner_team=winner_id) is None:
+            return jsonify({'error': 'Match not active or not found'}), 400
+        match_states.discard(match_id)
+        match_events.poke()
         
         return jsonify({'success': True})
     except Exception as e:
@@ -1411,6 +1493,9 @@ def match_room(match_id):
             
         cursor = conn.cursor()
         
+        # Opens the veto (first turn to the first player) if the match hasn't yet
+        match_states.get(match_id)
+        
         db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
         match = cursor.fetchone()
         
@@ -1430,47 +1515,12 @@ def match_room(match_id):
         ''', (match_id,))
         players = cursor.fetchall()
         
-        # Initialize Veto if not started and match is active
-        # Check if veto_status is None or empty
-        veto_status_raw = match['veto_status']
-        if match['status'] == 'active' and not veto_status_raw:
-            veto_status = {m: 'available' for m in MAP_POOL}
-            # Random first turn
-            first_turn = players[0]['user_id'] if players else session['user_id']
-            
-            # Use json.dumps for the dict
-            veto_json = json.dumps(veto_status)
-            
-            db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, current_veto_turn = ? WHERE id = ?',
-                         (veto_json, first_turn, match_id))
-            conn.commit()
-            # Refresh match data
-            db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
-            match = cursor.fetchone()
-            
-        # Parse veto status
-        veto_data = {}
-        if match['veto_status']:
-            if isinstance(match['veto_status'], str):
-                try:
-                    veto_data = json.loads(match['veto_status'])
-                except:
-                    veto_data = {}
-            else:
-                # If it's already a dict (some drivers might do this, though unlikely with sqlite/psycopg2 unless configured)
-                veto_data = match['veto_status']
-        
-        # Get chat messages
-        db.execute_query(cursor, '''
-            SELECT mc.*, u.nickname, u.avatar_url 
-            FROM match_chat mc
-            JOIN users u ON mc.user_id = u.user_id
-            WHERE mc.match_id = ?
-            ORDER BY mc.created_at ASC
-        ''', (match_id,))
-        chat_messages = cursor.fetchall()
+        veto_data = VETO_POOL.status(match['veto_bans'], match['map_picked'])
         
         conn.close()
+        # Latest page of chat; the page fetches newer messages incrementally
+        chat_messages = chat_messages_json(db.get_match_chat(match_id, None, CHAT_PAGE_SIZE))
+
         return render_template('match_room.html', match=match, players=players, veto_data=veto_data, map_pool=MAP_POOL, chat_messages=chat_messages)
 
     except Exception as e:
@@ -1483,22 +1533,13 @@ def match_room(match_id):
 
 @app.route('/match/<int:match_id>/chat', methods=['POST'])
 def match_chat(match_id):
-    import db
     if 'user_id' not in session: return redirect(url_for('login'))
     
     try:
         message = request.form.get('message')
         if message and len(message.strip()) > 0:
-            conn = get_db_connection()
-            if not conn: 
-                flash("Database connection failed", "error")
-                return redirect(url_for('match_room', match_id=match_id))
-            
-            cursor = conn.cursor()
-            db.execute_query(cursor, 'INSERT INTO match_chat (match_id, user_id, message) VALUES (?, ?, ?)',
-                         (match_id, session['user_id'], message.strip()))
-            conn.commit()
-            conn.close()
+            chat_writer.submit((match_id, session['user_id'], message.strip()))
+            match_events.poke()
     except Exception as e:
         log_error(e, "/match_chat")
         flash(f"Error sending message: {e}", "error")
@@ -1507,76 +1548,12 @@ def match_chat(match_id):
 
 @app.route('/match/<int:match_id>/veto', methods=['POST'])
 def match_veto(match_id):
-    import db
     if 'user_id' not in session: return redirect(url_for('login'))
     
     try:
-        map_name = request.form.get('map_name')
-        conn = get_db_connection()
-        if not conn: 
-            flash("Database connection failed", "error")
-            return redirect(url_for('match_room', match_id=match_id))
-        
-        cursor = conn.cursor()
-        
-        db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
-        match = cursor.fetchone()
-        
-        if not match or match['status'] != 'active':
-            conn.close()
-            return redirect(url_for('match_room', match_id=match_id))
-            
-        # Check turn
-        if str(match['current_veto_turn']) != str(session['user_id']):
+        error = match_states.ban(match_id, session['user_id'], request.form.get('map_name'))
+        if error == 'Not your turn':
             flash('Сейчас не ваш ход!', 'error')
-            conn.close()
-            return redirect(url_for('match_room', match_id=match_id))
-            
-        veto_data = {}
-        if match['veto_status']:
-             if isinstance(match['veto_status'], str):
-                 veto_data = json.loads(match['veto_status'])
-             else:
-                 veto_data = match['veto_status']
-        
-        if veto_data.get(map_name) == 'available':
-            # Ban map
-            veto_data[map_name] = 'banned'
-            
-            # Check remaining maps
-            available_maps = [m for m, s in veto_data.items() if s == 'available']
-            
-            veto_json = json.dumps(veto_data)
-            
-            if len(available_maps) == 1:
-                # Last map picked!
-                last_map = available_maps[0]
-                veto_data[last_map] = 'picked'
-                veto_json = json.dumps(veto_data) # Update json with picked status
-                
-                import time
-                current_time = int(time.time())
-                db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, map_picked = ?, last_action_time = ? WHERE id = ?',
-                             (veto_json, last_map, current_time, match_id))
-            else:
-                # Switch turn
-                db.execute_query(cursor, 'SELECT user_id FROM match_players WHERE match_id = ?', (match_id,))
-                players = cursor.fetchall()
-                next_turn = None
-                for p in players:
-                    if str(p['user_id']) != str(session['user_id']):
-                        next_turn = p['user_id']
-                        break
-                
-                if next_turn:
-                    import time
-                    current_time = int(time.time())
-                    db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, current_veto_turn = ?, last_action_time = ? WHERE id = ?',
-                                 (veto_json, next_turn, current_time, match_id))
-                         
-            conn.commit()
-            
-        conn.close()
     except Exception as e:
         log_error(e, "/match_veto")
         flash(f"Error processing veto: {e}", "error")
@@ -1615,25 +1592,19 @@ def submit_match_result(match_id):
              flash('Только администраторы могут подтверждать результаты', 'error')
              return redirect(url_for('match_room', match_id=match_id))
 
-        db.execute_query(cursor, "UPDATE matches SET status = 'finished', winner_team = ? WHERE id = ?", (winner_id, match_id))
-        
-        # Update ELO (simplified)
-        # Winner +25, Loser -25
-        # Check for annulled players
+        # Update ELO with the rating engine, skipping annulled players
         db.execute_query(cursor, 'SELECT user_id, is_annulled FROM match_players WHERE match_id = ?', (match_id,))
         players = cursor.fetchall()
+        conn.close()
         
-        for p in players:
-            if p['is_annulled']:
-                continue # Skip ELO update for annulled players
+        results = rated_results([(p['user_id'], str(p['user_id']) == str(winner_id)) for p in players if not p['is_annulled']], match['mode'])
                 
-            if str(p['user_id']) == str(winner_id):
-                db.execute_query(cursor, 'UPDATE users SET elo = elo + 25, wins = wins + 1, matches = matches + 1 WHERE user_id = ?', (p['user_id'],))
-            else:
-                db.execute_query(cursor, 'UPDATE users SET elo = elo - 25, matches = matches + 1 WHERE user_id = ?', (p['user_id'],))
-                
-        conn.commit()
-        conn.close()
+        # Match status, ELO, wins/matches and levels in one transaction
+        if db.settle_match(match_id, results, winner_team=winner_id) is None:
+            flash('Match not active or not found', 'error')
+            return redirect(url_for('match_room', match_id=match_id))
+        match_states.discard(match_id)
+        match_events.poke()
         
         flash('Результат матча подтвержден!', 'success')
     except Exception as e:
@@ -1654,10 +1625,12 @@ def cancel_match(match_id):
         cursor = conn.cursor()
         
         # Set match status to cancelled
-        db.execute_query(cursor, "UPDATE matches SET status = 'cancelled' WHERE id = ?", (match_id,))
+        db.execute_query(cursor, "UPDATE matches SET status = 'cancelled', version = version + 1 WHERE id = ?", (match_id,))
         
         conn.commit()
         conn.close()
+        match_states.discard(match_id)
+        match_events.poke()
         
         flash('Матч был отменен. ELO не изменено.', 'success')
     except Exception as e:
@@ -1694,13 +1667,14 @@ def leave_match(match_id):
             return redirect(url_for('play'))
             
         # Mark match as disputed and user as left
-        db.execute_query(cursor, "UPDATE matches SET status = 'disputed' WHERE id = ?", (match_id,))
+        db.execute_query(cursor, "UPDATE matches SET status = 'disputed', version = version + 1 WHERE id = ?", (match_id,))
         db.execute_query(cursor, "UPDATE match_players SET has_left = 1 WHERE match_id = ? AND user_id = ?", (match_id, session['user_id']))
         
         flash('Вы покинули матч. Матч помечен как СПОРНЫЙ. Администратор проверит ситуацию.', 'info')
         
         conn.commit()
         conn.close()
+        match_events.poke()
         
         return redirect(url_for('play'))
     except Exception as e:
@@ -1733,9 +1707,11 @@ def api_annul_player(match_id):
             
         new_status = 0 if row['is_annulled'] else 1
         db.execute_query(cursor, 'UPDATE match_players SET is_annulled = ? WHERE match_id = ? AND user_id = ?', (new_status, match_id, player_id))
+        db.touch_match(cursor, match_id)
         
         conn.commit()
         conn.close()
+        match_events.poke()
         
         return jsonify({'success': True, 'is_annulled': new_status})
     except Exception as e:
@@ -1744,135 +1720,94 @@ def api_annul_player(match_id):
 
 @app.route('/api/match/<int:match_id>')
 def api_match_status(match_id):
+    # Read-only: ban timeouts are applied by veto_sweeper. The ETag follows
+    # matches.version, so polling an unchanged match is one tiny query and a 304.
+    # With ?since_id=N chat_messages only has (up to a page of) messages after N.
     if 'user_id' not in session: 
         return jsonify({'error': 'Unauthorized'}), 401
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database error'}), 500
-            
-        cursor = conn.cursor()
-        
-        # Get match info
-        db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
-        match = cursor.fetchone()
-        
-        if not match:
-            conn.close()
+        since_id = request.args.get('since_id', type=int)
+        version = db.get_match_versions([match_id]).get(match_id)
+        if version is None:
             return jsonify({'error': 'Match not found'}), 404
-            
-        # Parse veto status
-        veto_data = {}
-        if match['veto_status']:
-            if isinstance(match['veto_status'], str):
-                try:
-                    veto_data = json.loads(match['veto_status'])
-                except:
-                    veto_data = {}
-            else:
-                veto_data = match['veto_status']
-        
-        # Check for timeout (30 seconds)
-        remaining_time = 30
-        if match['status'] == 'active' and not match['map_picked']:
-            import time
-            current_time = int(time.time())
-            last_action_time = match['last_action_time']
-            
-            # If last_action_time is missing (for old matches), set it to now
-            if not last_action_time:
-                last_action_time = current_time
-                db.execute_query(cursor, 'UPDATE matches SET last_action_time = ? WHERE id = ?', (current_time, match_id))
-                conn.commit()
-            
-            remaining_time = 30 - (current_time - last_action_time)
-            
-            if remaining_time <= 0:
-                # Timeout! Perform random action
-                if not veto_data:
-                    # Initialize if empty
-                    veto_data = {m: 'available' for m in MAP_POOL}
-                
-                available_maps = [m for m, s in veto_data.items() if s == 'available']
-                if available_maps:
-                    import random
-                    map_to_ban = random.choice(available_maps)
-                    veto_data[map_to_ban] = 'banned'
-                    
-                    # Check remaining
-                    available_maps = [m for m, s in veto_data.items() if s == 'available']
-                    veto_json = json.dumps(veto_data)
-                    
-                    if len(available_maps) == 1:
-                        # Last map picked
-                        last_map = available_maps[0]
-                        veto_data[last_map] = 'picked'
-                        veto_json = json.dumps(veto_data)
-                        db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, map_picked = ?, last_action_time = ? WHERE id = ?', (veto_json, last_map, current_time, match_id))
-                        match['map_picked'] = last_map
-                        # match['veto_status'] updated implicitly for response via veto_data
-                    else:
-                        # Switch turn
-                        current_turn = match['current_veto_turn']
-                        db.execute_query(cursor, 'SELECT user_id FROM match_players WHERE match_id = ?', (match_id,))
-                        players = cursor.fetchall()
-                        next_turn = None
-                        
-                        # If current_turn is not set, pick first player
-                        if not current_turn and players:
-                             current_turn = players[0]['user_id']
-                             
-                        for p in players:
-                            if str(p['user_id']) != str(current_turn):
-                                next_turn = p['user_id']
-                                break
-                        
-                        if next_turn:
-                            db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, current_veto_turn = ?, last_action_time = ? WHERE id = ?', (veto_json, next_turn, current_time, match_id))
-                            match['current_veto_turn'] = next_turn
-                    
-                    conn.commit()
-                    remaining_time = 30 # Reset timer for next turn
-
-        # Get chat messages
-        db.execute_query(cursor, '''
-            SELECT mc.id, mc.message, mc.created_at, mc.user_id, u.nickname, u.avatar_url 
-            FROM match_chat mc
-            JOIN users u ON mc.user_id = u.user_id
-            WHERE mc.match_id = ?
-            ORDER BY mc.created_at ASC
-        ''', (match_id,))
-        chat_rows = cursor.fetchall()
-        
-        chat_messages = []
-        for row in chat_rows:
-            chat_messages.append({
-                'id': row['id'],
-                'user_id': row['user_id'],
-                'nickname': row['nickname'],
-                'avatar_url': row['avatar_url'],
-                'message': row['message'],
-                'created_at': str(row['created_at'])
-            })
-            
-        conn.close()
-        
-        return jsonify({
-            'status': match['status'],
-            'veto_status': veto_data,
-            'current_veto_turn': match['current_veto_turn'],
-            'map_picked': match['map_picked'],
-            'winner_team': match['winner_team'],
-            'chat_messages': chat_messages,
-            'current_user_id': session['user_id'],
-            'remaining_time': remaining_time
-        })
+        if f"{match_id}-{version}-{session['user_id']}-{since_id}" in request.if_none_match:
+            response = Response(status=304)
+        else:
+            feed = load_match_feed(match_id, since_id, CHAT_PAGE_SIZE)
+            if feed is None:
+                return jsonify({'error': 'Match not found'}), 404
+            version, state, chat_messages = feed
+            response = jsonify(dict(state,
+                                    version=version,
+                                    chat_messages=chat_messages,
+                                    chat_reset=not since_id,
+                                    current_user_id=session['user_id'],
+                                    veto_deadline=veto_deadline(state)))
+        response.set_etag(f"{match_id}-{version}-{session['user_id']}-{since_id}")
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         log_error(e, "/api/match")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/match/<int:match_id>/events')
+def api_match_events(match_id):
+    # Server-Sent Events: a 'match' event with the same fields as /api/match/<id>
+    # whenever the match changes. The first event carries the latest page of
+    # chat (chat_reset), later ones only new messages. The page falls back to polling
+    # /api/match/<id> if the stream can't be opened, e.g. 503 when all slots are taken.
+    if 'user_id' not in session: 
+        return jsonify({'error': 'Unauthorized'}), 401
+    user_id = session['user_id']
+
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many open streams'}), 503
+    feed = match_events.subscribe(match_id)
+    if feed is None:
+        stream_slots.release()
+        return jsonify({'error': 'Match not found'}), 404
+
+    def stream():
+        version, chat_id = None, 0
+        expires = time.monotonic() + MATCH_EVENTS_MAX_AGE
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    break # the browser reconnects after `retry`
+                if not match_events.wait(feed, version, min(MATCH_EVENTS_HEARTBEAT, remaining)):
+                    yield ': keep-alive\n\n'
+                    continue
+                new_version, state, messages = match_events.read(feed, chat_id)
+                if state is None:
+                    break
+                payload = dict(state,
+                               version=new_version,
+                               chat_messages=messages,
+                               chat_reset=version is None,
+                               current_user_id=user_id,
+                               veto_deadline=veto_deadline(state),
+                               server_time=time.time())
+                version = new_version
+                if messages:
+                    chat_id = messages[-1]['id']
+                yield f'event: match\ndata: {json.dumps(payload)}\n\n'
+        except Exception as e:
+            log_error(e, "/api/match/events")
+
+    def close():
+        # Also runs for a stream closed before its first chunk
+        match_events.unsubscribe(match_id, feed)
+        stream_slots.release()
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
+
 @app.route('/api/match/<int:match_id>/veto', methods=['POST'])
 def api_match_veto(match_id):
     if 'user_id' not in session: 
@@ -1880,79 +1815,37 @@ def api_match_veto(match_id):
     
     try:
         data = request.get_json()
-        map_name = data.get('map_name')
-        
-        conn = get_db_connection()
-        if not conn: 
-            return jsonify({'error': 'Database error'}), 500
-        
-        cursor = conn.cursor()
-        
-        db.execute_query(cursor, 'SELECT * FROM matches WHERE id = ?', (match_id,))
-        match = cursor.fetchone()
-        
-        if not match or match['status'] != 'active':
-            conn.close()
-            return jsonify({'error': 'Match not active'}), 400
-            
-        # Check turn
-        if str(match['current_veto_turn']) != str(session['user_id']):
-            conn.close()
-            return jsonify({'error': 'Not your turn'}), 400
-            
-        veto_data = {}
-        if match['veto_status']:
-             if isinstance(match['veto_status'], str):
-                 try:
-                     veto_data = json.loads(match['veto_status'])
-                 except:
-                     veto_data = {}
-             else:
-                 veto_data = match['veto_status']
-        
-        if veto_data.get(map_name) == 'available':
-            # Ban map
-            veto_data[map_name] = 'banned'
-            
-            # Check remaining maps
-            available_maps = [m for m, s in veto_data.items() if s == 'available']
-            
-            veto_json = json.dumps(veto_data)
-            
-            if len(available_maps) == 1:
-                # Last map picked!
-                import time
-                current_time = int(time.time())
-                last_map = available_maps[0]
-                veto_data[last_map] = 'picked'
-                veto_json = json.dumps(veto_data) # Update json with picked status
-                
-                db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, map_picked = ?, last_action_time = ? WHERE id = ?',
-                             (veto_json, last_map, current_time, match_id))
-            else:
-                # Switch turn
-                db.execute_query(cursor, 'SELECT user_id FROM match_players WHERE match_id = ?', (match_id,))
-                players = cursor.fetchall()
-                next_turn = None
-                for p in players:
-                    if str(p['user_id']) != str(session['user_id']):
-                        next_turn = p['user_id']
-                        break
-                
-                if next_turn:
-                    import time
-                    current_time = int(time.time())
-                    db.execute_query(cursor, 'UPDATE matches SET veto_status = ?, current_veto_turn = ?, last_action_time = ? WHERE id = ?',
-                                 (veto_json, next_turn, current_time, match_id))
-                         
-            conn.commit()
-            
-        conn.close()
+        error = match_states.ban(match_id, session['user_id'], data.get('map_name'))
+        if error:
+            return jsonify({'error': error}), 400
         return jsonify({'success': True})
     except Exception as e:
         log_error(e, "/api/match/veto")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/match/<int:match_id>/chat')
+def api_match_chat_history(match_id):
+    # Incremental chat: ?since_id=N returns up to `limit` messages after N, oldest
+    # first; without since_id, the latest page. Poll again with since_id=last_id.
+    if 'user_id' not in session: 
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        since_id = request.args.get('since_id', type=int)
+        limit = max(1, min(request.args.get('limit', CHAT_PAGE_SIZE, type=int), CHAT_PAGE_SIZE))
+        # One extra row tells whether there is more after this page
+        rows = db.get_match_chat(match_id, since_id, limit if since_id is None else limit + 1)
+        has_more = since_id is not None and len(rows) > limit
+        rows = rows[:limit]
+        return jsonify({
+            'messages': chat_messages_json(rows),
+            'last_id': rows[-1][0] if rows else since_id or 0,
+            'has_more': has_more
+        })
+    except Exception as e:
+        log_error(e, "/api/match/chat_history")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/match/<int:match_id>/chat', methods=['POST'])
 def api_match_chat(match_id):
     if 'user_id' not in session: 
@@ -1988,10 +1881,9 @@ def api_match_chat(match_id):
             conn.close()
             return jsonify({'error': 'Access denied'}), 403
             
-        db.execute_query(cursor, 'INSERT INTO match_chat (match_id, user_id, message) VALUES (?, ?, ?)',
-                     (match_id, session['user_id'], message.strip()))
-        conn.commit()
         conn.close()
+        chat_writer.submit((match_id, session['user_id'], message.strip()))
+        match_events.poke()
         return jsonify({'success': True})
     except Exception as e:
         log_error(e, "/api/match/chat")
@@ -2101,4 +1993,5 @@ def api_admin_set_role_v2():
 
 # force deploy check
 if __name__ == '__main__':
+    veto_sweeper.start()
     app.run(debug=True, port=5000)
\ No newline at end of file